@@ -3,7 +3,44 @@ import pandas as pd
 import os
 import hashlib
 import shutil
+import threading
+import csv
+import sqlite3
+import time
+import tempfile
+from contextlib import contextmanager
+from dataclasses import dataclass
 from datetime import date, datetime
+from io import BytesIO
+
+import finanzas
+import respaldos
+import asignaciones
+
+try:
+    import fcntl  # bloqueos entre procesos (no existe en Windows)
+except Exception:
+    fcntl = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as pa_feather
+except Exception:
+    pa = None
+    pa_feather = None
+
+# Copy-on-Write: permite entregar vistas baratas de las tablas en caché
+# (pandas >= 3 ya lo trae siempre activo)
+_PANDAS_MAYOR = int(str(pd.__version__).split(".")[0])
+if _PANDAS_MAYOR < 3:
+    try:
+        pd.set_option("mode.copy_on_write", True)
+    except Exception:
+        pass
+try:
+    _COW_ACTIVO = _PANDAS_MAYOR >= 3 or bool(pd.get_option("mode.copy_on_write"))
+except Exception:
+    _COW_ACTIVO = False
 
 # ==========================================================
 # MARCA / CONFIGURACIÓN GENERAL
@@ -19,10 +56,18 @@ DATA_DIR = "."
 BACKUP_DIR = os.path.join(DATA_DIR, "backups")
 UPLOADS_DIR = os.path.join(DATA_DIR, "uploads")
 GENERADOS_DIR = os.path.join(DATA_DIR, "generados")
+LOCKS_DIR = os.path.join(DATA_DIR, ".locks")
+COLUMNAR_DIR = os.path.join(DATA_DIR, ".columnar")
 
 os.makedirs(BACKUP_DIR, exist_ok=True)
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 os.makedirs(GENERADOS_DIR, exist_ok=True)
+os.makedirs(LOCKS_DIR, exist_ok=True)
+os.makedirs(COLUMNAR_DIR, exist_ok=True)
+
+# Retención de respaldos: uno por hora durante N horas y uno por día durante M días
+BACKUP_RETENCION_HORAS = int(st.secrets.get("BACKUP_RETENCION_HORAS", 48))
+BACKUP_RETENCION_DIAS = int(st.secrets.get("BACKUP_RETENCION_DIAS", 60))
 
 st.set_page_config(page_title=f"⚖️ {APP_NAME} – {APP_VERSION}", layout="wide")
 
@@ -56,6 +101,19 @@ FILES = {
     "contratos": "contratos.csv",
     "auditoria_mod": "auditoria_mod.csv",
 
+    # ✅ tablas derivadas (se mantienen solas, ver TABLAS DERIVADAS)
+    "saldos_por_caso": "saldos_por_caso.csv",
+    "cubo_reportes": "cubo_reportes.csv",
+    "asignaciones_caso": "asignaciones_caso.csv",
+
+    # ✅ cierres mensuales (fotos congeladas del cubo)
+    "cierres": "cierres.csv",
+    "cierres_detalle": "cierres_detalle.csv",
+    "cierres_alertas": "cierres_alertas.csv",
+
+    # ✅ libro diario (partida doble, solo se agrega)
+    "libro_diario": "libro_diario.csv",
+
     # ✅ roles/permisos
     "permisos": "permisos.csv",
 }
@@ -222,6 +280,25 @@ SCHEMAS = {
     "colaboradores": [
         "ID","Nombre","DNI","Tipo","Usuario","Activo","Observaciones"
     ],
+
+    # ======================
+    # TABLAS DERIVADAS
+    # ======================
+    "saldos_por_caso": finanzas.SALDOS.columnas,
+    "cubo_reportes": finanzas.CUBO.columnas,
+    "asignaciones_caso": asignaciones.ASIGNACION_COLS,
+
+    # ======================
+    # CIERRES MENSUALES
+    # ======================
+    "cierres": ["Mes","FechaCierre","Usuario","Filas"],
+    "cierres_detalle": finanzas.CIERRE_COLS,
+    "cierres_alertas": ["ID","Fecha","Mes","Caso","Tabla","Usuario","Detalle"],
+
+    # ======================
+    # LIBRO DIARIO
+    # ======================
+    "libro_diario": finanzas.LIBRO.columnas,
 }
 
 # ============================
@@ -230,6 +307,42 @@ SCHEMAS = {
 ETAPAS_HONORARIOS = ["Primera instancia", "Segunda instancia", "Casación", "Otros"]
 TIPOS_CUOTA = ["Honorarios", "CuotaLitis"]
 
+# ==========================================================
+# TIPOS POR TABLA (se aplican UNA vez al cargar; la caché guarda la tabla tipada)
+# - "dinero": float64 (vacío / no numérico → 0.0)
+# - "entero": int64 (vacío → 0)
+# - "fecha": datetime64 (vacío → NaT). Si hay texto que no es fecha,
+#   la columna queda como texto para no perderlo al guardar.
+# - "categoria": category (valores conocidos + los presentes)
+# - Toda otra columna del schema (salvo ID) se carga como texto
+# ==========================================================
+SCHEMA_TIPOS = {
+    "honorarios": {"Monto Pactado": "dinero"},
+    "honorarios_etapas": {"Etapa": "categoria", "Monto Pactado": "dinero"},
+    "pagos_honorarios": {"Etapa": "categoria", "FechaPago": "fecha", "Monto": "dinero"},
+    "cuota_litis": {"Monto Base": "dinero", "Porcentaje": "dinero"},
+    "pagos_litis": {"FechaPago": "fecha", "Monto": "dinero"},
+    "cuotas": {"Tipo": "categoria", "NroCuota": "entero", "FechaVenc": "fecha", "Monto": "dinero"},
+    "actuaciones": {
+        "Fecha": "fecha", "FechaProximaAccion": "fecha",
+        "CostasAranceles": "dinero", "Gastos": "dinero",
+    },
+    "consultas": {"Fecha": "fecha", "CostoConsulta": "dinero", "HonorariosPropuestos": "dinero"},
+    "instancias": {"Honorarios": "dinero"},
+    "honorarios_tipo": {"Monto": "dinero"},
+    "saldos_por_caso": {**{c: "dinero" for c in finanzas.SALDOS.montos}, "NroEtapas": "entero"},
+    "cubo_reportes": {**{c: "dinero" for c in finanzas.CUBO.montos}, "Etapas": "entero"},
+    "cierres": {"Filas": "entero"},
+    "cierres_detalle": {c: "dinero" for c in finanzas.CONCEPTOS_CUBO},
+    "libro_diario": {"Asiento": "entero", "Debe": "dinero", "Haber": "dinero"},
+}
+
+CATEGORIAS_CONOCIDAS = {
+    ("honorarios_etapas", "Etapa"): ETAPAS_HONORARIOS,
+    ("pagos_honorarios", "Etapa"): ETAPAS_HONORARIOS,
+    ("cuotas", "Tipo"): TIPOS_CUOTA,
+}
+
 # ==========================================================
 # UTILIDADES (DEBEN IR ANTES DE ensure_csv/load_df/save_df)
 # ==========================================================
@@ -271,6 +384,17 @@ def money(x):
         return 0.0
 
 
+def fecha_txt(x) -> str:
+    """Fecha para mostrar / editar: YYYY-MM-DD (con hora solo si la tiene)."""
+    if x is None or (not isinstance(x, str) and pd.isna(x)):
+        return ""
+    if isinstance(x, (pd.Timestamp, datetime)):
+        if (x.hour, x.minute, x.second) == (0, 0, 0):
+            return x.strftime("%Y-%m-%d")
+        return x.strftime("%Y-%m-%d %H:%M:%S")
+    return str(x)
+
+
 def to_date_safe(x):
     if pd.isna(x) or str(x).strip() == "":
         return None
@@ -280,14 +404,33 @@ def to_date_safe(x):
         return None
 
 
-def backup_file(path: str):
+# ==========================================================
+# RESPALDOS (almacén por contenido, ver respaldos.py)
+# - gzip por hash: una versión repetida no ocupa espacio otra vez
+# - si la tabla no cambió desde su último respaldo, no se registra
+# - la poda por retención corre sola (como mucho una vez por hora)
+# ==========================================================
+@st.cache_resource
+def almacen_respaldos() -> respaldos.Almacen:
+    return respaldos.Almacen(
+        BACKUP_DIR, LOCKS_DIR,
+        horas=BACKUP_RETENCION_HORAS, dias=BACKUP_RETENCION_DIAS,
+    )
+
+
+def _tabla_de_archivo(path: str) -> str:
+    base = os.path.basename(path)
+    for k, v in FILES.items():
+        if os.path.basename(v) == base:
+            return k
+    return os.path.splitext(base)[0]
+
+
+def backup_file(path: str, motivo: str = "guardado"):
     if not os.path.exists(path):
         return
-    base = os.path.basename(path)
-    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    dst = os.path.join(BACKUP_DIR, f"{base}.{stamp}.bak")
     try:
-        shutil.copy2(path, dst)
+        almacen_respaldos().respaldar_archivo(_tabla_de_archivo(path), path, motivo)
     except Exception:
         pass
 
@@ -298,19 +441,67 @@ def backup_file(path: str):
 # - save_df: backup + NO recorta columnas
 # ==========================================================
 
+@st.cache_resource
+def _cache_headers() -> dict:
+    # key -> (firma_archivo, version_schema) de la última verificación OK
+    return {}
+
+
+def _header_csv(path: str):
+    """Lee SOLO la primera línea del CSV. None si no se puede interpretar."""
+    try:
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            return next(csv.reader(f), None)
+    except (OSError, UnicodeDecodeError, csv.Error):
+        return None
+
+
+def _header_ok(header, cols) -> bool:
+    if not header:
+        return False
+    limpio = [str(h).strip() for h in header]
+    if any((not h) or h.startswith("Unnamed") for h in limpio):
+        return False
+    if len(set(limpio)) != len(limpio):
+        return False
+    return all(c in limpio for c in cols)
+
+
+def _csv_al_dia(key: str, path: str, cols) -> bool:
+    # Camino rápido: solo el header (sin parsear ni reescribir el archivo).
+    # Filas corruptas en el cuerpo las rescata _leer_csv al leer.
+    if not os.path.exists(path):
+        return False
+    ya = _cache_headers()
+    firma = (_firma_archivo(path), tuple(cols))
+    if firma[0] is not None and ya.get(key) == firma:
+        return True
+    if _header_ok(_header_csv(path), cols):
+        ya[key] = firma
+        return True
+    return False
+
+
 def ensure_csv(key: str):
     path = FILES[key]
     cols = SCHEMAS.get(key, ["ID"])
+    if _csv_al_dia(key, path, cols):
+        return
+    # Crear / reparar bajo bloqueo de la tabla (otra sesión puede estar escribiendo)
+    with _bloqueo_tabla(key):
+        _ensure_csv_completo(path, cols)
+
 
+def _ensure_csv_completo(path: str, cols):
     # Crear si no existe
     if not os.path.exists(path):
-        pd.DataFrame(columns=cols).to_csv(path, index=False)
+        _escribir_csv_atomico(path, pd.DataFrame(columns=cols))
         return
 
     # Si está vacío, recrear con schema
     try:
         if os.path.getsize(path) == 0:
-            pd.DataFrame(columns=cols).to_csv(path, index=False)
+            _escribir_csv_atomico(path, pd.DataFrame(columns=cols))
             return
     except OSError:
         pass
@@ -320,37 +511,25 @@ def ensure_csv(key: str):
         df = pd.read_csv(path)
     except pd.errors.EmptyDataError:
         # archivo vacío lógico
-        try:
-            stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            shutil.copy2(path, os.path.join(BACKUP_DIR, f"{os.path.basename(path)}.{stamp}.empty.bak"))
-        except Exception:
-            pass
-        pd.DataFrame(columns=cols).to_csv(path, index=False)
+        backup_file(path, motivo="vacio")
+        _escribir_csv_atomico(path, pd.DataFrame(columns=cols))
         return
 
     except pd.errors.ParserError:
         # CSV corrupto: respaldar e intentar rescatar
-        try:
-            stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            shutil.copy2(path, os.path.join(BACKUP_DIR, f"{os.path.basename(path)}.{stamp}.corrupt.bak"))
-        except Exception:
-            pass
+        backup_file(path, motivo="corrupto")
 
         try:
             df = pd.read_csv(path, engine="python", on_bad_lines="skip")
         except Exception:
             # No se pudo rescatar: recrear vacío (backup ya hecho)
-            pd.DataFrame(columns=cols).to_csv(path, index=False)
+            _escribir_csv_atomico(path, pd.DataFrame(columns=cols))
             return
 
     except Exception:
         # Cualquier otra falla: respaldar y recrear
-        try:
-            stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            shutil.copy2(path, os.path.join(BACKUP_DIR, f"{os.path.basename(path)}.{stamp}.readfail.bak"))
-        except Exception:
-            pass
-        pd.DataFrame(columns=cols).to_csv(path, index=False)
+        backup_file(path, motivo="ilegible")
+        _escribir_csv_atomico(path, pd.DataFrame(columns=cols))
         return
 
     # Limpieza segura
@@ -361,13 +540,836 @@ def ensure_csv(key: str):
         if c not in df.columns:
             df[c] = ""
 
-    df.to_csv(path, index=False)
+    _escribir_csv_atomico(path, df)
+
+
+# ==========================================================
+# ESCRITURA SEGURA (varias sesiones a la vez)
+# - CSV: archivo temporal + os.replace (nunca queda a medio escribir)
+# - Bloqueo consultivo por tabla (fcntl; sin fcntl, solo dentro del proceso)
+# - Versión optimista: load_df marca df.attrs["_version"]; save_df rechaza
+#   guardar una tabla que otra sesión modificó después de leerla, y también
+#   un frame sin versión (no se sabe qué leyó): se cuenta por tabla en
+#   "Escrituras concurrentes". Solo save_df(..., reemplazar=True) escribe
+#   sin versión (tablas armadas completas bajo el bloqueo)
+# ==========================================================
+class ConflictoDeVersion(Exception):
+    pass
+
+
+def _escribir_csv_atomico(path: str, df: pd.DataFrame):
+    carpeta = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=carpeta)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            df.to_csv(f, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+@st.cache_resource
+def _bloqueos() -> dict:
+    return {"locks": {}, "metricas": {}, "sin_version": {}, "lock": threading.Lock()}
+
+
+_bloqueos_hilo = threading.local()
+
+
+@contextmanager
+def _bloqueo_tabla(key: str):
+    """Bloqueo exclusivo de escritura de una tabla (reentrante en el mismo hilo)."""
+    tomados = getattr(_bloqueos_hilo, "tablas", None)
+    if tomados is None:
+        tomados = _bloqueos_hilo.tablas = set()
+    if key in tomados:
+        yield
+        return
+
+    reg = _bloqueos()
+    with reg["lock"]:
+        lock = reg["locks"].setdefault(key, threading.Lock())
+
+    t0 = time.perf_counter()
+    lock.acquire()
+    f = None
+    try:
+        if fcntl is not None:
+            f = open(os.path.join(LOCKS_DIR, f"{key}.lock"), "a")
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        espera = time.perf_counter() - t0
+
+        with reg["lock"]:
+            m = reg["metricas"].setdefault(key, {"n": 0, "total": 0.0, "max": 0.0})
+            m["n"] += 1
+            m["total"] += espera
+            m["max"] = max(m["max"], espera)
+
+        tomados.add(key)
+        try:
+            yield
+        finally:
+            tomados.discard(key)
+    finally:
+        if f is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            finally:
+                f.close()
+        lock.release()
+
+
+def metricas_bloqueo() -> pd.DataFrame:
+    reg = _bloqueos()
+    with reg["lock"]:
+        filas = [
+            {
+                "Tabla": k,
+                "Bloqueos": m["n"],
+                "Espera total (ms)": round(m["total"] * 1000, 1),
+                "Espera promedio (ms)": round(m["total"] * 1000 / m["n"], 2) if m["n"] else 0.0,
+                "Espera máx (ms)": round(m["max"] * 1000, 1),
+                "Guardados sin versión": reg["sin_version"].get(k, 0),
+            }
+            for k, m in sorted(reg["metricas"].items())
+        ]
+    return pd.DataFrame(filas, columns=[
+        "Tabla", "Bloqueos", "Espera total (ms)", "Espera promedio (ms)", "Espera máx (ms)", "Guardados sin versión",
+    ])
+
+
+def _marcar_version(df: pd.DataFrame, ver):
+    if df is not None:
+        df.attrs["_version"] = (storage().nombre, ver)
+    return df
+
+
+def _verificar_version(key: str, df: pd.DataFrame):
+    """Llamar con el bloqueo de la tabla tomado."""
+    esperado = df.attrs.get("_version") if df is not None else None
+    if esperado is None:
+        # frame que perdió attrs (concat con un DataFrame nuevo, etc.): no se
+        # puede saber si pisa cambios de otra sesión
+        reg = _bloqueos()
+        with reg["lock"]:
+            reg["sin_version"][key] = reg["sin_version"].get(key, 0) + 1
+        raise ConflictoDeVersion(key, "sin versión")
+    actual = (storage().nombre, storage().version(key))
+    if esperado != actual:
+        raise ConflictoDeVersion(key)
+
+
+# ==========================================================
+# CACHÉ DE TABLAS (compartida por todo el proceso / todas las sesiones)
+# - clave: (tabla, firma del CSV = mtime/size/inode, versión del schema)
+# - load_df entrega una vista copy-on-write: mutarla NO altera la caché
+# - save_df invalida la entrada de la tabla escrita
+# ==========================================================
+@st.cache_resource
+def _cache_tablas() -> dict:
+    return {"datos": {}, "lock": threading.Lock()}
+
+
+def _firma_archivo(path: str):
+    try:
+        s = os.stat(path)
+    except OSError:
+        return None
+    return (s.st_mtime_ns, s.st_size, s.st_ino)
+
+
+def _version_schema(key: str) -> tuple:
+    return (tuple(SCHEMAS.get(key, [])), tuple(sorted(SCHEMA_TIPOS.get(key, {}).items())))
+
+
+def _firma_tablas(keys) -> tuple:
+    be = storage()
+    return (be.nombre,) + tuple((be.version(k), _version_schema(k)) for k in keys)
+
+
+def _vista_df(df: pd.DataFrame) -> pd.DataFrame:
+    # Con CoW la copia superficial es O(1); sin CoW hay que copiar de verdad
+    return df.copy(deep=False) if _COW_ACTIVO else df.copy()
+
+
+def invalidar_cache(key: str = None):
+    cache = _cache_tablas()
+    with cache["lock"]:
+        if key is None:
+            cache["datos"].clear()
+        else:
+            cache["datos"].pop(key, None)
+
 
+# ==========================================================
+# ALMACENAMIENTO (BACKEND CONFIGURABLE)
+# - st.secrets["STORAGE_BACKEND"] = "csv" (por defecto) | "sqlite"
+# - CSV: un archivo por tabla (comportamiento histórico)
+# - SQLite (WAL): clave primaria por tabla, índices en Caso/Expediente y
+#   escrituras fila a fila (solo INSERT/UPDATE/DELETE de lo que cambió)
+# - Al activar SQLite, cada tabla se migra UNA vez desde su CSV
+# ==========================================================
+STORAGE_BACKEND = str(st.secrets.get("STORAGE_BACKEND", "csv")).strip().lower()
+SQLITE_DB = st.secrets.get("SQLITE_DB", os.path.join(DATA_DIR, "data.db"))
+
+# Clave primaria por tabla (si no figura: "ID")
+PK_TABLAS = {
+    "usuarios": ["Usuario"],
+    "permisos": ["Scope", "ScopeID"],
+    "saldos_por_caso": finanzas.SALDOS.claves,
+    "cubo_reportes": finanzas.CUBO.claves,
+    "cierres": ["Mes"],
+    "cierres_detalle": ["Mes", "Caso", "Abogado"],
+}
+COLS_INDEXADAS = ["Caso", "Expediente"]
+# Índices compuestos extra (SQLite) por tabla
+INDICES_TABLAS = {
+    "libro_diario": [["Caso", "Fecha"], ["Fecha"]],
+    "asignaciones_caso": [["Persona", "Rol"]],
+}
+
+# Tablas ligadas a caso (columna del expediente: COL_CASO, si no "Caso").
+# TABLAS_POR_USUARIO son las que tables_for() acota por expediente; save_df
+# las usa ya en la carga inicial (guardado de reparaciones)
+TABLAS_CON_CASO = [
+    "honorarios", "honorarios_etapas", "pagos_honorarios", "cuota_litis",
+    "pagos_litis", "cuotas", "actuaciones", "documentos"
+]
+COL_CASO = {"casos": "Expediente"}
+# consultas no: el expediente es opcional y una consulta sin Caso quedaría
+# oculta para todos los usuarios restringidos
+TABLAS_POR_USUARIO = ["casos"] + TABLAS_CON_CASO
+
+# Secuencias de ID (backend CSV): un contador por tabla
+SECUENCIAS_FILE = os.path.join(DATA_DIR, "secuencias.csv")
 
-def load_df(key: str) -> pd.DataFrame:
-    # Asegura que el CSV exista y sea legible
-    ensure_csv(key)
 
+def _q(nombre) -> str:
+    return '"' + str(nombre).replace('"', '""') + '"'
+
+
+def _valor_sql(v):
+    if v is None or v is pd.NaT or v is pd.NA:
+        return None
+    if isinstance(v, str):
+        return v if v != "" else None
+    if isinstance(v, (int, float)):
+        return None if v != v else v
+    if isinstance(v, datetime):
+        return v.strftime("%Y-%m-%d") if v == datetime(v.year, v.month, v.day) else v.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(v, date):
+        return v.isoformat()
+    try:
+        if pd.isna(v):
+            return None
+    except (TypeError, ValueError):
+        pass
+    return str(v)
+
+
+def _filas_sql(df: pd.DataFrame) -> list:
+    # astype(object) entrega escalares Python (int/float/Timestamp)
+    return [tuple(_valor_sql(v) for v in fila) for fila in df.astype(object).itertuples(index=False, name=None)]
+
+
+def _pk_valida(df: pd.DataFrame, pk: list) -> bool:
+    if not pk or any(c not in df.columns for c in pk):
+        return False
+    claves = df[pk]
+    if claves.isna().any().any() or claves.duplicated().any():
+        return False
+    if pk == ["ID"]:
+        ids = pd.to_numeric(df["ID"], errors="coerce")
+        return bool(ids.notna().all() and (ids == ids.round()).all())
+    return True
+
+
+class StorageBackend:
+    """
+    Interfaz de almacenamiento que usan load_df/save_df.
+    - preparar(key): deja la tabla creada y legible
+    - version(key): token barato que cambia con cada escritura (clave de caché)
+    - leer(key): DataFrame crudo (las migraciones suaves las aplica load_df)
+    - escribir(key, df): persiste la tabla completa
+    - agregar(key, fila): persiste UNA fila nueva; False si no es posible
+      (p. ej. columnas nuevas) y hay que usar escribir
+    - agregar_filas(key, df): lo mismo para varias filas de una vez
+    - sumar_filas(key, df, claves): suma los montos de df (las columnas que
+      no son claves) a las filas con la misma clave; False si no es posible
+      y hay que usar escribir. Con acumula_repetidas la clave puede quedar
+      repetida en la tabla (quien la lee suma las repetidas)
+    - respaldar(key): copia de seguridad de la tabla
+    - reservar_ids(key, n, piso): n IDs nuevos de la secuencia de la tabla
+      (devuelve el primero); piso = ID mínimo ya usado
+    """
+    nombre = "base"
+    respaldo_por_escritura = True
+    acumula_repetidas = False
+
+    def preparar(self, key: str):
+        raise NotImplementedError
+
+    def version(self, key: str):
+        raise NotImplementedError
+
+    def leer(self, key: str) -> pd.DataFrame:
+        raise NotImplementedError
+
+    def escribir(self, key: str, df: pd.DataFrame):
+        raise NotImplementedError
+
+    def agregar(self, key: str, fila: dict) -> bool:
+        raise NotImplementedError
+
+    def agregar_filas(self, key: str, filas: pd.DataFrame) -> bool:
+        raise NotImplementedError
+
+    def sumar_filas(self, key: str, filas: pd.DataFrame, claves: list) -> bool:
+        raise NotImplementedError
+
+    def respaldar(self, key: str):
+        raise NotImplementedError
+
+    def reservar_ids(self, key: str, n: int = 1, piso=None) -> int:
+        raise NotImplementedError
+
+    def reiniciar_secuencias(self):
+        raise NotImplementedError
+
+
+class CSVBackend(StorageBackend):
+    nombre = "csv"
+    # sumar_filas agrega la diferencia al final en vez de reescribir el archivo
+    acumula_repetidas = True
+
+    def preparar(self, key: str):
+        ensure_csv(key)
+
+    def version(self, key: str):
+        return _firma_archivo(FILES[key])
+
+    def leer(self, key: str) -> pd.DataFrame:
+        return _leer_csv(key)
+
+    def escribir(self, key: str, df: pd.DataFrame):
+        _escribir_csv_atomico(FILES[key], df)
+
+    def agregar(self, key: str, fila: dict) -> bool:
+        path = FILES[key]
+        header = _header_csv(path)
+        if not header or any(str(c) not in header for c in fila):
+            return False
+        linea = pd.DataFrame([fila], columns=header).to_csv(header=False, index=False)
+
+        # si la última línea no termina en salto, no pegar la fila a ella
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) not in (b"\n", b"\r"):
+                    linea = "\n" + linea
+
+        with open(path, "a", encoding="utf-8", newline="") as f:
+            f.write(linea)
+            f.flush()
+            os.fsync(f.fileno())
+        return True
+
+    def agregar_filas(self, key: str, filas: pd.DataFrame) -> bool:
+        path = FILES[key]
+        header = _header_csv(path)
+        if not header or any(str(c) not in header for c in filas.columns):
+            return False
+        if filas.empty:
+            return True
+        lineas = filas.reindex(columns=header).to_csv(header=False, index=False)
+
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) not in (b"\n", b"\r"):
+                    lineas = "\n" + lineas
+
+        with open(path, "a", encoding="utf-8", newline="") as f:
+            f.write(lineas)
+            f.flush()
+            os.fsync(f.fileno())
+        return True
+
+    def sumar_filas(self, key: str, filas: pd.DataFrame, claves: list) -> bool:
+        return self.agregar_filas(key, filas)
+
+    def respaldar(self, key: str):
+        backup_file(FILES[key])
+
+    def _leer_secuencias(self) -> dict:
+        try:
+            with open(SECUENCIAS_FILE, newline="", encoding="utf-8") as f:
+                return {r["Tabla"]: int(r["Ultimo"]) for r in csv.DictReader(f) if r.get("Tabla")}
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def reservar_ids(self, key: str, n: int = 1, piso=None) -> int:
+        actual = self._leer_secuencias().get(key)
+        if n == 0 and actual is not None and piso is not None and actual >= piso:
+            return actual + 1  # nada que cambiar: sin bloqueo ni escritura
+        if actual is None and piso is None:
+            # primera vez: parte del mayor ID de la tabla (fuera del bloqueo)
+            piso = _max_id_tabla(key)
+
+        with _bloqueo_tabla("_secuencias"):
+            seqs = self._leer_secuencias()
+            previo = seqs.get(key)
+            base = max(previo or 0, int(piso or 0))
+            seqs[key] = base + n
+            if seqs[key] != previo:
+                _escribir_csv_atomico(
+                    SECUENCIAS_FILE,
+                    pd.DataFrame(sorted(seqs.items()), columns=["Tabla", "Ultimo"]),
+                )
+        return base + 1
+
+    def reiniciar_secuencias(self):
+        with _bloqueo_tabla("_secuencias"):
+            if os.path.exists(SECUENCIAS_FILE):
+                os.remove(SECUENCIAS_FILE)
+
+
+class SQLiteBackend(StorageBackend):
+    nombre = "sqlite"
+    # cada escritura es una transacción; no se copia la tabla en cada guardado
+    respaldo_por_escritura = False
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._listas = set()
+
+    def _con(self) -> sqlite3.Connection:
+        # una conexión por hilo (Streamlit atiende cada sesión en su hilo)
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.path, timeout=30)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS _versiones "
+                "(tabla TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)"
+            )
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS _secuencias "
+                "(tabla TEXT PRIMARY KEY, ultimo INTEGER NOT NULL DEFAULT 0)"
+            )
+            con.commit()
+            self._local.con = con
+        return con
+
+    def _existe(self, con, key: str) -> bool:
+        return con.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (key,)
+        ).fetchone() is not None
+
+    def _columnas(self, con, key: str) -> list:
+        return [r[1] for r in con.execute(f"PRAGMA table_info({_q(key)})")]
+
+    def _pk(self, con, key: str) -> list:
+        filas = [r for r in con.execute(f"PRAGMA table_info({_q(key)})") if r[5] > 0]
+        return [r[1] for r in sorted(filas, key=lambda r: r[5])]
+
+    def _subir_version(self, con, key: str):
+        con.execute(
+            "INSERT INTO _versiones(tabla, version) VALUES (?, 1) "
+            "ON CONFLICT(tabla) DO UPDATE SET version = version + 1",
+            (key,),
+        )
+
+    def _subir_secuencia(self, con, key: str, piso: int):
+        # nunca baja: tras importar/restaurar, el contador queda >= al mayor ID
+        con.execute(
+            "INSERT INTO _secuencias(tabla, ultimo) VALUES (?, ?) "
+            "ON CONFLICT(tabla) DO UPDATE SET ultimo = MAX(ultimo, excluded.ultimo)",
+            (key, int(piso)),
+        )
+
+    def _max_id(self, con, key: str) -> int:
+        if not self._existe(con, key) or "ID" not in self._columnas(con, key):
+            return 0
+        r = con.execute(f"SELECT MAX(CAST(ID AS INTEGER)) FROM {_q(key)}").fetchone()
+        return int(r[0] or 0)
+
+    def reservar_ids(self, key: str, n: int = 1, piso=None) -> int:
+        con = self._con()
+        if n == 0 and piso is not None:
+            r = con.execute("SELECT ultimo FROM _secuencias WHERE tabla=?", (key,)).fetchone()
+            if r is not None and r[0] >= piso:
+                return r[0] + 1
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            r = con.execute("SELECT ultimo FROM _secuencias WHERE tabla=?", (key,)).fetchone()
+            if r is None and piso is None:
+                piso = self._max_id(con, key)
+            base = max(r[0] if r else 0, int(piso or 0))
+            con.execute(
+                "INSERT INTO _secuencias(tabla, ultimo) VALUES (?, ?) "
+                "ON CONFLICT(tabla) DO UPDATE SET ultimo = excluded.ultimo",
+                (key, base + n),
+            )
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        return base + 1
+
+    def reiniciar_secuencias(self):
+        con = self._con()
+        con.execute("DELETE FROM _secuencias")
+        con.commit()
+
+    def existe(self, key: str) -> bool:
+        return self._existe(self._con(), key)
+
+    def preparar(self, key: str):
+        if key in self._listas:
+            return
+        con = self._con()
+        if not self._existe(con, key):
+            with self._lock:
+                if not self._existe(con, key):
+                    self.importar_csv(key)
+        self._listas.add(key)
+
+    def importar_csv(self, key: str):
+        """Migración desde el CSV (crea o reemplaza la tabla)."""
+        if os.path.exists(FILES[key]):
+            ensure_csv(key)
+            df = _migrar_df(key, _leer_csv(key))
+        else:
+            df = pd.DataFrame(columns=SCHEMAS.get(key, ["ID"]))
+        self.crear_tabla(key, df)
+
+    def crear_tabla(self, key: str, df: pd.DataFrame):
+        con = self._con()
+        cols = [str(c) for c in df.columns]
+        pk = PK_TABLAS.get(key, ["ID"])
+        if not _pk_valida(df, pk):
+            # datos heredados con claves vacías/duplicadas: tabla sin PK
+            pk = []
+        defs = [_q(c) + (" INTEGER" if pk == ["ID"] and c == "ID" else "") for c in cols]
+        if pk:
+            defs.append("PRIMARY KEY (" + ", ".join(_q(c) for c in pk) + ")")
+        filas = _filas_sql(df)
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            con.execute(f"DROP TABLE IF EXISTS {_q(key)}")
+            con.execute(f"CREATE TABLE {_q(key)} ({', '.join(defs)})")
+            for c in COLS_INDEXADAS:
+                if c in cols:
+                    con.execute(f"CREATE INDEX IF NOT EXISTS {_q('ix_' + key + '_' + c)} ON {_q(key)} ({_q(c)})")
+            for ix in INDICES_TABLAS.get(key, []):
+                if all(c in cols for c in ix):
+                    con.execute(
+                        f"CREATE INDEX IF NOT EXISTS {_q('ix_' + key + '_' + '_'.join(ix))} "
+                        f"ON {_q(key)} ({', '.join(_q(c) for c in ix)})"
+                    )
+            if filas:
+                con.executemany(
+                    f"INSERT INTO {_q(key)} VALUES ({', '.join('?' * len(cols))})", filas
+                )
+            self._subir_version(con, key)
+            self._subir_secuencia(con, key, self._max_id(con, key))
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+
+    def version(self, key: str):
+        try:
+            r = self._con().execute("SELECT version FROM _versiones WHERE tabla=?", (key,)).fetchone()
+            ino = os.stat(self.path).st_ino
+        except (sqlite3.Error, OSError):
+            return None
+        return (ino, r[0]) if r else None
+
+    def leer(self, key: str) -> pd.DataFrame:
+        self.preparar(key)
+        return pd.read_sql_query(f"SELECT * FROM {_q(key)}", self._con())
+
+    def escribir(self, key: str, df: pd.DataFrame):
+        self.preparar(key)
+        con = self._con()
+        cols = [str(c) for c in df.columns]
+        filas = _filas_sql(df)
+        t = _q(key)
+
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            existentes = self._columnas(con, key)
+            for c in cols:
+                if c not in existentes:
+                    con.execute(f"ALTER TABLE {t} ADD COLUMN {_q(c)}")
+
+            lista = ", ".join(_q(c) for c in cols)
+            insertar_sql = f"INSERT INTO {t} ({lista}) VALUES ({', '.join('?' * len(cols))})"
+            pk = self._pk(con, key)
+
+            if not pk or any(c not in cols for c in pk):
+                # tabla sin PK: reemplazo completo dentro de la transacción
+                con.execute(f"DELETE FROM {t}")
+                con.executemany(insertar_sql, filas)
+            else:
+                ipk = [cols.index(c) for c in pk]
+                resto = [i for i in range(len(cols)) if i not in ipk]
+                nuevos = {}
+                for f in filas:
+                    clave = tuple(f[i] for i in ipk)
+                    if any(v is None for v in clave):
+                        raise ValueError(f"clave primaria vacía en {key} ({', '.join(pk)})")
+                    if clave in nuevos:
+                        raise ValueError(f"clave primaria duplicada en {key}: {clave}")
+                    nuevos[clave] = f
+                actuales = {
+                    tuple(r[i] for i in ipk): r
+                    for r in con.execute(f"SELECT {lista} FROM {t}")
+                }
+                where = " AND ".join(f"{_q(c)} = ?" for c in pk)
+
+                borrar = [k for k in actuales if k not in nuevos]
+                altas = [f for k, f in nuevos.items() if k not in actuales]
+                cambios = [
+                    tuple(f[i] for i in resto) + k
+                    for k, f in nuevos.items()
+                    if k in actuales and tuple(actuales[k]) != f
+                ]
+                if borrar:
+                    con.executemany(f"DELETE FROM {t} WHERE {where}", borrar)
+                if cambios and resto:
+                    sets = ", ".join(f"{_q(cols[i])} = ?" for i in resto)
+                    con.executemany(f"UPDATE {t} SET {sets} WHERE {where}", cambios)
+                if altas:
+                    con.executemany(insertar_sql, altas)
+
+            self._subir_version(con, key)
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+
+    def agregar(self, key: str, fila: dict) -> bool:
+        self.preparar(key)
+        con = self._con()
+        cols = [str(c) for c in fila]
+        valores = tuple(_valor_sql(v) for v in fila.values())
+        t = _q(key)
+
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            existentes = self._columnas(con, key)
+            for c in cols:
+                if c not in existentes:
+                    con.execute(f"ALTER TABLE {t} ADD COLUMN {_q(c)}")
+            con.execute(
+                f"INSERT INTO {t} ({', '.join(_q(c) for c in cols)}) VALUES ({', '.join('?' * len(cols))})",
+                valores,
+            )
+            self._subir_version(con, key)
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        return True
+
+    def agregar_filas(self, key: str, filas: pd.DataFrame) -> bool:
+        self.preparar(key)
+        con = self._con()
+        cols = [str(c) for c in filas.columns]
+        t = _q(key)
+
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            existentes = self._columnas(con, key)
+            for c in cols:
+                if c not in existentes:
+                    con.execute(f"ALTER TABLE {t} ADD COLUMN {_q(c)}")
+            con.executemany(
+                f"INSERT INTO {t} ({', '.join(_q(c) for c in cols)}) VALUES ({', '.join('?' * len(cols))})",
+                _filas_sql(filas),
+            )
+            self._subir_version(con, key)
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        return True
+
+    def sumar_filas(self, key: str, filas: pd.DataFrame, claves: list) -> bool:
+        self.preparar(key)
+        con = self._con()
+        cols = [str(c) for c in filas.columns]
+        montos = [c for c in cols if c not in claves]
+        t = _q(key)
+        # sin PK en las claves (tabla heredada con repetidas) no hay fila única que sumar
+        if self._pk(con, key) != list(claves) or any(c not in self._columnas(con, key) for c in cols):
+            return False
+        ik = [cols.index(c) for c in claves]
+        im = [cols.index(c) for c in montos]
+        where = " AND ".join(f"{_q(c)} = ?" for c in claves)
+        sumar_sql = f"UPDATE {t} SET " + ", ".join(f"{_q(c)} = COALESCE({_q(c)}, 0) + ?" for c in montos) + f" WHERE {where}"
+        insertar_sql = f"INSERT INTO {t} ({', '.join(_q(c) for c in cols)}) VALUES ({', '.join('?' * len(cols))})"
+        ceros_sql = f"DELETE FROM {t} WHERE {where} AND " + " AND ".join(
+            f"ABS(COALESCE({_q(c)}, 0)) <= 1e-9" for c in montos
+        )
+
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            for f in _filas_sql(filas):
+                clave = tuple(f[i] for i in ik)
+                if con.execute(sumar_sql, tuple(f[i] for i in im) + clave).rowcount == 0:
+                    con.execute(insertar_sql, f)
+                if montos:
+                    con.execute(ceros_sql, clave)
+            self._subir_version(con, key)
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        return True
+
+    def respaldar(self, key: str):
+        if not self.existe(key):
+            return
+        try:
+            data = self.leer(key).to_csv(index=False).encode("utf-8")
+            almacen_respaldos().respaldar_bytes(key, FILES[key], data, motivo="sqlite")
+        except Exception:
+            pass
+
+
+_BACKEND_CSV = CSVBackend()
+
+
+@st.cache_resource
+def _backend_sqlite(path: str) -> SQLiteBackend:
+    return SQLiteBackend(path)
+
+
+def storage() -> StorageBackend:
+    if STORAGE_BACKEND == "sqlite":
+        return _backend_sqlite(SQLITE_DB)
+    return _BACKEND_CSV
+
+
+# ==========================================================
+# SNAPSHOT COLUMNAR (Feather / Arrow IPC) JUNTO A CADA CSV
+# - .columnar/<tabla>.feather guarda la tabla YA migrada y tipada
+# - Vale mientras la firma del CSV (mtime/size/inode) y el schema coincidan;
+#   si no, se regenera en la siguiente lectura completa
+# - Permite leer solo algunas columnas (load_df(key, columns=[...]))
+# - Sin pyarrow (o con columnas mixtas que Arrow no acepta) se lee el CSV
+# ==========================================================
+def _sidecar_path(key: str) -> str:
+    return os.path.join(COLUMNAR_DIR, f"{key}.feather")
+
+
+def _sidecar_firma(key: str, ver) -> bytes:
+    return repr((ver, _version_schema(key))).encode("utf-8")
+
+
+def _leer_sidecar(key: str, ver, columns=None):
+    if pa_feather is None or ver is None:
+        return None
+    path = _sidecar_path(key)
+    try:
+        # el esquema (pie del archivo) dice si el sidecar está al día y qué
+        # columnas tiene, sin leer datos
+        with pa.memory_map(path) as f:
+            esquema = pa.ipc.open_file(f).schema
+        if (esquema.metadata or {}).get(b"firma_csv") != _sidecar_firma(key, ver):
+            return None
+        tabla = pa_feather.read_table(
+            path, columns=None if columns is None else [c for c in columns if c in esquema.names], memory_map=True,
+        )
+    except Exception:
+        return None
+    return tabla.to_pandas()
+
+
+def _escribir_sidecar(key: str, ver, df: pd.DataFrame):
+    if pa is None or ver is None:
+        return
+    path = _sidecar_path(key)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        tabla = pa.Table.from_pandas(df, preserve_index=False)
+        meta = dict(tabla.schema.metadata or {})
+        meta[b"firma_csv"] = _sidecar_firma(key, ver)
+        pa_feather.write_feather(tabla.replace_schema_metadata(meta), tmp)
+        os.replace(tmp, path)
+    except Exception:
+        # columnas mixtas u otro problema: se sigue leyendo el CSV
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def _proyectar(df: pd.DataFrame, columns) -> pd.DataFrame:
+    if columns is None:
+        return df
+    out = df[[c for c in columns if c in df.columns]]
+    out.attrs["_proyeccion"] = tuple(out.columns)
+    return out
+
+
+def load_df(key: str, columns=None) -> pd.DataFrame:
+    """
+    Tabla completa (o solo `columns`) desde la caché del proceso.
+    Una tabla proyectada NO se puede pasar a save_df.
+    """
+    be = storage()
+    cache = _cache_tablas()
+    ver = be.version(key)
+    ent = cache["datos"].get(key)
+    if ver is not None and ent is not None and ent[0] == (be.nombre, ver, _version_schema(key)):
+        return _proyectar(_marcar_version(_vista_df(ent[1]), ver), columns)
+
+    # Asegura que la tabla exista y sea legible
+    be.preparar(key)
+    ver_antes = be.version(key)
+    usa_sidecar = be.nombre == "csv"
+
+    if usa_sidecar and columns is not None:
+        # lectura en frío de pocas columnas: no se materializa el resto
+        parcial = _leer_sidecar(key, ver_antes, columns)
+        if parcial is not None and be.version(key) == ver_antes:
+            return _proyectar(_marcar_version(parcial, ver_antes), columns)
+
+    df = _leer_sidecar(key, ver_antes) if usa_sidecar else None
+    desde_sidecar = df is not None
+    if df is None:
+        df = _tipar_df(key, _migrar_df(key, be.leer(key)))
+        # tabla editada fuera de la app: que la secuencia no entregue IDs usados
+        _sincronizar_secuencia(key, df)
+    ver_despues = be.version(key)
+
+    # Solo se cachea si la tabla no cambió mientras se leía
+    if ver_antes is not None and ver_antes == ver_despues:
+        with cache["lock"]:
+            cache["datos"][key] = ((be.nombre, ver_antes, _version_schema(key)), df)
+        if usa_sidecar and not desde_sidecar:
+            _escribir_sidecar(key, ver_antes, df)
+    # si cambió durante la lectura, sin versión: save_df no podrá verificarla
+    return _proyectar(_marcar_version(_vista_df(df), ver_antes if ver_antes == ver_despues else ("?",)), columns)
+
+
+def _leer_csv(key: str) -> pd.DataFrame:
     try:
         df = pd.read_csv(FILES[key])
     except pd.errors.EmptyDataError:
@@ -379,8 +1381,10 @@ def load_df(key: str) -> pd.DataFrame:
         except Exception:
             df = pd.DataFrame()
 
-    df = drop_unnamed(df)
+    return drop_unnamed(df)
 
+
+def _migrar_df(key: str, df: pd.DataFrame) -> pd.DataFrame:
     # ==========================
     # MIGRACIONES SUAVES
     # ==========================
@@ -420,12 +1424,95 @@ def load_df(key: str) -> pd.DataFrame:
     return df
 
 
-def save_df(key: str, df: pd.DataFrame):
-    path = FILES[key]
-    try:
-        backup_file(path)
-    except Exception:
-        pass
+def _a_texto(s: pd.Series) -> pd.Series:
+    # números enteros sin ".0" (DNI, AbogadoID, expedientes numéricos)
+    if pd.api.types.is_float_dtype(s.dtype):
+        ent = s.notna() & (s % 1 == 0)
+        txt = s.astype(str)
+        txt[ent] = s[ent].astype("int64").astype(str)
+        return txt.where(s.notna())
+    if pd.api.types.is_string_dtype(s.dtype) and not pd.api.types.is_object_dtype(s.dtype):
+        return s
+    return s.astype(str).where(s.notna())
+
+
+def _tipar_df(key: str, df: pd.DataFrame) -> pd.DataFrame:
+    if df is None or (df.empty and len(df.columns) == 0):
+        return df
+    tipos = SCHEMA_TIPOS.get(key, {})
+    for c in SCHEMAS.get(key, []):
+        if c == "ID" or c not in df.columns:
+            continue
+        s = df[c]
+        t = tipos.get(c, "texto")
+        if t == "dinero":
+            df[c] = pd.to_numeric(s, errors="coerce").fillna(0.0).astype("float64")
+        elif t == "entero":
+            df[c] = pd.to_numeric(s, errors="coerce").fillna(0).round().astype("int64")
+        elif t == "fecha":
+            if pd.api.types.is_datetime64_any_dtype(s.dtype):
+                continue
+            txt = _a_texto(s)
+            vacio = txt.isna() | (txt.str.strip() == "")
+            f = pd.to_datetime(txt.where(~vacio), errors="coerce", format="mixed")
+            df[c] = f if not (f.isna() & ~vacio).any() else txt
+        elif t == "categoria":
+            txt = _a_texto(s)
+            txt = txt.where(txt.str.strip() != "")
+            conocidas = CATEGORIAS_CONOCIDAS.get((key, c), [])
+            cats = sorted(set(conocidas) | set(txt.dropna().unique()))
+            df[c] = pd.Categorical(txt, categories=cats)
+        else:
+            df[c] = _a_texto(s)
+    return df
+
+
+def _alcance_sesion(key: str):
+    """(columna, expedientes) si la sesión es de un usuario restringido y `key` es ligada a caso."""
+    if st.session_state.get("perfil") is None or key not in TABLAS_POR_USUARIO:
+        return None
+    expedientes = perfil_sesion().expedientes
+    return None if expedientes is None else (COL_CASO.get(key, "Caso"), expedientes)
+
+
+def _fusionar_alcance(key: str, df: pd.DataFrame, alcance) -> pd.DataFrame:
+    """
+    Frame acotado (tables_for) -> tabla completa: las filas de casos fuera del
+    alcance se toman de la versión vigente tal cual; las del alcance son las de df.
+    Una fila de df fuera del alcance que ya existe en la tabla no se toca (manda
+    la vigente); las filas nuevas se agregan. Llamar con el bloqueo de la tabla tomado.
+    """
+    col, expedientes = alcance
+    actual = load_df(key)
+    if actual is None or actual.empty or col not in actual.columns:
+        return df
+    fuera = actual[~finanzas.normalizar_caso(actual[col]).isin(expedientes)]
+    pk = PK_TABLAS.get(key, ["ID"])
+    if col in df.columns and all(c in df.columns for c in pk):
+        ajenas = ~finanzas.normalizar_caso(df[col]).isin(expedientes)
+        existentes = pd.MultiIndex.from_arrays([_id_texto(fuera[c]) for c in pk])
+        ajenas &= pd.MultiIndex.from_arrays([_id_texto(df[c]) for c in pk]).isin(existentes)
+        df = df[~ajenas]
+    out = pd.concat([fuera, df], ignore_index=True)
+    if "ID" in out.columns:
+        # mismo orden que tenía la tabla (los IDs crecen al agregar)
+        orden = pd.to_numeric(out["ID"], errors="coerce")
+        out = out.loc[orden.sort_values(kind="stable").index].reset_index(drop=True)
+    return out
+
+
+def save_df(key: str, df: pd.DataFrame, reemplazar: bool = False):
+    """
+    Guarda la tabla completa. df debe venir de load_df (attrs["_version"]);
+    reemplazar=True solo para tablas armadas completas con el bloqueo de
+    `key` tomado (no hay versión que comparar).
+    """
+    be = storage()
+    original = df
+    if df is not None and df.attrs.get("_proyeccion") is not None:
+        # guardar solo algunas columnas borraría las demás
+        st.error(f"❌ No se pudo guardar '{key}': la tabla se cargó con columnas parciales")
+        st.stop()
 
     df = drop_unnamed(df)
 
@@ -434,24 +1521,92 @@ def save_df(key: str, df: pd.DataFrame):
         if c not in df.columns:
             df[c] = ""
 
-    df.to_csv(path, index=False)
+    # usuario restringido: nunca se escribe solo su parte de la tabla, aunque
+    # el frame haya perdido attrs (concat / merge / DataFrame nuevo)
+    alcance = _alcance_sesion(key) or (original.attrs.get("_alcance") if original is not None else None)
+    try:
+        with _bloqueo_tabla(key):
+            if not reemplazar:
+                _verificar_version(key, original)
+            if alcance is not None:
+                df = _fusionar_alcance(key, df, alcance)
+            if be.respaldo_por_escritura:
+                try:
+                    be.respaldar(key)
+                except Exception:
+                    pass
+            ver_antes = be.version(key)
+            antes = load_df(key) if _derivadas_de(key) else None
+            be.escribir(key, df)
+            ver = be.version(key)
+            _marcar_version(original, ver)
+            _sincronizar_secuencia(key, df)
+            if antes is not None:
+                _actualizar_derivadas(key, ver_antes, ver, antes, df)
+    except ConflictoDeVersion as e:
+        invalidar_cache(key)
+        if "sin versión" in e.args:
+            st.error(f"⚠️ No se pudo comprobar qué versión de '{key}' se editó. No se guardó nada: recarga y vuelve a intentar.")
+        else:
+            st.error(f"⚠️ Otra sesión modificó '{key}' mientras se editaba. No se guardó nada: recarga y vuelve a intentar.")
+        st.stop()
+    except (ValueError, sqlite3.IntegrityError) as e:
+        invalidar_cache(key)
+        st.error(f"❌ No se pudo guardar '{key}': {e}")
+        st.stop()
+    invalidar_cache(key)
+
+
+# ==========================================================
+# SECUENCIAS DE ID
+# - Un contador por tabla (secuencias.csv o _secuencias en SQLite),
+#   avanzado bajo bloqueo: dos sesiones nunca reciben el mismo ID
+# - next_id(df, tabla=...) no recorre la columna ID
+# - Las escrituras completas / importaciones suben el contador si la tabla
+#   trae IDs mayores (nunca lo bajan)
+# ==========================================================
+def _max_id_tabla(key: str) -> int:
+    df = load_df(key, columns=["ID"])
+    if df is None or df.empty or "ID" not in df.columns:
+        return 0
+    m = pd.to_numeric(df["ID"], errors="coerce").max()
+    return int(m) if pd.notna(m) else 0
 
 
-def next_id(df: pd.DataFrame, col="ID") -> int:
+def _sincronizar_secuencia(key: str, df: pd.DataFrame):
+    if PK_TABLAS.get(key, ["ID"]) != ["ID"] or df is None or "ID" not in df.columns:
+        return
+    m = pd.to_numeric(df["ID"], errors="coerce").max()
+    if pd.notna(m):
+        try:
+            storage().reservar_ids(key, 0, piso=int(m))
+        except Exception:
+            pass
+
+
+def next_id(df: pd.DataFrame, col="ID", tabla=None) -> int:
+    if tabla is not None:
+        return storage().reservar_ids(tabla, 1)
     if df is None or df.empty:
         return 1
     m = pd.to_numeric(df.get(col, pd.Series(dtype="float")), errors="coerce").max()
     return int(m) + 1 if pd.notna(m) else len(df) + 1
 
 
-def ensure_ids(df: pd.DataFrame) -> pd.DataFrame:
+def ensure_ids(df: pd.DataFrame, tabla=None) -> pd.DataFrame:
     if df is None or df.empty:
         return df
     if "ID" not in df.columns:
         return df
     ids = pd.to_numeric(df["ID"], errors="coerce")
+    faltan = df[ids.isna()].index.tolist()
+    if not faltan:
+        return df
     max_id = int(ids.max()) if pd.notna(ids.max()) else 0
-    for idx in df[ids.isna()].index.tolist():
+    if tabla is not None:
+        # bloque de IDs de la secuencia (por encima de los que ya tiene df)
+        max_id = storage().reservar_ids(tabla, len(faltan), piso=max_id) - 1
+    for idx in faltan:
         max_id += 1
         df.at[idx, "ID"] = max_id
     return df
@@ -459,15 +1614,380 @@ def ensure_ids(df: pd.DataFrame) -> pd.DataFrame:
 
 def add_row(df: pd.DataFrame, row_dict: dict, schema_key: str) -> pd.DataFrame:
     df2 = pd.concat([df, pd.DataFrame([row_dict])], ignore_index=True)
+    df2.attrs = dict(df.attrs)  # conserva la versión leída (save_df la verifica)
 
     # Asegurar columnas del schema sin recortar otras
     for c in SCHEMAS.get(schema_key, []):
         if c not in df2.columns:
             df2[c] = ""
 
+    return _tipar_df(schema_key, df2)
+
+
+def asignar_fila(df: pd.DataFrame, idx, valores: dict) -> pd.DataFrame:
+    """
+    Asigna valores a UNA fila convirtiéndolos al tipo de cada columna
+    (pandas ya no convierte solo: texto en una columna fecha/numérica falla).
+    """
+    for col, v in valores.items():
+        if col not in df.columns:
+            df[col] = pd.Series(pd.NA, index=df.index, dtype="object")
+        dt = df[col].dtype
+        vacio = v is None or (isinstance(v, str) and v.strip() == "") or (not isinstance(v, str) and pd.isna(v))
+        if isinstance(dt, pd.CategoricalDtype):
+            if vacio:
+                v = None
+            elif v not in dt.categories:
+                df[col] = df[col].cat.add_categories([v])
+        elif pd.api.types.is_datetime64_any_dtype(dt):
+            v = pd.NaT if vacio else pd.to_datetime(v, errors="coerce", format="mixed")
+        elif pd.api.types.is_bool_dtype(dt):
+            df[col] = df[col].astype("object")
+        elif pd.api.types.is_numeric_dtype(dt):
+            num = float("nan") if vacio else pd.to_numeric(v, errors="coerce")
+            if pd.isna(num):
+                if pd.api.types.is_integer_dtype(dt):
+                    df[col] = df[col].astype("float64")
+                v = float("nan")
+            else:
+                v = num
+                if pd.api.types.is_integer_dtype(dt) and float(num) % 1 != 0:
+                    df[col] = df[col].astype("float64")
+        elif pd.api.types.is_string_dtype(dt) and not pd.api.types.is_object_dtype(dt):
+            v = float("nan") if v is None or (not isinstance(v, str) and pd.isna(v)) else str(v)
+        df.at[idx, col] = v
+    return df
+
+
+def _cache_agregar_fila(key: str, ver_antes, ver_despues, fila: dict):
+    """
+    Suma la fila a la tabla en caché sin releer. Solo si la caché
+    correspondía exactamente a la versión previa a la escritura.
+    """
+    be = storage()
+    cache = _cache_tablas()
+    with cache["lock"]:
+        ent = cache["datos"].get(key)
+        esperado = (be.nombre, ver_antes, _version_schema(key))
+        if ver_antes is None or ver_despues is None or ent is None or ent[0] != esperado:
+            cache["datos"].pop(key, None)
+            return
+        # "" se relee como NaN; infer_objects deja los tipos como en una relectura
+        nueva = pd.DataFrame([{c: (float("nan") if isinstance(v, str) and v == "" else v) for c, v in fila.items()}])
+        df = _tipar_df(key, pd.concat([ent[1], nueva], ignore_index=True).infer_objects())
+        cache["datos"][key] = ((be.nombre, ver_despues, _version_schema(key)), df)
+
+
+def append_row(key: str, df: pd.DataFrame, row_dict: dict) -> pd.DataFrame:
+    """
+    Alta de UNA fila: escribe solo esa fila (CSV en modo append + fsync,
+    SQLite con un INSERT) y actualiza la caché en memoria.
+    Devuelve la tabla con la fila agregada, igual que add_row.
+    Si la fila trae columnas que la tabla aún no tiene, guarda completo.
+    """
+    df2 = add_row(df, row_dict, key)
+    be = storage()
+    be.preparar(key)
+    pk = PK_TABLAS.get(key, ["ID"])
+    try:
+        with _bloqueo_tabla(key):
+            ver_antes = be.version(key)
+            al_dia = df.attrs.get("_version") == (be.nombre, ver_antes)
+            if not al_dia and all(c in row_dict for c in pk):
+                # otra sesión agregó filas: solo es conflicto si la clave ya existe
+                actual = load_df(key)
+                if all(c in actual.columns for c in pk):
+                    clave = tuple(_valor_sql(row_dict[c]) for c in pk)
+                    if clave in set(_filas_sql(actual[pk])):
+                        raise ConflictoDeVersion(key)
+            ok = be.agregar(key, row_dict)
+            if not ok:
+                if not al_dia:
+                    raise ConflictoDeVersion(key)
+                if df.attrs.get("_proyeccion") is not None:
+                    # df trae solo algunas columnas: se guarda la tabla completa
+                    save_df(key, add_row(load_df(key), row_dict, key))
+                else:
+                    save_df(key, df2)
+                return df2
+            ver_despues = be.version(key)
+            _actualizar_derivadas(key, ver_antes, ver_despues, None, pd.DataFrame([row_dict]))
+    except ConflictoDeVersion:
+        invalidar_cache(key)
+        st.error(f"⚠️ Otra sesión modificó '{key}' mientras se editaba. No se guardó nada: recarga y vuelve a intentar.")
+        st.stop()
+    except (ValueError, sqlite3.IntegrityError) as e:
+        invalidar_cache(key)
+        st.error(f"❌ No se pudo guardar '{key}': {e}")
+        st.stop()
+
+    _cache_agregar_fila(key, ver_antes, ver_despues, row_dict)
+    if al_dia:
+        _marcar_version(df2, ver_despues)
     return df2
 
 
+# ==========================================================
+# TABLAS DERIVADAS (se mantienen solas)
+# - saldos_por_caso: por caso, lo que aporta cada tabla fuente (pactado,
+#   pagos, cuota litis, gastos)
+# - cubo_reportes: caso × abogado × mes × concepto para Reportes
+# - libro_diario: asientos de partida doble; no se reemplaza, se le agregan
+#   las altas / correcciones / anulaciones (y la conciliación al reconstruir)
+# - asignaciones_caso: quién lleva cada caso (principal / conjunto /
+#   delegado) con Desde / Hasta; lo quitado en casos se cierra, no se borra
+# - save_df / append_row les aplican la diferencia de la tabla escrita
+#   dentro del mismo bloqueo, sin recalcular las demás claves: solo se
+#   escriben las claves tocadas (SQLite: UPDATE / INSERT por clave; CSV:
+#   filas de diferencia al final, que se suman al leer y se compactan cada
+#   tanto)
+# - <tabla>_fuentes.csv sella la versión de cada fuente que ya está sumada.
+#   Si una fuente cambió por otro camino (restauración, CSV editado a mano,
+#   importación, corte a mitad de escritura) el sello no coincide y la
+#   tabla se reconstruye completa en la siguiente lectura
+# - verificar_derivada() la compara con una reconstrucción desde cero
+# - Un cambio del cubo que cae en un mes cerrado queda en cierres_alertas
+#   (ver CIERRES MENSUALES)
+# ==========================================================
+TABLA_SALDOS = "saldos_por_caso"
+TABLA_CUBO = "cubo_reportes"
+TABLA_LIBRO = "libro_diario"
+TABLA_ASIGNACIONES = "asignaciones_caso"
+TABLAS_DERIVADAS = {
+    TABLA_SALDOS: finanzas.SALDOS,
+    TABLA_CUBO: finanzas.CUBO,
+    TABLA_LIBRO: finanzas.LIBRO,
+    TABLA_ASIGNACIONES: asignaciones.ASIGNACIONES,
+}
+SELLOS_DERIVADAS = {
+    TABLA_SALDOS: os.path.join(DATA_DIR, "saldos_fuentes.csv"),
+    TABLA_CUBO: os.path.join(DATA_DIR, "cubo_fuentes.csv"),
+    TABLA_LIBRO: os.path.join(DATA_DIR, "libro_fuentes.csv"),
+    TABLA_ASIGNACIONES: os.path.join(DATA_DIR, "asignaciones_fuentes.csv"),
+}
+# en el sello: filas de diferencia agregadas desde la última reescritura (CSV)
+SELLO_AGREGADAS = "_agregadas"
+# en el sello: versión de la definición (`version` de la derivada, 1 si no
+# tiene); si cambió, la tabla se reconstruye / concilia en la siguiente lectura
+SELLO_DEFINICION = "_definicion"
+COMPACTAR_DERIVADA_CADA = int(st.secrets.get("COMPACTAR_DERIVADA_CADA", 2000))
+
+
+def _sello_version(key: str, ver=None) -> str:
+    be = storage()
+    return repr((be.nombre, be.version(key) if ver is None else ver))
+
+
+def _leer_sello(tabla: str) -> dict:
+    try:
+        with open(SELLOS_DERIVADAS[tabla], newline="", encoding="utf-8") as f:
+            return {r["Tabla"]: r["Version"] for r in csv.DictReader(f) if r.get("Tabla")}
+    except (OSError, KeyError):
+        return {}
+
+
+def _escribir_sello(tabla: str, sello: dict):
+    _escribir_csv_atomico(
+        SELLOS_DERIVADAS[tabla],
+        pd.DataFrame(sorted(sello.items()), columns=["Tabla", "Version"]),
+    )
+
+
+def _sello_definicion(tabla: str) -> str:
+    return str(getattr(TABLAS_DERIVADAS[tabla], "version", 1))
+
+
+def derivada_al_dia(tabla: str, sello: dict = None) -> bool:
+    sello = _leer_sello(tabla) if sello is None else sello
+    if sello.get(SELLO_DEFINICION, "1") != _sello_definicion(tabla):
+        return False
+    return all(
+        sello.get(k) is not None and sello.get(k) == _sello_version(k)
+        for k in TABLAS_DERIVADAS[tabla].fuentes + [tabla]
+    )
+
+
+def _escribir_derivada(tabla: str, df: pd.DataFrame, sello: dict):
+    """Llamar con el bloqueo de `tabla` tomado."""
+    be = storage()
+    be.preparar(tabla)
+    be.escribir(tabla, df)
+    invalidar_cache(tabla)
+    sello[tabla] = _sello_version(tabla)
+    sello.pop(SELLO_AGREGADAS, None)
+    _escribir_sello(tabla, sello)
+
+
+def _reservar_ids(tabla: str):
+    """reservar(n, piso) para las derivadas con ID propio (misma secuencia que next_id)."""
+    return lambda n, piso: storage().reservar_ids(tabla, n, piso=piso)
+
+
+def _sumar_derivada(tabla: str, delta: pd.DataFrame, sello: dict):
+    """
+    Suma `delta` solo en las claves que toca (sin reescribir la tabla).
+    En CSV la diferencia queda como filas al final; cada
+    COMPACTAR_DERIVADA_CADA filas agregadas se reescribe con una fila por
+    clave. Llamar con el bloqueo de `tabla` tomado.
+    """
+    be = storage()
+    be.preparar(tabla)
+    d = TABLAS_DERIVADAS[tabla]
+    if d.con_historial:
+        # asignaciones_caso no suma: abre / cierra filas con historial
+        _escribir_derivada(tabla, d.aplicar(load_df(tabla), delta, reservar=_reservar_ids(tabla)), sello)
+        return
+    if not be.sumar_filas(tabla, d.filas_delta(delta), d.claves):
+        _escribir_derivada(tabla, d.aplicar(load_df(tabla), delta), sello)
+        return
+    invalidar_cache(tabla)
+    sello[tabla] = _sello_version(tabla)
+    if be.acumula_repetidas:
+        agregadas = int(sello.get(SELLO_AGREGADAS) or 0) + len(delta)
+        if agregadas >= COMPACTAR_DERIVADA_CADA:
+            _escribir_derivada(tabla, d.compactar(load_df(tabla)), sello)
+            return
+        sello[SELLO_AGREGADAS] = str(agregadas)
+    _escribir_sello(tabla, sello)
+
+
+def _asentar(tabla: str, movs: pd.DataFrame, sello: dict):
+    """Agrega los asientos de `movs` al libro. Llamar con el bloqueo de `tabla` tomado."""
+    be = storage()
+    be.preparar(tabla)
+    if not movs.empty:
+        lineas = TABLAS_DERIVADAS[tabla].asientos(
+            movs, load_df_reparado("casos", persistir=False),
+            be.reservar_ids(tabla, 2 * len(movs)), datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        )
+        if not be.agregar_filas(tabla, lineas):
+            be.escribir(tabla, pd.concat([load_df(tabla), lineas], ignore_index=True))
+        invalidar_cache(tabla)
+    sello[tabla] = _sello_version(tabla)
+    _escribir_sello(tabla, sello)
+
+
+def reconstruir_derivada(tabla: str) -> pd.DataFrame:
+    """Recalcula la tabla desde sus fuentes y la reemplaza (el libro: asienta lo que falte)."""
+    be = storage()
+    d = TABLAS_DERIVADAS[tabla]
+    with _bloqueo_tabla(tabla):
+        tablas, sello = {}, {}
+        for k in d.fuentes:
+            ver = be.version(k)
+            tablas[k] = load_df(k)
+            # si la fuente cambió mientras se leía, queda sin sello (se reconstruye otra vez)
+            sello[k] = _sello_version(k, ver) if ver is not None and be.version(k) == ver else None
+        sello = {k: v for k, v in sello.items() if v is not None}
+        sello[SELLO_DEFINICION] = _sello_definicion(tabla)
+        if d.solo_agregar:
+            _asentar(tabla, d.pendientes(load_df(tabla), d.desde_tablas(tablas)), sello)
+            return load_df(tabla)
+        df = d.desde_tablas(tablas)
+        if d.con_historial:
+            # se concilia lo vigente: el historial (Hasta) no se pierde
+            df = d.conciliar(load_df(tabla), df, reservar=_reservar_ids(tabla))
+        _escribir_derivada(tabla, df, sello)
+    return df
+
+
+def _derivadas_de(key: str) -> list:
+    return [t for t, d in TABLAS_DERIVADAS.items() if key in d.fuentes]
+
+
+def _actualizar_derivadas(key: str, ver_antes, ver_despues, antes, despues: pd.DataFrame):
+    """
+    Suma a cada tabla derivada el cambio que acaba de escribirse en `key`
+    (antes=None: `despues` son filas nuevas). Llamar con el bloqueo de `key`
+    tomado, justo después de escribir.
+    """
+    for tabla in _derivadas_de(key):
+        alertar = None
+        try:
+            with _bloqueo_tabla(tabla):
+                sello = _leer_sello(tabla)
+                if not derivada_al_dia(tabla, {**sello, key: _sello_version(key)}) \
+                        or sello.get(key) != _sello_version(key, ver_antes):
+                    # la tabla no reflejaba la versión previa: mejor rehacerla
+                    reconstruir_derivada(tabla)
+                    continue
+                d = TABLAS_DERIVADAS[tabla]
+                delta = d.delta(key, antes, despues)
+                sello[key] = _sello_version(key, ver_despues)
+                if delta.empty:
+                    _escribir_sello(tabla, sello)
+                    continue
+                if d.solo_agregar:
+                    _asentar(tabla, delta, sello)
+                    continue
+                _sumar_derivada(tabla, delta, sello)
+                if tabla == TABLA_CUBO:
+                    alertar = delta
+            # fuera del bloqueo del cubo: las alertas tienen su propia tabla
+            if alertar is not None:
+                _alertar_cierres(key, alertar)
+        except Exception:
+            # la escritura de la fuente ya se hizo: el sello viejo fuerza reconstruir al leer
+            pass
+
+
+def meses_cerrados() -> list:
+    df = load_df("cierres", columns=["Mes"])
+    if df is None or df.empty or "Mes" not in df.columns:
+        return []
+    return sorted(m for m in df["Mes"].dropna().astype(str).unique() if m)
+
+
+def _alertar_cierres(key: str, delta: pd.DataFrame):
+    """Registra en cierres_alertas los cambios de `key` que caen en meses cerrados."""
+    cerrados = meses_cerrados()
+    if not cerrados:
+        return
+    tocados = delta[delta.index.get_level_values("Mes").isin(cerrados)]
+    if tocados.empty:
+        return
+    tocados = tocados.groupby(level=["Mes", "Caso"]).sum()
+    be = storage()
+    be.preparar("cierres_alertas")
+    primero = be.reservar_ids("cierres_alertas", len(tocados))
+    filas = pd.DataFrame({
+        "ID": range(primero, primero + len(tocados)),
+        "Fecha": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "Mes": tocados.index.get_level_values("Mes"),
+        "Caso": tocados.index.get_level_values("Caso"),
+        "Tabla": key,
+        "Usuario": st.session_state.get("usuario", ""),
+        "Detalle": [
+            ", ".join(f"{c} {v:+,.2f}" for c, v in fila.items() if abs(v) > 1e-9)
+            for _, fila in tocados.iterrows()
+        ],
+    })
+    # todas las alertas de este cambio en UNA escritura
+    with _bloqueo_tabla("cierres_alertas"):
+        if not be.agregar_filas("cierres_alertas", filas):
+            be.escribir("cierres_alertas", pd.concat([load_df("cierres_alertas"), filas], ignore_index=True))
+    invalidar_cache("cierres_alertas")
+
+
+def leer_derivada(tabla: str) -> pd.DataFrame:
+    """Tabla derivada al día (la reconstruye si el sello no coincide)."""
+    if not derivada_al_dia(tabla):
+        with _bloqueo_tabla(tabla):
+            if not derivada_al_dia(tabla):
+                return _marcar_version(reconstruir_derivada(tabla), storage().version(tabla))
+    return load_df(tabla)
+
+
+def verificar_derivada(tabla: str) -> pd.DataFrame:
+    """Diferencias (clave, columna) entre la tabla guardada y una reconstrucción desde cero."""
+    d = TABLAS_DERIVADAS[tabla]
+    return d.diferencias(load_df(tabla), d.desde_tablas({k: load_df(k) for k in d.fuentes}))
+
+
+def saldos_por_caso() -> pd.DataFrame:
+    return leer_derivada(TABLA_SALDOS)
+
+
 def brand_header():
     st.markdown(
         f"""
@@ -499,34 +2019,99 @@ def _usuario_actual():
         or ""
     ).strip()
 
+# ----------------------------------------------------------
+# Índice de acceso: asignaciones_caso (ver TABLAS DERIVADAS) indexada por
+# caso y por persona UNA vez por versión. Se comparan nombres / usuarios
+# completos (sin mayúsculas ni espacios de más): "Ana" no ve los casos de
+# "Ana María".
+# ----------------------------------------------------------
+@st.cache_resource
+def _cache_acceso() -> dict:
+    return {"datos": {}, "lock": threading.Lock()}
+
+
+def _id_texto(s: pd.Series) -> pd.Series:
+    # "2", 2, 2.0 y "2.0" son el mismo ID
+    n = pd.to_numeric(s, errors="coerce")
+    texto = s.astype(object).where(s.notna(), "").astype(str).str.strip()
+    return n.round().astype("Int64").astype(str).where(n.notna() & (n == n.round()), texto)
+
+
+def _memo_acceso(nombre: str, keys, construir):
+    cache = _cache_acceso()
+    firma = _firma_tablas(keys)
+    ent = cache["datos"].get(nombre)
+    if ent is not None and ent[0] == firma:
+        return ent[1]
+    valor = construir()
+    if all(v[0] is not None for v in firma[1:]) and firma == _firma_tablas(keys):
+        with cache["lock"]:
+            cache["datos"][nombre] = (firma, valor)
+    return valor
+
+
+def _indice_asignaciones() -> dict:
+    """Asignaciones por caso (con historial) y casos vigentes por (Rol, persona)."""
+    return _memo_acceso(
+        TABLA_ASIGNACIONES, [TABLA_ASIGNACIONES, "casos"],
+        lambda: asignaciones.indexar(leer_derivada(TABLA_ASIGNACIONES)),
+    )
+
+
+def carga_de_trabajo() -> pd.DataFrame:
+    """Casos vigentes por persona y rol (Principal / Conjunto / Delegado)."""
+    return _memo_acceso(
+        "carga", [TABLA_ASIGNACIONES, "casos"],
+        lambda: asignaciones.carga_por_persona(leer_derivada(TABLA_ASIGNACIONES), load_df("casos")),
+    )
+
+
+def _abogados_por_usuario() -> dict:
+    """usuario -> nombre del abogado (usuarios.AbogadoID -> abogados.ID)"""
+    def construir():
+        df_u, df_a = load_df("usuarios"), load_df("abogados")
+        if df_u.empty or df_a.empty or not {"Usuario", "AbogadoID"} <= set(df_u.columns) \
+                or not {"ID", "Nombre"} <= set(df_a.columns):
+            return {}
+        ids = _id_texto(df_a["ID"])
+        nombres = pd.Series(df_a["Nombre"].astype(str).str.strip().values, index=ids.values)
+        nombres = nombres[~nombres.index.duplicated()]
+        u = df_u[~df_u["Usuario"].astype(str).duplicated()]
+        return dict(zip(u["Usuario"].astype(str), _id_texto(u["AbogadoID"]).map(nombres).fillna("")))
+    return _memo_acceso("usuarios", ["usuarios", "abogados"], construir)
+
+
 def _nombre_abogado_del_usuario():
     """
     Devuelve el NOMBRE del abogado asociado al usuario (si rol=Abogado),
     usando usuarios.AbogadoID -> abogados.ID -> abogados.Nombre
     """
     try:
-        usuario = _usuario_actual()
-        if not usuario:
-            return ""
-        df_u = load_df("usuarios")
-        if df_u.empty or "Usuario" not in df_u.columns:
-            return ""
-        fila = df_u[df_u["Usuario"].astype(str) == usuario]
-        if fila.empty:
-            return ""
-        abogado_id = str(fila.iloc[0].get("AbogadoID","")).strip()
-        if not abogado_id:
-            return ""
-        df_a = load_df("abogados")
-        if df_a.empty or "ID" not in df_a.columns:
-            return ""
-        match = df_a[df_a["ID"].astype(str) == abogado_id]
-        if match.empty:
-            return ""
-        return str(match.iloc[0].get("Nombre","")).strip()
+        return perfil_sesion().abogado_nombre
     except Exception:
         return ""
 
+
+def _expedientes_de(usuario: str, rol: str, nombre_abogado: str):
+    if rol in ["admin", "personal administrativo"]:
+        return None
+
+    indice = _indice_asignaciones()
+    visibles = asignaciones.casos_de(indice, usuario, ["Delegado"])
+    if rol == "abogado":
+        visibles |= asignaciones.casos_de(indice, nombre_abogado, ["Principal", "Conjunto"])
+    return frozenset(visibles)
+
+
+def expedientes_visibles(usuario: str = None, rol: str = None):
+    """Expedientes (normalizados) que puede ver el usuario; None = todos."""
+    if usuario is None and rol is None:
+        return perfil_sesion().expedientes
+    rol = _rol_actual() if rol is None else str(rol).strip().lower()
+    usuario = _usuario_actual() if usuario is None else str(usuario).strip()
+    return _expedientes_de(usuario, rol, _abogados_por_usuario().get(usuario, ""))
+
+
 def filtrar_casos_por_rol(df_casos):
     """
     Reglas:
@@ -535,53 +2120,102 @@ def filtrar_casos_por_rol(df_casos):
         * es Abogado principal (por nombre)
         * está en AbogadosExtra (defensa conjunta por nombre)
         * está en Delegados (por usuario)
-    - Secretaria/o / Asistente: solo casos Delegados (por usuario)
+    - Secretaria/o / Asistente (y otros roles): solo casos Delegados (por usuario)
     """
     if df_casos is None or df_casos.empty:
         return df_casos
 
-    rol = _rol_actual()
-    usuario = _usuario_actual()
-
-    if rol in ["admin", "personal administrativo"]:
+    visibles = expedientes_visibles()
+    if visibles is None:
         return df_casos
+    if "Expediente" not in df_casos.columns:
+        return df_casos.iloc[0:0].copy()
+    return df_casos[finanzas.normalizar_caso(df_casos["Expediente"]).isin(visibles)].copy()
 
-    df = df_casos.copy()
-    for col in ["Abogado", "AbogadosExtra", "Delegados"]:
-        if col not in df.columns:
-            df[col] = ""
-        df[col] = df[col].astype(str)
 
-    if rol == "abogado":
-        nombre_abogado = _nombre_abogado_del_usuario()
-        m_deleg = df["Delegados"].str.contains(usuario, case=False, na=False) if usuario else False
-        if nombre_abogado:
-            m1 = df["Abogado"].str.contains(nombre_abogado, case=False, na=False)
-            m2 = df["AbogadosExtra"].str.contains(nombre_abogado, case=False, na=False)
-            return df[m1 | m2 | m_deleg].copy()
-        return df[m_deleg].copy() if isinstance(m_deleg, pd.Series) else df.iloc[0:0].copy()
-
-    if rol in ["secretaria", "secretaria/o", "asistente"]:
-        if not usuario:
-            return df.iloc[0:0].copy()
-        return df[df["Delegados"].str.contains(usuario, case=False, na=False)].copy()
-
-    if not usuario:
-        return df.iloc[0:0].copy()
-    return df[df["Delegados"].str.contains(usuario, case=False, na=False)].copy()
+# ----------------------------------------------------------
+# PERFIL DE SESIÓN
+# - login_ui lo arma una vez (usuario, rol, abogado, colaborador y
+#   expedientes visibles) y queda en st.session_state.perfil
+# - perfil_sesion() solo lo rehace si cambió usuarios / abogados /
+#   colaboradores / casos / asignaciones_caso (o el usuario de la sesión)
+# ----------------------------------------------------------
+TABLAS_PERFIL = ["usuarios", "abogados", "colaboradores", "casos", TABLA_ASIGNACIONES]
+ROLES_COLABORADOR = ["personal administrativo", "secretaria/o", "practicante"]
+
+
+@dataclass(frozen=True)
+class PerfilSesion:
+    usuario: str
+    rol: str                      # tal como figura en usuarios
+    abogado_id: str = ""
+    abogado_nombre: str = ""
+    colaborador_nombre: str = ""
+    expedientes: frozenset = None  # None = todos
+    firma: tuple = ()
+
+    @property
+    def nombre_visible(self) -> str:
+        rol = self.rol.lower()
+        if rol == "abogado" and self.abogado_nombre:
+            return f"{self.usuario}_{self.abogado_nombre}"
+        if rol in ROLES_COLABORADOR and self.colaborador_nombre:
+            return f"{self.usuario}_{self.colaborador_nombre}"
+        return self.usuario
+
+
+def _resolver_perfil(usuario, rol) -> PerfilSesion:
+    firma = _firma_tablas(TABLAS_PERFIL)
+    usuario = str(usuario or "").strip()
+    rol = str(rol or "").strip()
+
+    abogado_id = ""
+    df_u = load_df("usuarios")
+    if not df_u.empty and {"Usuario", "AbogadoID"} <= set(df_u.columns):
+        fila = df_u[df_u["Usuario"].astype(str) == usuario]
+        if not fila.empty:
+            abogado_id = _id_texto(fila["AbogadoID"]).iloc[0]
+
+    colaborador = ""
+    df_c = load_df("colaboradores")
+    if not df_c.empty and {"Usuario", "Nombre"} <= set(df_c.columns):
+        fila = df_c[df_c["Usuario"].astype(str) == usuario]
+        if not fila.empty:
+            colaborador = str(fila.iloc[0].get("Nombre", "") or "").strip()
+
+    abogado_nombre = _abogados_por_usuario().get(usuario, "")
+    return PerfilSesion(
+        usuario=usuario,
+        rol=rol,
+        abogado_id=abogado_id,
+        abogado_nombre=abogado_nombre,
+        colaborador_nombre=colaborador,
+        expedientes=_expedientes_de(usuario, rol.lower(), abogado_nombre),
+        firma=firma,
+    )
+
+
+def perfil_sesion() -> PerfilSesion:
+    perfil = st.session_state.get("perfil")
+    usuario, rol = _usuario_actual(), str(st.session_state.get("rol") or "").strip()
+    if perfil is None or perfil.usuario != usuario or perfil.rol != rol \
+            or perfil.firma != _firma_tablas(TABLAS_PERFIL):
+        perfil = _resolver_perfil(usuario, rol)
+        st.session_state.perfil = perfil
+    return perfil
 
 # ==========================================================
 # INICIALIZACIÓN DE ARCHIVOS (DESPUÉS de utilidades)
 # ==========================================================
 for k in FILES:
-    ensure_csv(k)
+    storage().preparar(k)
 
 # ==========================================================
 # ASEGURAR ADMIN (sin borrar nada)
 # ==========================================================
 usuarios = load_df("usuarios")
 if usuarios[usuarios["Usuario"].astype(str) == "admin"].empty:
-    usuarios = add_row(usuarios, {
+    usuarios = append_row("usuarios", usuarios, {
         "Usuario": "admin",
         "PasswordHash": sha256(ADMIN_BOOTSTRAP_PASSWORD),
         "Rol": "admin",
@@ -590,8 +2224,7 @@ if usuarios[usuarios["Usuario"].astype(str) == "admin"].empty:
         "Creado": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         "NombreCompleto": "",
         "DNI": "",
-    }, "usuarios")
-    save_df("usuarios", usuarios)
+    })
 
 # ==========================================================
 # LOGIN (variables de sesión)
@@ -602,6 +2235,8 @@ if "rol" not in st.session_state:
     st.session_state.rol = None
 if "abogado_id" not in st.session_state:
     st.session_state.abogado_id = ""
+if "perfil" not in st.session_state:
+    st.session_state.perfil = None
 
 def login_ui():
     brand_header()
@@ -621,6 +2256,7 @@ def login_ui():
         st.session_state.usuario = u
         st.session_state.rol = str(row.iloc[0].get("Rol",""))
         st.session_state.abogado_id = str(row.iloc[0].get("AbogadoID","")) if "AbogadoID" in row.columns else ""
+        st.session_state.perfil = _resolver_perfil(u, st.session_state.rol)
         st.rerun()
 
 if st.session_state.usuario is None:
@@ -629,54 +2265,104 @@ if st.session_state.usuario is None:
 
 # ==========================================================
 # CARGA DATA (con IDs asegurados)
+# - La reparación (ensure_ids + normalizar claves) corre UNA vez por
+#   versión de cada tabla y se cachea para todas las sesiones
+# - Solo se guarda (y respalda) la tabla si algo cambió de verdad
 # ==========================================================
+TABLAS_REPARABLES = TABLAS_CON_CASO + ["plantillas", "consultas"]
+
+
+@st.cache_resource
+def _cache_reparadas() -> dict:
+    return {"datos": {}, "lock": threading.Lock()}
+
+
+def _normalizar_col(s: pd.Series) -> pd.Series:
+    # Igual que normalize_key, pero vectorizado
+    return s.where(s.notna(), "").astype(str).str.strip().str.upper()
+
+
+def _reparar_df(key: str, df: pd.DataFrame):
+    """
+    Devuelve (df_reparado, cambio). cambio=True solo si ensure_ids o la
+    normalización de claves modificaron algún valor que deba persistirse.
+    """
+    cambio = False
+    if df is None or df.empty:
+        return df, cambio
+
+    if key in TABLAS_REPARABLES and "ID" in df.columns:
+        if pd.to_numeric(df["ID"], errors="coerce").isna().any():
+            df = ensure_ids(df, tabla=key)
+            cambio = True
+
+    col = "Expediente" if key == "casos" else "Caso"
+    if (key == "casos" or key in TABLAS_CON_CASO) and col in df.columns:
+        crudo = df[col]
+        norm = _normalizar_col(crudo)
+        if not norm.equals(crudo.where(crudo.notna(), "").astype(str)):
+            cambio = True
+        df[col] = norm
+
+    if key == "cuotas" and "Tipo" in df.columns:
+        tipo = df["Tipo"]
+        tipo_n = tipo.where(tipo.isna(), tipo.astype(str).str.replace(" ", "", regex=False))
+        if not tipo_n.equals(tipo):
+            cambio = True
+            df["Tipo"] = tipo_n
+
+    return df, cambio
+
+
+def load_df_reparado(key: str, persistir: bool = True) -> pd.DataFrame:
+    cache = _cache_reparadas()
+    firma = (storage().version(key), _version_schema(key))
+    ent = cache["datos"].get(key)
+    if firma[0] is not None and ent is not None and ent[0] == firma:
+        return _marcar_version(_vista_df(ent[1]), firma[0])
+
+    df, cambio = _reparar_df(key, load_df(key))
+    if cambio and persistir:
+        # guardar IDs / claves reparados (NO borra nada)
+        save_df(key, df)
+        firma = (storage().version(key), _version_schema(key))
+
+    with cache["lock"]:
+        cache["datos"][key] = (firma, df)
+    return _marcar_version(_vista_df(df), firma[0])
+
+
 clientes = load_df("clientes")
 abogados = load_df("abogados")
-casos = load_df("casos")
-
-honorarios = ensure_ids(load_df("honorarios"))
-honorarios_etapas = ensure_ids(load_df("honorarios_etapas"))
-pagos_honorarios = ensure_ids(load_df("pagos_honorarios"))
-
-cuota_litis = ensure_ids(load_df("cuota_litis"))
-pagos_litis = ensure_ids(load_df("pagos_litis"))
-
-cuotas = ensure_ids(load_df("cuotas"))
-actuaciones = ensure_ids(load_df("actuaciones"))
-documentos = ensure_ids(load_df("documentos"))
-plantillas = ensure_ids(load_df("plantillas"))
-consultas = ensure_ids(load_df("consultas"))
-
-# normalizar claves
-if "Expediente" in casos.columns:
-    casos["Expediente"] = casos["Expediente"].apply(normalize_key)
-
-for df in [honorarios, honorarios_etapas, pagos_honorarios, cuota_litis, pagos_litis, cuotas, actuaciones, documentos]:
-    if df is not None and not df.empty and "Caso" in df.columns:
-        df["Caso"] = df["Caso"].apply(normalize_key)
-
-if not cuotas.empty and "Tipo" in cuotas.columns:
-    cuotas["Tipo"] = cuotas["Tipo"].astype(str).str.replace(" ", "", regex=False)
-    cuotas["Tipo"] = cuotas["Tipo"].replace({"CuotaLitis":"CuotaLitis","Honorarios":"Honorarios"})
-    save_df("cuotas", cuotas)
-
-# guardar IDs reparados (NO borra nada)
-save_df("honorarios", honorarios)
-save_df("honorarios_etapas", honorarios_etapas)
-save_df("pagos_honorarios", pagos_honorarios)
-save_df("cuota_litis", cuota_litis)
-save_df("pagos_litis", pagos_litis)
-save_df("cuotas", cuotas)
-save_df("actuaciones", actuaciones)
-save_df("documentos", documentos)
-save_df("plantillas", plantillas)
-save_df("consultas", consultas)
+plantillas = load_df_reparado("plantillas")
+consultas = load_df_reparado("consultas")
+
+# casos y tablas ligadas a caso: completas solo si el perfil ve todo. Un
+# usuario restringido las recibe ya acotadas de tables_for() (ver DATOS POR
+# USUARIO): el proceso igual carga la tabla completa una vez (índice en
+# caché, compartido entre sesiones), pero la sesión solo copia sus filas.
+if perfil_sesion().expedientes is None:
+    # casos: Expediente normalizado solo en memoria (no se reescribe casos.csv)
+    casos = load_df_reparado("casos", persistir=False)
+
+    honorarios = load_df_reparado("honorarios")
+    honorarios_etapas = load_df_reparado("honorarios_etapas")
+    pagos_honorarios = load_df_reparado("pagos_honorarios")
+
+    cuota_litis = load_df_reparado("cuota_litis")
+    pagos_litis = load_df_reparado("pagos_litis")
+
+    cuotas = load_df_reparado("cuotas")
+    actuaciones = load_df_reparado("actuaciones")
+    documentos = load_df_reparado("documentos")
 
 # ==========================================================
 # PANEL DE CONTROL (RESET)
 # ==========================================================
 def reset_suave():
-    casos_set = set(casos["Expediente"].tolist()) if (casos is not None and not casos.empty and "Expediente" in casos.columns) else set()
+    # siempre contra la tabla completa (no la vista acotada del usuario)
+    casos_todos = load_df_reparado("casos", persistir=False)
+    casos_set = set(casos_todos["Expediente"].tolist()) if (casos_todos is not None and not casos_todos.empty and "Expediente" in casos_todos.columns) else set()
 
     def clean(keyname):
         df = load_df(keyname)
@@ -684,20 +2370,22 @@ def reset_suave():
             df["Caso"] = df["Caso"].apply(normalize_key)
             if casos_set:
                 df = df[df["Caso"].isin(casos_set)].copy()
-        df = ensure_ids(df)
+        df = ensure_ids(df, tabla=keyname)
         save_df(keyname, df)
 
     for keyname in ["honorarios","honorarios_etapas","pagos_honorarios","cuota_litis","pagos_litis","cuotas","actuaciones","documentos","consultas"]:
         clean(keyname)
 
 def reset_total(borrar_archivos=False):
+    be = storage()
     for k in FILES:
-        backup_file(FILES[k])
+        be.respaldar(k)
 
     for k in FILES:
         if k == "usuarios":
             continue
-        pd.DataFrame(columns=SCHEMAS[k]).to_csv(FILES[k], index=False)
+        with _bloqueo_tabla(k):
+            be.escribir(k, pd.DataFrame(columns=SCHEMAS[k]))
 
     users = pd.DataFrame(columns=SCHEMAS["usuarios"])
     users = pd.concat([users, pd.DataFrame([{
@@ -710,7 +2398,10 @@ def reset_total(borrar_archivos=False):
         "NombreCompleto":"",
         "DNI":""
     }])], ignore_index=True)
-    users.to_csv(FILES["usuarios"], index=False)
+    with _bloqueo_tabla("usuarios"):
+        be.escribir("usuarios", users)
+    be.reiniciar_secuencias()
+    invalidar_cache()
 
     if borrar_archivos:
         for folder in [UPLOADS_DIR, GENERADOS_DIR]:
@@ -729,39 +2420,11 @@ st.sidebar.markdown(f"### 🏷️ {APP_VERSION}")
 usr = str(st.session_state.get("usuario","")).strip()
 rol_raw = str(st.session_state.get("rol","")).strip()
 rol = rol_raw.lower()
-display_user = usr
-
+# nombre completo: viene del perfil armado en el login (ver PERFIL DE SESIÓN)
 try:
-    if rol == "abogado":
-        u_df = load_df("usuarios")
-        a_df = load_df("abogados")
-        if u_df is not None and not u_df.empty:
-            fila_u = u_df[u_df["Usuario"].astype(str) == usr]
-            if not fila_u.empty:
-                ab_id = str(fila_u.iloc[0].get("AbogadoID","")).strip()
-                try:
-                    if "." in ab_id:
-                        ab_id = str(int(float(ab_id)))
-                except Exception:
-                    pass
-                if a_df is not None and not a_df.empty and "ID" in a_df.columns:
-                    fila_a = a_df[a_df["ID"].astype(str).str.strip() == ab_id]
-                    if not fila_a.empty:
-                        nombre_ab = str(fila_a.iloc[0].get("Nombre","")).strip()
-                        if nombre_ab:
-                            display_user = f"{usr}_{nombre_ab}"
-
-    elif rol in ["personal administrativo", "secretaria/o", "practicante"]:
-        c_df = load_df("colaboradores")
-        if c_df is not None and not c_df.empty:
-            fila_c = c_df[c_df["Usuario"].astype(str) == usr]
-            if not fila_c.empty:
-                nombre_col = str(fila_c.iloc[0].get("Nombre","")).strip()
-                if nombre_col:
-                    display_user = f"{usr}_{nombre_col}"
-
+    display_user = perfil_sesion().nombre_visible
 except Exception:
-    pass
+    display_user = usr
 
 st.sidebar.write(f"👤 Usuario: {display_user} ({rol_raw})")
 
@@ -769,6 +2432,7 @@ if st.sidebar.button("Cerrar sesión"):
     st.session_state.usuario = None
     st.session_state.rol = None
     st.session_state.abogado_id = ""
+    st.session_state.perfil = None
     st.rerun()
 
 with st.sidebar.expander("🔒 Panel de control", expanded=False):
@@ -794,14 +2458,45 @@ rol = str(st.session_state.get("rol", "")).strip().lower()
 usuario = str(st.session_state.get("usuario", "")).strip()
 
 # ----------------------------------------------------------
-# ¿permisos listos?
+# Matriz de permisos compilada UNA vez por versión de permisos.csv:
+# (Scope, ScopeID) -> frozenset de columnas en "1" (fila repetida: manda
+# la primera). La prioridad USER > ROLE se resuelve con dos búsquedas en
+# el dict: el menú y los chequeos Ver/Agregar/Modificar/Borrar no leen
+# la tabla.
 # ----------------------------------------------------------
-def _permisos_listos() -> bool:
-    try:
+def _matriz_permisos() -> dict:
+    def construir():
         dfp = load_df("permisos")
-        return (dfp is not None) and (not dfp.empty) and ("Scope" in dfp.columns) and ("ScopeID" in dfp.columns)
+        if dfp is None or dfp.empty or "Scope" not in dfp.columns or "ScopeID" not in dfp.columns:
+            return {}
+        claves = [c for c in dfp.columns if c not in ("Scope", "ScopeID")]
+        dfp = dfp[~dfp[["Scope", "ScopeID"]].astype(str).duplicated()]
+        otorgado = (dfp[claves].astype(str) == "1").values
+        return {
+            (scope, scope_id): frozenset(c for c, ok in zip(claves, fila) if ok)
+            for scope, scope_id, fila in zip(dfp["Scope"], dfp["ScopeID"], otorgado)
+        }
+    try:
+        return _memo_acceso("permisos", ["permisos"], construir)
     except Exception:
-        return False
+        return {}
+
+
+# ----------------------------------------------------------
+# ¿permisos listos?
+# ----------------------------------------------------------
+def _permisos_listos() -> bool:
+    return bool(_matriz_permisos())
+
+
+def permisos_efectivos(usr: str = None, rl: str = None) -> frozenset:
+    """Columnas de permisos en "1" para el usuario (fila USER si existe; si no, la de su ROLE)."""
+    matriz = _matriz_permisos()
+    usr = usuario if usr is None else usr
+    rl = rol if rl is None else rl
+    if ("USER", usr) in matriz:
+        return matriz[("USER", usr)]
+    return matriz.get(("ROLE", rl), frozenset())
 
 # ----------------------------------------------------------
 # Helper permisos (prioridad USER > ROLE)
@@ -810,32 +2505,12 @@ def can_menu(menu_key: str) -> bool:
     """
     menu_key debe coincidir con columnas de SCHEMAS['permisos']
     Ej: 'Casos', 'Honorarios', 'Usuarios', 'Dashboard', etc.
+    También sirve para las acciones: can_menu('Agregar'), can_menu('Borrar')...
     """
     # Admin ve todo si aún no hay permisos configurados
     if rol == "admin" and not _permisos_listos():
         return True
-
-    try:
-        dfp = load_df("permisos")
-        if dfp is None or dfp.empty:
-            return False
-        if "Scope" not in dfp.columns or "ScopeID" not in dfp.columns:
-            return False
-
-        # override por usuario
-        ru = dfp[(dfp["Scope"] == "USER") & (dfp["ScopeID"] == usuario)]
-        if not ru.empty and menu_key in ru.columns:
-            return str(ru.iloc[0].get(menu_key, "0")) == "1"
-
-        # permiso por rol
-        rr = dfp[(dfp["Scope"] == "ROLE") & (dfp["ScopeID"] == rol)]
-        if not rr.empty and menu_key in rr.columns:
-            return str(rr.iloc[0].get(menu_key, "0")) == "1"
-
-    except Exception:
-        pass
-
-    return False
+    return menu_key in permisos_efectivos()
 
 # ----------------------------------------------------------
 # DEFINICIÓN GLOBAL DE MENÚS
@@ -911,242 +2586,369 @@ brand_header()
 def gastos_actuaciones_por_caso():
     if 'actuaciones' not in globals() or actuaciones is None or actuaciones.empty:
         return pd.DataFrame(columns=["Caso", "GastosActuaciones"])
+    return finanzas.gastos_por_caso(actuaciones)
 
-    df = actuaciones.copy()
-    df["Caso"] = df["Caso"].apply(normalize_key)
-    df["CostasAranceles"] = pd.to_numeric(df.get("CostasAranceles", 0), errors="coerce").fillna(0.0)
-    df["Gastos"] = pd.to_numeric(df.get("Gastos", 0), errors="coerce").fillna(0.0)
-    df["GastosActuaciones"] = df["CostasAranceles"] + df["Gastos"]
-    return df.groupby("Caso", as_index=False)["GastosActuaciones"].sum()
-
-
-def resumen_financiero_df():
-    if 'casos' not in globals() or casos is None or casos.empty:
-        return pd.DataFrame(columns=[
-            "Expediente","Cliente","Materia",
-            "Honorario Pactado","Honorario Pagado","Honorario Pendiente",
-            "Cuota Litis Calculada","Pagado Litis","Saldo Litis",
-            "Gastos Actuaciones","Saldo Total"
-        ])
 
-    # Preparar cuota litis con cálculo por fila
-    cl = cuota_litis.copy() if 'cuota_litis' in globals() and cuota_litis is not None else pd.DataFrame()
-    if not cl.empty:
-        cl["Caso"] = cl["Caso"].apply(normalize_key)
-        cl["Monto Base"] = safe_float_series(cl.get("Monto Base", 0))
-        cl["Porcentaje"] = safe_float_series(cl.get("Porcentaje", 0))
-        cl["CuotaCalc"] = cl["Monto Base"] * cl["Porcentaje"] / 100.0
-    else:
-        cl = pd.DataFrame(columns=["Caso", "CuotaCalc"])
+# ==========================================================
+# LIBRO FINANCIERO POR CASO (compartido)
+# - Pactado / pagado / cuota litis / gastos / saldo de cada caso, leído de
+#   saldos_por_caso (se actualiza al escribir; aquí solo se cruza con casos)
+# - Lo usan Dashboard, Ficha del Caso, Reportes y el reporte por abogado
+# - Regla única de pactado: etapas si el caso tiene etapas, si no total
+# ==========================================================
+TABLAS_LIBRO = [
+    "casos", "honorarios", "honorarios_etapas", "pagos_honorarios",
+    "cuota_litis", "pagos_litis", "actuaciones",
+]
 
-    gastos_df = gastos_actuaciones_por_caso()
-    gastos_map = dict(zip(gastos_df["Caso"].astype(str), safe_float_series(gastos_df["GastosActuaciones"]).tolist())) if not gastos_df.empty else {}
 
-    rows = []
-    for _, c in casos.iterrows():
-        exp = normalize_key(c.get("Expediente",""))
+@st.cache_resource
+def _cache_libro() -> dict:
+    return {"firma": None, "df": None, "lock": threading.Lock()}
 
-        # 1) Pactado honorarios: etapas si existen, si no total
-        sub_et = honorarios_etapas[honorarios_etapas["Caso"] == exp].copy() if 'honorarios_etapas' in globals() else pd.DataFrame()
-        if not sub_et.empty:
-            pactado = safe_float_series(sub_et.get("Monto Pactado", 0)).sum()
-        else:
-            sub_h = honorarios[honorarios["Caso"] == exp].copy() if 'honorarios' in globals() else pd.DataFrame()
-            pactado = safe_float_series(sub_h.get("Monto Pactado", 0)).sum()
 
-        # 2) Pagos honorarios
-        sub_ph = pagos_honorarios[pagos_honorarios["Caso"] == exp].copy() if 'pagos_honorarios' in globals() else pd.DataFrame()
-        pagado_h = safe_float_series(sub_ph.get("Monto", 0)).sum()
+def libro_financiero() -> pd.DataFrame:
+    cache = _cache_libro()
+    saldos = saldos_por_caso()
+    firma = _firma_tablas(["casos", TABLA_SALDOS])
+    if cache["firma"] == firma and cache["df"] is not None:
+        return _vista_df(cache["df"])
 
-        # 3) Cuota litis calculada
-        sub_cl = cl[cl["Caso"] == exp].copy()
-        calc = safe_float_series(sub_cl.get("CuotaCalc", 0)).sum()
+    df = finanzas.resumen_desde_saldos(load_df_reparado("casos", persistir=False), saldos)
 
-        # 4) Pagos litis
-        sub_pl = pagos_litis[pagos_litis["Caso"] == exp].copy() if 'pagos_litis' in globals() else pd.DataFrame()
-        pagado_l = safe_float_series(sub_pl.get("Monto", 0)).sum()
+    # solo se guarda si nada cambió mientras se calculaba
+    al_dia = saldos.attrs.get("_version") == (firma[0], firma[2][0])
+    if al_dia and all(v[0] is not None for v in firma[1:]) and firma == _firma_tablas(["casos", TABLA_SALDOS]):
+        with cache["lock"]:
+            cache["firma"], cache["df"] = firma, df
+    return _vista_df(df)
 
-        pend_h = max(0.0, float(pactado) - float(pagado_h))
-        pend_l = max(0.0, float(calc) - float(pagado_l))
-        gastos_act = float(gastos_map.get(exp, 0.0))
 
-        saldo_total = float(pend_h + pend_l)
+def libro_financiero_visible() -> pd.DataFrame:
+    """libro_financiero() solo con los expedientes del perfil de la sesión (todos si ve todo)."""
+    df = libro_financiero()
+    expedientes = perfil_sesion().expedientes
+    if expedientes is None:
+        return df
+    return df[finanzas.normalizar_caso(df["Expediente"]).isin(expedientes)]
 
-        rows.append([
-            exp, c.get("Cliente",""), c.get("Materia",""),
-            float(pactado), float(pagado_h), float(pend_h),
-            float(calc), float(pagado_l), float(pend_l),
-            float(gastos_act), float(saldo_total)
-        ])
 
-    return pd.DataFrame(rows, columns=[
-        "Expediente","Cliente","Materia",
-        "Honorario Pactado","Honorario Pagado","Honorario Pendiente",
-        "Cuota Litis Calculada","Pagado Litis","Saldo Litis",
-        "Gastos Actuaciones","Saldo Total"
-    ])
+# ==========================================================
+# CUOTAS Y ANTIGÜEDAD DE SALDOS (compartidas)
+# - Estado de cuotas (asignación en cascada), antigüedad 0-30/31-60/61-90/90+
+#   y flujo de caja proyectado, calculados UNA vez por versión de datos y por
+#   día (los días vencidos cambian con la fecha)
+# - El flujo se calcula a 12 meses; 3 y 6 meses son sus primeras filas
+# ==========================================================
+TABLAS_CUOTAS = ["cuotas", "pagos_honorarios", "pagos_litis"]
+
+
+@st.cache_resource
+def _cache_cuotas() -> dict:
+    return {"datos": {}, "lock": threading.Lock()}
+
+
+def _memo_cuotas(nombre: str, keys, calcular) -> pd.DataFrame:
+    cache = _cache_cuotas()
+    firma = (date.today(),) + _firma_tablas(keys)
+    ent = cache["datos"].get(nombre)
+    if ent is not None and ent[0] == firma:
+        return _vista_df(ent[1])
+    df = calcular()
+    if all(v[0] is not None for v in firma[2:]) and firma == (date.today(),) + _firma_tablas(keys):
+        with cache["lock"]:
+            cache["datos"][nombre] = (firma, df)
+    return _vista_df(df)
 
 
 def cuotas_status_all():
-    if 'cuotas' not in globals() or cuotas is None or cuotas.empty:
-        return pd.DataFrame()
-
-    df = cuotas.copy()
-    df["Caso"] = df["Caso"].apply(normalize_key)
-    df["Monto"] = safe_float_series(df["Monto"])
-    df["FechaVenc_dt"] = df["FechaVenc"].apply(to_date_safe)
-
-    ph = pagos_honorarios.copy() if 'pagos_honorarios' in globals() and pagos_honorarios is not None else pd.DataFrame()
-    pl = pagos_litis.copy() if 'pagos_litis' in globals() and pagos_litis is not None else pd.DataFrame()
-
-    if not ph.empty:
-        ph["Caso"] = ph["Caso"].apply(normalize_key)
-        ph["Monto"] = safe_float_series(ph["Monto"])
-    if not pl.empty:
-        pl["Caso"] = pl["Caso"].apply(normalize_key)
-        pl["Monto"] = safe_float_series(pl["Monto"])
-
-    def calc_for_type(tipo, pagos_df):
-        sub = df[df["Tipo"] == tipo].copy()
-        if sub.empty:
-            return sub
+    # asignación en cascada vectorizada (ver finanzas.estado_cuotas)
+    def calcular():
+        # de los pagos solo se suma Monto por Caso: lectura proyectada (el
+        # sidecar no materializa Observacion ni el resto)
+        pagos = [load_df(k, columns=["Caso", "Monto"]) for k in TABLAS_CUOTAS[1:]]
+        return finanzas.estado_cuotas(load_df_reparado("cuotas", persistir=False), *pagos)
+    return _memo_cuotas("estado", TABLAS_CUOTAS, calcular)
+
+
+def antiguedad_cuotas() -> pd.DataFrame:
+    """Una fila por cuota con saldo: Caso, Cliente, Abogado, Tipo, DiasVencido, Tramo..."""
+    def calcular():
+        return finanzas.antiguedad_cuotas(cuotas_status_all(), load_df_reparado("casos", persistir=False))
+    return _memo_cuotas("antiguedad", TABLAS_CUOTAS + ["casos"], calcular)
+
+
+def tasas_cobro_clientes() -> pd.DataFrame:
+    """Cliente / Vencido / Cobrado / Tasa sobre sus cuotas ya vencidas."""
+    def calcular():
+        return finanzas.tasas_cobro(cuotas_status_all(), load_df_reparado("casos", persistir=False))[0]
+    return _memo_cuotas("tasas", TABLAS_CUOTAS + ["casos"], calcular)
+
+
+def flujo_proyectado(frecuencia: str) -> pd.DataFrame:
+    """Cobranza esperada por semana ("W-MON") o mes ("MS"), 12 meses hacia adelante."""
+    def calcular():
+        return finanzas.proyeccion_flujo(
+            cuotas_status_all(), load_df_reparado("casos", persistir=False), frecuencia, meses=12
+        )
+    return _memo_cuotas(f"flujo_{frecuencia}", TABLAS_CUOTAS + ["casos"], calcular)
 
-        sub["_sort_date"] = sub["FechaVenc_dt"].apply(lambda d: d if d else date(2100,1,1))
-        sub["NroCuota"] = pd.to_numeric(sub["NroCuota"], errors="coerce").fillna(0).astype(int)
-        sub.sort_values(["Caso","_sort_date","NroCuota"], inplace=True)
-
-        pagado_por_caso = pagos_df.groupby("Caso")["Monto"].sum().to_dict() if not pagos_df.empty else {}
-        remaining = {k: float(v) for k, v in pagado_por_caso.items()}
-
-        asignados, saldos, estados, dias = [], [], [], []
-        today = date.today()
-
-        for _, r in sub.iterrows():
-            caso = r["Caso"]
-            monto = float(r["Monto"])
-            venc = r["FechaVenc_dt"]
-
-            rem = remaining.get(caso, 0.0)
-            asign = min(rem, monto) if monto > 0 else 0.0
-            remaining[caso] = rem - asign
-            saldo = monto - asign
-
-            if monto == 0:
-                est = "Sin monto"
-            elif saldo <= 0.00001:
-                est = "Pagada"
-            elif asign > 0:
-                est = "Parcial"
-            else:
-                est = "Pendiente"
 
-            dv = None if venc is None else (venc - today).days
-            asignados.append(asign); saldos.append(saldo); estados.append(est); dias.append(dv)
+# ==========================================================
+# CUBO DE REPORTES (consultas)
+# - cubo_reportes ya viene sumado por caso × abogado × mes; aquí solo se
+#   le une la materia/abogado actual del caso y se agrupa una vez por
+#   versión de las tablas
+# - la firma incluye las fuentes: si alguna cambió por fuera, se relee
+#   (y leer_derivada reconstruye)
+# ==========================================================
+TABLAS_CUBO = [TABLA_CUBO, "casos"] + finanzas.CUBO.fuentes
+
+
+def cubo_detalle() -> pd.DataFrame:
+    """Caso / Abogado / Materia / Mes + conceptos: base del desglose por casos."""
+    def calcular():
+        return finanzas.cubo_detalle(leer_derivada(TABLA_CUBO), load_df_reparado("casos", persistir=False))
+    return _memo_cuotas("cubo_detalle", TABLAS_CUBO, calcular)
 
-        sub["PagadoAsignado"] = asignados
-        sub["SaldoCuota"] = saldos
-        sub["Estado"] = estados
-        sub["DiasParaVencimiento"] = dias
-        sub.drop(columns=["_sort_date"], inplace=True, errors="ignore")
-        return sub
 
-    out_h = calc_for_type("Honorarios", ph)
-    out_l = calc_for_type("CuotaLitis", pl)
-    out = pd.concat([out_h, out_l], ignore_index=True) if (not out_h.empty or not out_l.empty) else pd.DataFrame()
-    return out
 # ==========================================================
-# DASHBOARD COMPLETO (ROBUSTO + VISUAL + DISCRIMINADO POR ROL)
+# CIERRES MENSUALES
+# - cerrar_mes() congela el detalle del cubo de un mes ya terminado en
+#   cierres_detalle (+ una fila en cierres)
+# - Reportes lee esa foto para los meses cerrados y el cubo solo para los
+#   abiertos (reporte_detalle / reporte_agregado)
+# - Las ediciones posteriores no cambian la foto: se avisan al escribir
+#   (cierres_alertas) y diferencias_cierres() las muestra contra el cubo
+# - Volver a cerrar un mes reemplaza su foto (queda en auditoría)
 # ==========================================================
-if menu == "Dashboard":
+TABLAS_REPORTE = TABLAS_CUBO + ["cierres", "cierres_detalle"]
+
+
+def meses_cerrables() -> list:
+    """Meses ya terminados con movimientos y sin cierre."""
+    det = cubo_detalle()
+    if det.empty:
+        return []
+    actual, cerrados = finanzas.mes_actual(), set(meses_cerrados())
+    return sorted(m for m in det["Mes"].unique() if m != finanzas.SIN_MES and m < actual and m not in cerrados)
+
+
+def cerrar_mes(mes: str, recerrar: bool = False) -> int:
+    """Guarda la foto del mes; devuelve cuántas filas (caso × abogado) quedaron."""
+    if not mes or mes >= finanzas.mes_actual():
+        raise ValueError(f"El mes {mes} aún no termina")
+    with _bloqueo_tabla("cierres"):
+        cierres = load_df("cierres")
+        ya_cerrado = mes in set(cierres["Mes"].astype(str))
+        if ya_cerrado and not recerrar:
+            raise ValueError(f"El mes {mes} ya está cerrado")
+        foto = finanzas.foto_cierre(
+            finanzas.cubo_detalle(leer_derivada(TABLA_CUBO), load_df_reparado("casos", persistir=False)), mes
+        )
+        with _bloqueo_tabla("cierres_detalle"):
+            det = load_df("cierres_detalle")
+            det = det[det["Mes"].astype(str) != mes]
+            save_df("cierres_detalle", pd.concat([det, foto], ignore_index=True) if not det.empty else foto, reemplazar=True)
+        fila = {
+            "Mes": mes,
+            "FechaCierre": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "Usuario": st.session_state.get("usuario", ""),
+            "Filas": len(foto),
+        }
+        if ya_cerrado:
+            cierres = cierres[cierres["Mes"].astype(str) != mes]
+            save_df("cierres", add_row(cierres, fila, "cierres"))
+        else:
+            append_row("cierres", cierres, fila)
+    return len(foto)
 
-    # =========================
-    # Helpers locales (seguros)
-    # =========================
-    def _to_num(s):
-        return pd.to_numeric(s, errors="coerce").fillna(0.0)
 
-    def _norm(s):
-        return normalize_key(s)
+def reporte_detalle() -> pd.DataFrame:
+    """Como cubo_detalle, con los meses cerrados tomados de su foto."""
+    def calcular():
+        return finanzas.detalle_con_cierres(cubo_detalle(), load_df("cierres_detalle"), meses_cerrados())
+    return _memo_cuotas("reporte_detalle", TABLAS_REPORTE, calcular)
+
+
+def reporte_agregado() -> pd.DataFrame:
+    """Abogado / Materia / Mes + conceptos (meses cerrados desde su foto)."""
+    return _memo_cuotas("reporte_agregado", TABLAS_REPORTE, lambda: finanzas.cubo_agregado(reporte_detalle()))
+
+
+def diferencias_cierres() -> pd.DataFrame:
+    """Mes / Caso / Concepto cuyo valor actual ya no es el del cierre."""
+    def calcular():
+        return finanzas.diferencias_cierre(cubo_detalle(), load_df("cierres_detalle"), meses_cerrados())
+    return _memo_cuotas("diferencias_cierres", TABLAS_REPORTE, calcular)
+
+
+# ==========================================================
+# FINANZAS DE UN SOLO CASO (Ficha del Caso)
+# - Índice Caso -> posiciones por tabla, armado una vez por versión
+# - case_financials / case_cuotas_status calculan solo con las filas del
+#   caso: abrir una ficha cuesta lo mismo con 50 o con 50 000 casos
+# ==========================================================
+@st.cache_resource
+def _cache_indices_caso() -> dict:
+    return {"datos": {}, "lock": threading.Lock()}
+
+
+def _indice_tabla(key: str):
+    cache = _cache_indices_caso()
+    firma = _firma_tablas([key])
+    ent = cache["datos"].get(key)
+    if ent is not None and ent[0] == firma:
+        return ent[1], ent[2]
+
+    df = load_df_reparado(key, persistir=False)
+    indice = finanzas.indice_por_caso(df, COL_CASO.get(key, "Caso"))
+    if firma[1][0] is not None and firma == _firma_tablas([key]):
+        with cache["lock"]:
+            cache["datos"][key] = (firma, df, indice)
+    return df, indice
+
+
+def filas_del_caso(key: str, exp) -> pd.DataFrame:
+    df, indice = _indice_tabla(key)
+    pos = indice.get(normalize_key(exp))
+    if pos is None:
+        return df.iloc[0:0]
+    return df.iloc[pos]
+
+
+def case_financials(exp) -> pd.DataFrame:
+    """Fila(s) del libro financiero de un expediente (mismas columnas que libro_financiero)."""
+    return finanzas.resumen_financiero(**{k: filas_del_caso(k, exp) for k in TABLAS_LIBRO})
+
+
+def case_cuotas_status(exp) -> pd.DataFrame:
+    """Estado de las cuotas de un expediente (igual que cuotas_status_all, solo ese caso)."""
+    return finanzas.estado_cuotas(
+        filas_del_caso("cuotas", exp),
+        filas_del_caso("pagos_honorarios", exp),
+        filas_del_caso("pagos_litis", exp),
+    )
+
+
+# ==========================================================
+# LIBRO DIARIO (consultas)
+# - Índice por caso+fecha y por fecha, armado una vez por versión del libro
+# - Estado de cuenta de un caso y totales de un período = un corte contiguo
+# ==========================================================
+TABLAS_LIBRO_DIARIO = [TABLA_LIBRO] + finanzas.LIBRO.fuentes
+
+
+def _indice_libro() -> dict:
+    cache = _cache_indices_caso()
+    firma = _firma_tablas(TABLAS_LIBRO_DIARIO)
+    ent = cache["datos"].get(TABLA_LIBRO)
+    if ent is not None and ent[0] == firma:
+        return ent[1]
+
+    indice = finanzas.indexar_libro(leer_derivada(TABLA_LIBRO))
+    if all(v[0] is not None for v in firma[1:]) and firma == _firma_tablas(TABLAS_LIBRO_DIARIO):
+        with cache["lock"]:
+            cache["datos"][TABLA_LIBRO] = (firma, indice)
+    return indice
+
+
+def estado_de_cuenta_caso(exp, desde=None, hasta=None) -> pd.DataFrame:
+    """Cargos / abonos del caso con saldo corrido (el saldo arrastra lo anterior a `desde`)."""
+    indice = _indice_libro()
+    lineas = finanzas.libro_del_caso(indice, exp, desde, hasta)
+    if desde:
+        anterior = finanzas.libro_del_caso(indice, exp)
+        anterior = anterior[anterior["Fecha"] < str(desde)]
+        return finanzas.estado_de_cuenta(lineas, finanzas.saldo_cliente(anterior))
+    return finanzas.estado_de_cuenta(lineas)
+
+
+def totales_libro(desde=None, hasta=None) -> pd.DataFrame:
+    """Debe / Haber / Saldo por cuenta de los asientos con fecha en [desde, hasta]."""
+    return finanzas.totales_por_cuenta(finanzas.libro_del_periodo(_indice_libro(), desde, hasta))
+
+
+# ==========================================================
+# DATOS POR USUARIO (seguridad por fila)
+# - tables_for(perfil): casos y tablas dependientes ya acotados a los
+#   expedientes que el usuario puede ver (semi-join por Caso normalizado)
+# - Se arma desde el índice por caso (_indice_tabla): la tabla completa se
+#   carga una vez por proceso y queda en caché; cada sesión restringida
+#   recibe y copia solo sus filas
+# - Caché por (conjunto de expedientes, versión de cada tabla)
+# - save_df de una sesión restringida (o de un frame con attrs["_alcance"])
+#   conserva las filas de los demás casos aunque el frame haya perdido attrs
+# ==========================================================
+@st.cache_resource
+def _cache_alcance() -> dict:
+    return {"datos": {}, "lock": threading.Lock()}
+
+
+def _tabla_acotada(key: str, expedientes: frozenset) -> pd.DataFrame:
+    cache = _cache_alcance()
+    firma = _firma_tablas([key])
+    ent = cache["datos"].get((key, expedientes))
+    if ent is None or ent[0] != firma:
+        df, indice = _indice_tabla(key)
+        df = finanzas.filas_de_casos(df, indice, expedientes).reset_index(drop=True)
+        df.attrs["_alcance"] = (COL_CASO.get(key, "Caso"), expedientes)
+        ent = (firma, df)
+        if firma[1][0] is not None:
+            with cache["lock"]:
+                # solo la versión vigente de cada (tabla, alcance)
+                for k in [k for k, v in cache["datos"].items() if k[0] == key and v[0] != firma]:
+                    cache["datos"].pop(k, None)
+                cache["datos"][(key, expedientes)] = ent
+    return _marcar_version(_vista_df(ent[1]), firma[1][0])
+
+
+def tables_for(perfil: PerfilSesion = None) -> dict:
+    """
+    {tabla: DataFrame} de casos y tablas ligadas a caso, vistas por el usuario.
+    Admin / Personal Administrativo (expedientes None): tablas completas.
+    """
+    perfil = perfil_sesion() if perfil is None else perfil
+    if perfil.expedientes is None:
+        return {k: load_df_reparado(k, persistir=k != "casos") for k in TABLAS_POR_USUARIO}
+    return {k: _tabla_acotada(k, perfil.expedientes) for k in TABLAS_POR_USUARIO}
+
+
+if perfil_sesion().expedientes is not None:
+    _tablas_usuario = tables_for()
+    casos = _tablas_usuario["casos"]
+    honorarios = _tablas_usuario["honorarios"]
+    honorarios_etapas = _tablas_usuario["honorarios_etapas"]
+    pagos_honorarios = _tablas_usuario["pagos_honorarios"]
+    cuota_litis = _tablas_usuario["cuota_litis"]
+    pagos_litis = _tablas_usuario["pagos_litis"]
+    cuotas = _tablas_usuario["cuotas"]
+    actuaciones = _tablas_usuario["actuaciones"]
+    documentos = _tablas_usuario["documentos"]
+
+
+# ==========================================================
+# DASHBOARD COMPLETO (ROBUSTO + VISUAL + DISCRIMINADO POR ROL)
+# ==========================================================
+if menu == "Dashboard":
 
     rol_dash = str(st.session_state.get("rol","")).strip().lower()
     usuario_dash = str(st.session_state.get("usuario","")).strip()
 
     # =========================
-    # Construir resumen por caso (NO SE TOCA)
+    # Resumen por caso (libro financiero compartido)
     # =========================
-    rows = []
-    if casos.empty:
-        df_res = pd.DataFrame(columns=[
-            "Expediente","Cliente","Materia",
-            "Honorario Pactado","Honorario Pagado","Honorario Pendiente",
-            "Cuota Litis Calculada","Pagado Litis","Saldo Litis"
-        ])
-    else:
-        h = honorarios.copy() if 'honorarios' in globals() else load_df("honorarios")
-        he = honorarios_etapas.copy() if 'honorarios_etapas' in globals() else load_df("honorarios_etapas")
-        ph = pagos_honorarios.copy() if 'pagos_honorarios' in globals() else load_df("pagos_honorarios")
-        cl = cuota_litis.copy() if 'cuota_litis' in globals() else load_df("cuota_litis")
-        pl = pagos_litis.copy() if 'pagos_litis' in globals() else load_df("pagos_litis")
-
-        for df in [h, he, ph, cl, pl]:
-            if df is not None and not df.empty and "Caso" in df.columns:
-                df["Caso"] = df["Caso"].apply(_norm)
-
-        if h is not None and not h.empty and "Monto Pactado" in h.columns:
-            h["Monto Pactado"] = _to_num(h["Monto Pactado"])
-        if he is not None and not he.empty and "Monto Pactado" in he.columns:
-            he["Monto Pactado"] = _to_num(he["Monto Pactado"])
-        if ph is not None and not ph.empty and "Monto" in ph.columns:
-            ph["Monto"] = _to_num(ph["Monto"])
-        if pl is not None and not pl.empty and "Monto" in pl.columns:
-            pl["Monto"] = _to_num(pl["Monto"])
-
-        if cl is not None and not cl.empty:
-            cl["Monto Base"] = _to_num(cl.get("Monto Base", 0))
-            cl["Porcentaje"] = _to_num(cl.get("Porcentaje", 0))
-            cl["CuotaCalc"] = cl["Monto Base"] * cl["Porcentaje"] / 100.0
-        else:
-            cl = pd.DataFrame(columns=["Caso","CuotaCalc"])
-
-        for _, c in casos.iterrows():
-            exp = _norm(c.get("Expediente",""))
-
-            pactado = 0.0
-            if he is not None and not he.empty:
-                sub = he[he["Caso"] == exp]
-                if not sub.empty:
-                    pactado = float(sub["Monto Pactado"].sum())
-            if pactado == 0 and h is not None and not h.empty:
-                sub = h[h["Caso"] == exp]
-                pactado = float(sub["Monto Pactado"].sum()) if not sub.empty else 0
-
-            pag_h = float(ph[ph["Caso"] == exp]["Monto"].sum()) if ph is not None and not ph.empty else 0
-            calc_l = float(cl[cl["Caso"] == exp]["CuotaCalc"].sum()) if cl is not None and not cl.empty else 0
-            pag_l = float(pl[pl["Caso"] == exp]["Monto"].sum()) if pl is not None and not pl.empty else 0
-
-            rows.append([
-                exp, c.get("Cliente",""), c.get("Materia",""),
-                pactado, pag_h, max(0,pactado-pag_h),
-                calc_l, pag_l, max(0,calc_l-pag_l)
-            ])
-
-        df_res = pd.DataFrame(rows, columns=[
-            "Expediente","Cliente","Materia",
-            "Honorario Pactado","Honorario Pagado","Honorario Pendiente",
-            "Cuota Litis Calculada","Pagado Litis","Saldo Litis"
-        ])
+    df_res = libro_financiero_visible()[[
+        "Expediente","Cliente","Materia",
+        "Honorario Pactado","Honorario Pagado","Honorario Pendiente",
+        "Cuota Litis Calculada","Pagado Litis","Saldo Litis"
+    ]]
 
     # =========================
-    # FILTRO POR ROL (NUEVO, NO ROMPE)
+    # FILTRO POR PERFIL: libro_financiero_visible() ya deja solo los
+    # expedientes que ve la sesión (cualquier rol restringido)
     # =========================
     df_res_view = df_res.copy()
-    if rol_dash == "abogado":
-        casos_propios = casos[
-            (casos["Abogado"].astype(str).str.contains(usuario_dash, na=False)) |
-            (casos["AbogadosExtra"].astype(str).str.contains(usuario_dash, na=False)) |
-            (casos["Delegados"].astype(str).str.contains(usuario_dash, na=False))
-        ]["Expediente"].astype(str).tolist()
-        df_res_view = df_res[df_res["Expediente"].isin(casos_propios)].copy()
 
     # =========================
     # MÉTRICAS (AJUSTADAS POR ROL)
@@ -1197,7 +2999,7 @@ if menu == "Dashboard":
     st.divider()
     st.markdown("### 📅 Agenda de Actuaciones")
 
-    df_act = load_df("actuaciones")
+    df_act = tables_for()["actuaciones"]
     if df_act is not None and not df_act.empty:
         df_act = df_act.copy()
         df_act["FechaAgenda"] = pd.to_datetime(
@@ -1252,6 +3054,18 @@ if menu == "Dashboard":
         use_container_width=True
     )
 
+    # antigüedad de lo que está en cuotas (solo los casos visibles)
+    det_ant = antiguedad_cuotas()
+    det_ant = det_ant[det_ant["Caso"].isin(df_res_view["Expediente"])]
+    if not det_ant.empty:
+        st.markdown("#### ⏳ Antigüedad de cuotas pendientes")
+        ant_tipo = (
+            det_ant.groupby(["Tipo", "Tramo"], observed=False)["SaldoCuota"].sum()
+            .unstack("Tramo").reindex(columns=finanzas.TRAMOS_ANTIGUEDAD, fill_value=0.0)
+        )
+        ant_tipo["Total"] = ant_tipo.sum(axis=1)
+        st.dataframe(ant_tipo[ant_tipo["Total"] > 0], use_container_width=True)
+
     st.download_button(
         "⬇️ Descargar reporte casos (CSV)",
         df_res_view.to_csv(index=False).encode("utf-8"),
@@ -1278,19 +3092,26 @@ if menu == "Ficha del Caso":
         # DATOS
         # =========================
         with tabs[0]:
-            df_caso = casos[casos["Expediente"] == exp]
+            df_caso = filas_del_caso("casos", exp)
             st.dataframe(df_caso, use_container_width=True)
 
+            st.markdown("### Equipo del caso")
+            equipo = asignaciones.del_caso(_indice_asignaciones(), exp_n)
+            if equipo.empty:
+                st.info("Sin abogados ni delegados asignados.")
+            else:
+                st.dataframe(equipo, use_container_width=True, hide_index=True)
+
         # =========================
         # PAGOS
         # =========================
         with tabs[1]:
             st.markdown("### Pagos Honorarios")
-            df_ph = pagos_honorarios[pagos_honorarios["Caso"] == exp_n]
+            df_ph = filas_del_caso("pagos_honorarios", exp_n)
             st.dataframe(df_ph, use_container_width=True)
 
             st.markdown("### Pagos Cuota Litis")
-            df_pl = pagos_litis[pagos_litis["Caso"] == exp_n]
+            df_pl = filas_del_caso("pagos_litis", exp_n)
             st.dataframe(df_pl, use_container_width=True)
 
         # =========================
@@ -1298,38 +3119,34 @@ if menu == "Ficha del Caso":
         # =========================
         with tabs[2]:
             st.markdown("### Cuotas registradas")
-            st.dataframe(cuotas[cuotas["Caso"] == exp_n], use_container_width=True)
+            st.dataframe(filas_del_caso("cuotas", exp_n), use_container_width=True)
 
             st.markdown("### Estado cuotas")
-            estado_cuotas = cuotas_status_all()
+            estado_cuotas = case_cuotas_status(exp_n)
             if estado_cuotas is None or estado_cuotas.empty:
                 st.info("No hay estado de cuotas disponible.")
             else:
-                st.dataframe(
-                    estado_cuotas[estado_cuotas["Caso"] == exp_n],
-                    use_container_width=True
-                )
+                st.dataframe(estado_cuotas, use_container_width=True)
 
         # =========================
         # ACTUACIONES
         # =========================
         with tabs[3]:
-            df_act = actuaciones[actuaciones["Caso"] == exp_n].sort_values("Fecha", ascending=False)
+            df_act = filas_del_caso("actuaciones", exp_n).sort_values("Fecha", ascending=False)
             st.dataframe(df_act, use_container_width=True)
 
         # =========================
         # DOCUMENTOS
         # =========================
         with tabs[4]:
-            df_doc = documentos[documentos["Caso"] == exp_n].sort_values("Fecha", ascending=False)
+            df_doc = filas_del_caso("documentos", exp_n).sort_values("Fecha", ascending=False)
             st.dataframe(df_doc, use_container_width=True)
 
         # =========================
         # ESTADO DE CUENTA + WORD
         # =========================
         with tabs[5]:
-            df_res = resumen_financiero_df()
-            fila = df_res[df_res["Expediente"] == exp_n]
+            fila = case_financials(exp_n)
 
             if fila.empty:
                 st.info("Sin estado de cuenta.")
@@ -1350,9 +3167,7 @@ if menu == "Ficha del Caso":
             # =========================
             # GASTOS CLIENTE (INFORMATIVO)
             # =========================
-            acts = actuaciones[actuaciones["Caso"] == exp_n].copy()
-            acts["CostasAranceles"] = pd.to_numeric(acts.get("CostasAranceles",0), errors="coerce").fillna(0.0)
-            acts["Gastos"] = pd.to_numeric(acts.get("Gastos",0), errors="coerce").fillna(0.0)
+            acts = filas_del_caso("actuaciones", exp_n).copy()
             acts["Total"] = acts["CostasAranceles"] + acts["Gastos"]
             acts["GastosPagado"] = acts.get("GastosPagado","0").astype(str)
 
@@ -1363,6 +3178,30 @@ if menu == "Ficha del Caso":
             g1.metric("⏳ Gastos pendientes", f"S/ {pend:,.2f}")
             g2.metric("✅ Gastos pagados", f"S/ {pag:,.2f}")
 
+            # =========================
+            # MOVIMIENTOS (LIBRO DIARIO)
+            # =========================
+            st.markdown("#### 📒 Movimientos del cliente (libro diario)")
+            cm1, cm2 = st.columns(2)
+            with cm1:
+                mov_desde = st.date_input("Desde", value=None, key="ficha_mov_desde")
+            with cm2:
+                mov_hasta = st.date_input("Hasta", value=None, key="ficha_mov_hasta")
+            movs_caso = estado_de_cuenta_caso(
+                exp_n,
+                mov_desde.isoformat() if mov_desde else None,
+                mov_hasta.isoformat() if mov_hasta else None,
+            )
+            if movs_caso.empty:
+                st.info("Sin movimientos en el período.")
+            else:
+                st.caption(f"Saldo al cierre del período: S/ {movs_caso['Saldo'].iloc[-1]:,.2f}")
+                st.dataframe(movs_caso, use_container_width=True, hide_index=True)
+                st.download_button(
+                    "⬇️ Descargar movimientos (CSV)", movs_caso.to_csv(index=False).encode("utf-8"),
+                    f"movimientos_{exp_n}.csv", key="ficha_mov_csv",
+                )
+
             # =========================
             # EXPORTAR A WORD
             # =========================
@@ -1461,7 +3300,7 @@ if menu == "Clientes":
    obs = st.text_area("Observaciones")
    submit = st.form_submit_button("Guardar", disabled=is_readonly)
   if submit:
-   new_id = next_id(df_cli)
+   new_id = next_id(df_cli, tabla="clientes")
    row = {
     "ID": new_id,
     "TipoCliente": tipo,
@@ -1479,8 +3318,7 @@ if menu == "Clientes":
     "PartidaElectronica": partida if tipo == "Jurídica" else "",
     "SedeRegistral": sede if tipo == "Jurídica" else "",
    }
-   df_cli = add_row(df_cli, row, "clientes")
-   save_df("clientes", df_cli)
+   df_cli = append_row("clientes", df_cli, row)
    try: _audit_log('ADD','clientes', new_id, nombre)
    except Exception: pass
    st.success("✅ Cliente registrado")
@@ -1561,8 +3399,8 @@ if menu == "Abogados":
    notas = st.text_area("Notas", height=120)
    submit = st.form_submit_button("Guardar", disabled=is_readonly)
   if submit:
-   new_id = next_id(df_ab)
-   df_ab = add_row(df_ab, {
+   new_id = next_id(df_ab, tabla="abogados")
+   df_ab = append_row("abogados", df_ab, {
     "ID": new_id,
     "Nombre": nombre,
     "DNI": dni,
@@ -1576,8 +3414,7 @@ if menu == "Abogados":
     "DistritoJudicial": distrito,
     "Casilla Judicial": cas_j,
     "Notas": notas,
-   }, "abogados")
-   save_df("abogados", df_ab)
+   })
    try: _audit_log('ADD','abogados', new_id, nombre)
    except Exception: pass
    st.success("✅ Abogado registrado")
@@ -1637,7 +3474,7 @@ if menu == "Colaboradores":
     # CARGA DE DATOS
     # --------------------------------------------------
     colaboradores = load_df("colaboradores")
-    if colaboradores is None or colaboradores.empty:
+    if colaboradores is None:
         colaboradores = pd.DataFrame(columns=[
             "ID","Nombre","DNI","Tipo","Usuario","Activo","Observaciones"
         ])
@@ -1647,17 +3484,6 @@ if menu == "Colaboradores":
         if col not in colaboradores.columns:
             colaboradores[col] = ""
 
-    # --------------------------------------------------
-    # GENERAR ID AUTOMÁTICO
-    # --------------------------------------------------
-    def next_colab_id(df):
-        if df.empty:
-            return "1"
-        try:
-            return str(int(pd.to_numeric(df["ID"], errors="coerce").max()) + 1)
-        except Exception:
-            return str(len(df) + 1)
-
     # --------------------------------------------------
     # USUARIOS DISPONIBLES (NO ABOGADOS, NO ADMIN)
     # --------------------------------------------------
@@ -1737,7 +3563,7 @@ if menu == "Colaboradores":
                             st.stop()
 
                 nuevo = {
-                    "ID": next_colab_id(colaboradores),
+                    "ID": str(next_id(colaboradores, tabla="colaboradores")),
                     "Nombre": nombre.strip(),
                     "DNI": dni.strip(),
                     "Tipo": tipo,
@@ -1746,10 +3572,7 @@ if menu == "Colaboradores":
                     "Observaciones": obs.strip(),
                 }
 
-                colaboradores = pd.concat(
-                    [colaboradores, pd.DataFrame([nuevo])],
-                    ignore_index=True
-                )
+                colaboradores = add_row(colaboradores, nuevo, "colaboradores")
                 save_df("colaboradores", colaboradores)
                 st.success("✅ Colaborador creado")
                 st.rerun()
@@ -1859,7 +3682,8 @@ if menu == "Colaboradores":
 if menu == "Casos":
     st.subheader("📁 Casos")
 
-    df_casos = load_df("casos")
+    # admin: casos.csv tal cual; usuario restringido: solo sus casos
+    df_casos = load_df("casos") if perfil_sesion().expedientes is None else tables_for()["casos"]
     is_readonly = st.session_state.get('rol') == 'asistente'
     accion = st.radio("Acción", ["Nuevo","Editar","Eliminar"], horizontal=True, key="cas_accion")
 
@@ -2055,10 +3879,10 @@ if menu == "Casos":
                 submit = st.form_submit_button("Guardar", disabled=is_readonly)
 
             if submit:
-                new_id = next_id(df_casos)
+                new_id = next_id(df_casos, tabla="casos")
                 num_delegados = len(delegados_sel) if delegacion_activa else 0
 
-                df_casos = add_row(df_casos, {
+                df_casos = append_row("casos", df_casos, {
                     "ID": new_id,
                     "Cliente": cliente,
                     "Abogado": abogado,
@@ -2083,9 +3907,7 @@ if menu == "Casos":
                     "DelegacionActiva": "1" if delegacion_activa else "0",
                     "NumDelegados": int(num_delegados),
                     "Delegados": " | ".join([d for d in delegados_sel if str(d).strip() != ""]),
-                }, "casos")
-
-                save_df("casos", df_casos)
+                })
                 try:
                     _audit_log('ADD','casos', new_id, expediente)
                 except Exception:
@@ -2310,7 +4132,7 @@ if menu == "Honorarios":
         st.markdown("### Honorario total")
 
         if honorarios is None:
-            honorarios = load_df("honorarios")
+            honorarios = tables_for()["honorarios"]
         if honorarios is None:
             honorarios = pd.DataFrame(columns=["ID","Caso","Monto Pactado","Notas","FechaRegistro"])
 
@@ -2359,14 +4181,13 @@ if menu == "Honorarios":
                     disabled=is_readonly,
                     key="hon_total_save_btn"
                 ):
-                    honorarios = add_row(honorarios, {
-                        "ID": next_id(honorarios),
+                    honorarios = append_row("honorarios", honorarios, {
+                        "ID": next_id(honorarios, tabla="honorarios"),
                         "Caso": _norm(exp),
                         "Monto Pactado": float(monto),
                         "Notas": notas,
                         "FechaRegistro": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    }, "honorarios")
-                    save_df("honorarios", honorarios)
+                    })
                     st.success("✅ Guardado")
                     st.rerun()
 
@@ -2417,7 +4238,7 @@ if menu == "Honorarios":
             if submit:
                 idx = honorarios.index[honorarios["ID"] == sel][0]
                 # ✅ NO tocamos Caso. Solo monto y notas.
-                honorarios.loc[idx, ["Monto Pactado","Notas"]] = [float(monto_e), notas_e]
+                asignar_fila(honorarios, idx, {"Monto Pactado": float(monto_e), "Notas": notas_e})
                 save_df("honorarios", honorarios)
                 st.success("✅ Actualizado")
                 st.rerun()
@@ -2451,7 +4272,7 @@ if menu == "Honorarios":
         st.markdown("### Honorarios por etapa / instancia")
 
         if honorarios_etapas is None:
-            honorarios_etapas = load_df("honorarios_etapas")
+            honorarios_etapas = tables_for()["honorarios_etapas"]
         if honorarios_etapas is None:
             honorarios_etapas = pd.DataFrame(columns=["ID","Caso","Etapa","Monto Pactado","Notas","FechaRegistro"])
 
@@ -2485,15 +4306,14 @@ if menu == "Honorarios":
                 disabled=is_readonly,
                 key="hon_et_save_btn"
             ):
-                honorarios_etapas = add_row(honorarios_etapas, {
-                    "ID": next_id(honorarios_etapas),
+                honorarios_etapas = append_row("honorarios_etapas", honorarios_etapas, {
+                    "ID": next_id(honorarios_etapas, tabla="honorarios_etapas"),
                     "Caso": _norm(exp),
                     "Etapa": etapa,
                     "Monto Pactado": float(monto),
                     "Notas": notas,
                     "FechaRegistro": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                }, "honorarios_etapas")
-                save_df("honorarios_etapas", honorarios_etapas)
+                })
                 st.success("✅ Guardado")
                 st.rerun()
 
@@ -2547,7 +4367,7 @@ if menu == "Honorarios":
             if submit:
                 idx = honorarios_etapas.index[honorarios_etapas["ID"] == sel][0]
                 # ✅ NO tocamos Caso. Solo etapa/monto/notas.
-                honorarios_etapas.loc[idx, ["Etapa","Monto Pactado","Notas"]] = [etapa_e, float(monto_e), notas_e]
+                asignar_fila(honorarios_etapas, idx, {"Etapa": etapa_e, "Monto Pactado": float(monto_e), "Notas": notas_e})
                 save_df("honorarios_etapas", honorarios_etapas)
                 st.success("✅ Actualizado")
                 st.rerun()
@@ -2589,12 +4409,11 @@ if menu == "Pagos Honorarios":
         obs = st.text_input("Observación", value="", key="ph_obs")
 
         if st.button("Registrar pago honorarios"):
-            new_id = next_id(pagos_honorarios)
-            pagos_honorarios = add_row(pagos_honorarios, {
+            new_id = next_id(pagos_honorarios, tabla="pagos_honorarios")
+            pagos_honorarios = append_row("pagos_honorarios", pagos_honorarios, {
                 "ID": new_id, "Caso": normalize_key(exp), "Etapa": etapa,
                 "FechaPago": str(fecha), "Monto": float(monto), "Observacion": obs
-            }, "pagos_honorarios")
-            save_df("pagos_honorarios", pagos_honorarios)
+            })
             st.success("✅ Pago registrado")
             st.rerun()
 
@@ -2607,13 +4426,16 @@ if menu == "Pagos Honorarios":
         with st.form("ph_edit_form"):
             exp_e = st.selectbox("Expediente", exp_list, index=exp_list.index(fila["Caso"]) if fila["Caso"] in exp_list else 0)
             etapa_e = st.selectbox("Etapa", ETAPAS_HONORARIOS, index=ETAPAS_HONORARIOS.index(fila["Etapa"]) if fila["Etapa"] in ETAPAS_HONORARIOS else 0)
-            fecha_e = st.text_input("FechaPago (YYYY-MM-DD)", value=str(fila["FechaPago"]))
+            fecha_e = st.text_input("FechaPago (YYYY-MM-DD)", value=fecha_txt(fila["FechaPago"]))
             monto_e = st.number_input("Monto", min_value=0.0, value=money(fila["Monto"]), step=50.0)
             obs_e = st.text_input("Observación", value=str(fila["Observacion"]))
             submit = st.form_submit_button("Guardar cambios")
             if submit:
                 idx = pagos_honorarios.index[pagos_honorarios["ID"] == sel][0]
-                pagos_honorarios.loc[idx, :] = [sel, normalize_key(exp_e), etapa_e, fecha_e, float(monto_e), obs_e]
+                asignar_fila(pagos_honorarios, idx, {
+                    "Caso": normalize_key(exp_e), "Etapa": etapa_e, "FechaPago": fecha_e,
+                    "Monto": float(monto_e), "Observacion": obs_e
+                })
                 save_df("pagos_honorarios", pagos_honorarios)
                 st.success("✅ Actualizado")
                 st.rerun()
@@ -2679,8 +4501,8 @@ if menu == "Cronograma de Cuotas":
         nro = int(sub["NroCuota"].max()) + 1 if not sub.empty else 1
 
         if st.button("Guardar cuota", disabled=is_readonly, key="cr_save_new"):
-            new_id = next_id(cuotas)
-            cuotas = add_row(cuotas, {
+            new_id = next_id(cuotas, tabla="cuotas")
+            cuotas = append_row("cuotas", cuotas, {
                 "ID": new_id,
                 "Caso": caso_norm,
                 "Tipo": tipo_norm,
@@ -2688,8 +4510,7 @@ if menu == "Cronograma de Cuotas":
                 "FechaVenc": str(venc_new),
                 "Monto": float(monto_new),
                 "Notas": notas_new
-            }, "cuotas")
-            save_df("cuotas", cuotas)
+            })
             st.success("✅ Cuota creada")
             st.rerun()
 
@@ -2715,7 +4536,7 @@ if menu == "Cronograma de Cuotas":
                 nro_e = st.number_input("NroCuota", min_value=1, step=1,
                                         value=int(pd.to_numeric(fila["NroCuota"], errors="coerce") or 1),
                                         key="cr_edit_nro")
-                venc_e = st.text_input("FechaVenc (YYYY-MM-DD)", value=str(fila["FechaVenc"]), key="cr_edit_venc")
+                venc_e = st.text_input("FechaVenc (YYYY-MM-DD)", value=fecha_txt(fila["FechaVenc"]), key="cr_edit_venc")
                 monto_e = st.number_input("Monto", min_value=0.0, step=50.0,
                                           value=float(pd.to_numeric(fila["Monto"], errors="coerce") or 0),
                                           key="cr_edit_monto")
@@ -2725,14 +4546,14 @@ if menu == "Cronograma de Cuotas":
 
             if submit:
                 idx = cuotas.index[cuotas["ID"] == sel_id][0]
-                cuotas.loc[idx, ["Caso","Tipo","NroCuota","FechaVenc","Monto","Notas"]] = [
-                    normalize_key(caso_e),
-                    "Honorarios" if str(tipo_e) == "Honorarios" else "CuotaLitis",
-                    int(nro_e),
-                    str(venc_e),
-                    float(monto_e),
-                    notas_e
-                ]
+                asignar_fila(cuotas, idx, {
+                    "Caso": normalize_key(caso_e),
+                    "Tipo": "Honorarios" if str(tipo_e) == "Honorarios" else "CuotaLitis",
+                    "NroCuota": int(nro_e),
+                    "FechaVenc": str(venc_e),
+                    "Monto": float(monto_e),
+                    "Notas": notas_e
+                })
                 save_df("cuotas", cuotas)
                 st.success("✅ Cuota actualizada")
                 st.rerun()
@@ -2771,29 +4592,27 @@ if menu == "Cronograma de Cuotas":
 
             if st.button("💳 Registrar pago equivalente", disabled=is_readonly or monto_pago <= 0, key="cr_pay_btn"):
                 if tipo_pago == "Honorarios":
-                    new_id = next_id(pagos_honorarios)
-                    pagos_honorarios = add_row(pagos_honorarios, {
+                    new_id = next_id(pagos_honorarios, tabla="pagos_honorarios")
+                    pagos_honorarios = append_row("pagos_honorarios", pagos_honorarios, {
                         "ID": new_id,
                         "Caso": normalize_key(caso_pago),
                         "Etapa": "",  # opcional: si quieres asociarlo a una etapa, lo puedes editar luego
                         "FechaPago": str(fecha_pago),
                         "Monto": float(monto_pago),
                         "Observacion": obs_pago
-                    }, "pagos_honorarios")
-                    save_df("pagos_honorarios", pagos_honorarios)
+                    })
                     st.success("✅ Pago de honorarios creado (afecta dashboard y estado de cuotas)")
                     st.rerun()
 
                 else:  # CuotaLitis
-                    new_id = next_id(pagos_litis)
-                    pagos_litis = add_row(pagos_litis, {
+                    new_id = next_id(pagos_litis, tabla="pagos_litis")
+                    pagos_litis = append_row("pagos_litis", pagos_litis, {
                         "ID": new_id,
                         "Caso": normalize_key(caso_pago),
                         "FechaPago": str(fecha_pago),
                         "Monto": float(monto_pago),
                         "Observacion": obs_pago
-                    }, "pagos_litis")
-                    save_df("pagos_litis", pagos_litis)
+                    })
                     st.success("✅ Pago de litis creado (afecta dashboard y estado de cuotas)")
                     st.rerun()
 
@@ -2810,6 +4629,83 @@ if menu == "Cronograma de Cuotas":
 
         st.download_button("⬇️ Descargar cronograma (CSV)", cuotas.to_csv(index=False).encode("utf-8"), "cuotas.csv", key="cr_dl_csv")
 
+        # ==========================================================
+        # ANTIGÜEDAD DE SALDOS (días vencidos por tramo)
+        # ==========================================================
+        st.divider()
+        st.markdown("### ⏳ Antigüedad de saldos")
+        st.caption("Saldo de cada cuota según días vencidos (tras asignar los pagos). 'Por vencer' incluye cuotas sin fecha.")
+
+        det_ant = antiguedad_cuotas()
+        if det_ant.empty:
+            st.info("No hay cuotas con saldo pendiente.")
+        else:
+            por_ant = st.radio("Agrupar por", ["Caso", "Cliente", "Abogado"], horizontal=True, key="cr_ant_por")
+            res_ant = finanzas.resumen_antiguedad(det_ant, por_ant)
+
+            tot_ant = det_ant.groupby("Tramo", observed=False)["SaldoCuota"].sum()
+            cols_ant = st.columns(len(finanzas.TRAMOS_ANTIGUEDAD))
+            for col_a, tramo in zip(cols_ant, finanzas.TRAMOS_ANTIGUEDAD):
+                col_a.metric(f"{tramo} (S/)", f"{money(tot_ant.get(tramo, 0.0)):,.2f}")
+
+            st.dataframe(res_ant, use_container_width=True, hide_index=True)
+            st.download_button(
+                "⬇️ Descargar antigüedad (CSV)",
+                res_ant.to_csv(index=False).encode("utf-8"),
+                f"antiguedad_por_{por_ant.lower()}.csv",
+                key="cr_ant_csv",
+            )
+            st.download_button(
+                "⬇️ Descargar detalle por cuota (CSV)",
+                det_ant.to_csv(index=False).encode("utf-8"),
+                "antiguedad_detalle.csv",
+                key="cr_ant_det_csv",
+            )
+
+        # ==========================================================
+        # FLUJO DE CAJA PROYECTADO
+        # ==========================================================
+        st.divider()
+        st.markdown("### 💸 Flujo de caja proyectado")
+        st.caption(
+            "Saldo de las cuotas en la semana/mes de su vencimiento, ajustado por la tasa histórica "
+            "de cobro de cada cliente. Lo ya vencido se espera en el período actual; "
+            "las cuotas sin fecha no se incluyen."
+        )
+
+        c_fl1, c_fl2 = st.columns(2)
+        with c_fl1:
+            frec_fl = st.radio("Frecuencia", list(finanzas.FRECUENCIAS_FLUJO), horizontal=True, key="cr_flujo_frec")
+        with c_fl2:
+            meses_fl = st.radio("Horizonte (meses)", [3, 6, 12], horizontal=True, key="cr_flujo_meses")
+
+        alias_fl = finanzas.FRECUENCIAS_FLUJO[frec_fl]
+        flujo = flujo_proyectado(alias_fl).iloc[:finanzas.periodos_horizonte(alias_fl, meses_fl)]
+        tasas_cli = tasas_cobro_clientes()
+        tasa_estudio = (tasas_cli["Cobrado"].sum() / tasas_cli["Vencido"].sum()) if not tasas_cli.empty else 1.0
+
+        m_fl1, m_fl2, m_fl3 = st.columns(3)
+        m_fl1.metric("Programado (S/)", f"{flujo['Programado'].sum():,.2f}")
+        m_fl2.metric("Esperado (S/)", f"{flujo['Esperado'].sum():,.2f}")
+        m_fl3.metric("Tasa de cobro del estudio", f"{min(max(tasa_estudio, 0.0), 1.0):.0%}")
+
+        st.bar_chart(flujo[["Esperado", "De cuotas vencidas"]])
+        flujo_tabla = flujo.reset_index()
+        flujo_tabla["Periodo"] = flujo_tabla["Periodo"].dt.strftime("%Y-%m-%d")
+        st.dataframe(flujo_tabla, use_container_width=True, hide_index=True)
+        st.download_button(
+            "⬇️ Descargar flujo proyectado (CSV)",
+            flujo_tabla.to_csv(index=False).encode("utf-8"),
+            f"flujo_{frec_fl.lower()}_{meses_fl}m.csv",
+            key="cr_flujo_csv",
+        )
+
+        with st.expander("Tasas de cobro por cliente", expanded=False):
+            if tasas_cli.empty:
+                st.info("Aún no hay cuotas vencidas: se asume cobro completo.")
+            else:
+                st.dataframe(tasas_cli.sort_values("Tasa"), use_container_width=True, hide_index=True)
+
 # ==========================================================
 # ACTUACIONES (FICHA por caso/cliente + historial + reporte)
 # + ✅ Aranceles / Otros gastos
@@ -2868,8 +4764,8 @@ if menu == "Actuaciones":
                 submit = st.form_submit_button("Guardar actuación")
 
                 if submit:
-                    new_id = next_id(actuaciones)
-                    actuaciones = add_row(actuaciones, {
+                    new_id = next_id(actuaciones, tabla="actuaciones")
+                    actuaciones = append_row("actuaciones", actuaciones, {
                         "ID": new_id,
                         "Caso": normalize_key(exp),
                         "Cliente": cliente,
@@ -2883,8 +4779,7 @@ if menu == "Actuaciones":
                         "Gastos": float(otros_gastos),
                         "GastosPagado": "1" if gastos_pagado else "0",
                         "Notas": notas
-                    }, "actuaciones")
-                    save_df("actuaciones", actuaciones)
+                    })
                     st.success("✅ Actuación registrada")
                     st.rerun()
 
@@ -2914,12 +4809,12 @@ if menu == "Actuaciones":
                 )
 
                 for _, r in hist.iterrows():
-                    titulo = f"{r['Fecha']} – {r['TipoActuacion']} (ID {r['ID']})"
+                    titulo = f"{fecha_txt(r['Fecha'])} – {r['TipoActuacion']} (ID {r['ID']})"
                     with st.expander(titulo, expanded=False):
                         st.write(f"**Cliente:** {r.get('Cliente','')}")
                         st.write(f"**Resumen:** {r.get('Resumen','')}")
                         st.write(f"**Próxima acción:** {r.get('ProximaAccion','')}")
-                        st.write(f"**Fecha próxima acción:** {r.get('FechaProximaAccion','')}")
+                        st.write(f"**Fecha próxima acción:** {fecha_txt(r.get('FechaProximaAccion',''))}")
                         if str(r.get("LinkOneDrive","")).strip():
                             st.markdown(f"**Link OneDrive:** {r.get('LinkOneDrive')}")
 
@@ -2941,13 +4836,13 @@ if menu == "Actuaciones":
                 fila = actuaciones[actuaciones["ID"] == sel].iloc[0]
 
                 with st.form("act_edit_form"):
-                    fecha_e = st.text_input("Fecha (YYYY-MM-DD)", value=str(fila["Fecha"]))
+                    fecha_e = st.text_input("Fecha (YYYY-MM-DD)", value=fecha_txt(fila["Fecha"]))
                     tipo_e = st.text_input("TipoActuacion", value=str(fila["TipoActuacion"]))
                     resumen_e = st.text_area("Resumen", value=str(fila["Resumen"]), height=160)
                     prox_e = st.text_input("ProximaAccion", value=str(fila["ProximaAccion"]))
                     prox_fecha_e = st.text_input(
                         "FechaProximaAccion",
-                        value=str(fila["FechaProximaAccion"])
+                        value=fecha_txt(fila["FechaProximaAccion"])
                     )
                     link_e = st.text_input(
                         "LinkOneDrive",
@@ -2984,19 +4879,14 @@ if menu == "Actuaciones":
 
                     if submit:
                         idx = actuaciones.index[actuaciones["ID"] == sel][0]
-                        actuaciones.loc[idx, [
-                            "Fecha","TipoActuacion","Resumen",
-                            "ProximaAccion","FechaProximaAccion",
-                            "LinkOneDrive","CostasAranceles",
-                            "Gastos","GastosPagado","Notas"
-                        ]] = [
-                            fecha_e, tipo_e, resumen_e,
-                            prox_e, prox_fecha_e,
-                            link_e, float(aranceles_e),
-                            float(gastos_e),
-                            "1" if gastos_pagado_e else "0",
-                            notas_e
-                        ]
+                        asignar_fila(actuaciones, idx, {
+                            "Fecha": fecha_e, "TipoActuacion": tipo_e, "Resumen": resumen_e,
+                            "ProximaAccion": prox_e, "FechaProximaAccion": prox_fecha_e,
+                            "LinkOneDrive": link_e, "CostasAranceles": float(aranceles_e),
+                            "Gastos": float(gastos_e),
+                            "GastosPagado": "1" if gastos_pagado_e else "0",
+                            "Notas": notas_e
+                        })
                         save_df("actuaciones", actuaciones)
                         st.success("✅ Actualizado")
                         st.rerun()
@@ -3026,20 +4916,14 @@ if menu == "Actuaciones":
             if rep.empty:
                 st.info("No hay actuaciones registradas para este expediente.")
             else:
-                # Normalizar valores
-                rep["CostasAranceles"] = pd.to_numeric(rep.get("CostasAranceles", 0), errors="coerce").fillna(0.0)
-                rep["Gastos"] = pd.to_numeric(rep.get("Gastos", 0), errors="coerce").fillna(0.0)
+                # CostasAranceles / Gastos ya son float64 (SCHEMA_TIPOS)
                 rep["GastosPagado"] = rep.get("GastosPagado", "0").astype(str)
+                total_gasto = rep["CostasAranceles"] + rep["Gastos"]
+                pagado_cli = rep["GastosPagado"] == "1"
 
                 # ✅ columnas explícitas (NO ambiguas)
-                rep["Gasto Pendiente Cliente"] = rep.apply(
-                    lambda r: (r["CostasAranceles"] + r["Gastos"]) if r["GastosPagado"] != "1" else 0.0,
-                    axis=1
-                )
-                rep["Gasto Pagado Cliente"] = rep.apply(
-                    lambda r: (r["CostasAranceles"] + r["Gastos"]) if r["GastosPagado"] == "1" else 0.0,
-                    axis=1
-                )
+                rep["Gasto Pendiente Cliente"] = total_gasto.where(~pagado_cli, 0.0)
+                rep["Gasto Pagado Cliente"] = total_gasto.where(pagado_cli, 0.0)
 
                 total_pendiente = rep["Gasto Pendiente Cliente"].sum()
                 total_pagado = rep["Gasto Pagado Cliente"].sum()
@@ -3179,8 +5063,8 @@ if menu == "Consultas":
         b1, b2, b3 = st.columns([1, 1, 2])
         with b1:
             if st.button("💾 Guardar consulta y proforma", key="cons_save"):
-                new_id = next_id(consultas)
-                consultas = add_row(consultas, {
+                new_id = next_id(consultas, tabla="consultas")
+                consultas = append_row("consultas", consultas, {
                     "ID": new_id,
                     "Fecha": str(draft["Fecha"]),
                     "Cliente": draft["Cliente"],
@@ -3193,8 +5077,7 @@ if menu == "Consultas":
                     "Proforma": proforma,
                     "LinkOneDrive": draft["LinkOneDrive"],
                     "Notas": draft["Notas"]
-                }, "consultas")
-                save_df("consultas", consultas)
+                })
 
                 # ✅ limpiar borrador (autoguardado) al guardar
                 st.session_state.consulta_draft = {
@@ -3240,7 +5123,7 @@ if menu == "Consultas":
             st.info("Aún no hay consultas registradas.")
         else:
             def label_consulta(row):
-                return f"ID {row['ID']} – {row.get('Fecha','')} – {row.get('Cliente','')} – {row.get('Abogado','')}"
+                return f"ID {row['ID']} – {fecha_txt(row.get('Fecha',''))} – {row.get('Cliente','')} – {row.get('Abogado','')}"
             consultas_view = consultas.copy()
             consultas_view["_label"] = consultas_view.apply(label_consulta, axis=1)
 
@@ -3248,7 +5131,7 @@ if menu == "Consultas":
             row = consultas_view[consultas_view["_label"] == sel_label].iloc[0]
 
             st.markdown("### Detalle de consulta")
-            st.write(f"**Fecha:** {row.get('Fecha','')}")
+            st.write(f"**Fecha:** {fecha_txt(row.get('Fecha',''))}")
             st.write(f"**Cliente:** {row.get('Cliente','')}")
             st.write(f"**Expediente:** {row.get('Caso','')}")
             st.write(f"**Abogado a cargo:** {row.get('Abogado','')}")
@@ -3280,7 +5163,7 @@ if menu == "Consultas":
             fila = consultas[consultas["ID"] == sel_id].iloc[0]
 
             with st.form("cons_edit_form"):
-                fecha_e = st.text_input("Fecha", value=str(fila.get("Fecha","")))
+                fecha_e = st.text_input("Fecha", value=fecha_txt(fila.get("Fecha","")))
                 cliente_e = st.text_input("Cliente", value=str(fila.get("Cliente","")))
                 caso_e = st.text_input("Expediente", value=str(fila.get("Caso","")))
                 abogado_e = st.text_input("Abogado a cargo", value=str(fila.get("Abogado","")))
@@ -3310,11 +5193,12 @@ if menu == "Consultas":
                         f"Notas: {notas_e}\n"
                     )
                     idx = consultas.index[consultas["ID"] == sel_id][0]
-                    consultas.loc[idx, ["Fecha","Cliente","Caso","Abogado","Consulta","Estrategia","CostoConsulta",
-                                        "HonorariosPropuestos","Proforma","LinkOneDrive","Notas"]] = [
-                        fecha_e, cliente_e, normalize_key(caso_e), abogado_e, consulta_e, estrategia_e,
-                        float(costo_e), float(honor_e), proforma_new, link_e, notas_e
-                    ]
+                    asignar_fila(consultas, idx, {
+                        "Fecha": fecha_e, "Cliente": cliente_e, "Caso": normalize_key(caso_e),
+                        "Abogado": abogado_e, "Consulta": consulta_e, "Estrategia": estrategia_e,
+                        "CostoConsulta": float(costo_e), "HonorariosPropuestos": float(honor_e),
+                        "Proforma": proforma_new, "LinkOneDrive": link_e, "Notas": notas_e
+                    })
                     save_df("consultas", consultas)
                     st.success("✅ Consulta actualizada")
                     st.rerun()
@@ -3544,15 +5428,14 @@ if menu == "Plantillas de Contrato":
             submit = st.form_submit_button("Guardar plantilla")
 
             if submit:
-                new_id = next_id(plantillas)
-                plantillas = add_row(plantillas, {
+                new_id = next_id(plantillas, tabla="plantillas")
+                plantillas = append_row("plantillas", plantillas, {
                     "ID": new_id,
                     "Nombre": nombre,
                     "Contenido": contenido,
                     "Notas": notas,
                     "Creado": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                }, "plantillas")
-                save_df("plantillas", plantillas)
+                })
                 st.success("✅ Plantilla creada")
                 # limpiar borrador
                 st.session_state["tpl_new_contenido"] = ""
@@ -3900,7 +5783,7 @@ if menu == "Usuarios":
                     st.error("Debe seleccionar abogado")
                     st.stop()
 
-                usuarios = add_row(usuarios, {
+                usuarios = append_row("usuarios", usuarios, {
                     "Usuario": usuario,
                     "PasswordHash": sha256(pwd),
                     "Rol": rol,
@@ -3909,9 +5792,7 @@ if menu == "Usuarios":
                     "Creado": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                     "NombreCompleto": nombre if rol != "Abogado" else "",
                     "DNI": dni if rol != "Abogado" else "",
-                }, "usuarios")
-
-                save_df("usuarios", usuarios)
+                })
                 st.success("✅ Usuario creado")
                 st.rerun()
 
@@ -4060,9 +5941,8 @@ try:
         # Resumen económico consolidado (tabla)
         st.divider()
         st.markdown("### 📊 Resumen económico consolidado")
-        if 'resumen_financiero_df' in globals():
-            df_res_local = resumen_financiero_df()
-            st.dataframe(df_res_local, use_container_width=True)
+        df_res_local = libro_financiero_visible()
+        st.dataframe(df_res_local, use_container_width=True)
 except Exception:
     pass
 
@@ -4081,7 +5961,7 @@ def _patch_render_cuota_litis_menu():
         notas = st.text_input("Notas", value="", key="patch_cl_notas")
 
         if st.button("Guardar cuota litis", key="patch_cl_save"):
-            new_id = next_id(cuota_litis)
+            new_id = next_id(cuota_litis, tabla="cuota_litis")
             nueva = {
                 "ID": new_id,
                 "Caso": normalize_key(exp),
@@ -4090,8 +5970,7 @@ def _patch_render_cuota_litis_menu():
                 "Notas": notas,
                 "FechaRegistro": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             }
-            df2 = add_row(cuota_litis, nueva, "cuota_litis")
-            save_df("cuota_litis", df2)
+            df2 = append_row("cuota_litis", cuota_litis, nueva)
             st.success("✅ Cuota litis guardada")
             st.rerun()
 
@@ -4109,7 +5988,7 @@ def _patch_render_cuota_litis_menu():
             submit = st.form_submit_button("Guardar cambios")
             if submit:
                 idx = cuota_litis.index[cuota_litis["ID"] == sel][0]
-                cuota_litis.loc[idx, ["Caso","Monto Base","Porcentaje","Notas"]] = [normalize_key(caso_e), float(base_e), float(porc_e), notas_e]
+                asignar_fila(cuota_litis, idx, {"Caso": normalize_key(caso_e), "Monto Base": float(base_e), "Porcentaje": float(porc_e), "Notas": notas_e})
                 save_df("cuota_litis", cuota_litis)
                 st.success("✅ Actualizado")
                 st.rerun()
@@ -4137,7 +6016,7 @@ def _patch_render_pagos_litis_menu():
         obs = st.text_input("Observación", value="", key="patch_pl_obs")
 
         if st.button("Registrar pago litis", key="patch_pl_save"):
-            new_id = next_id(pagos_litis)
+            new_id = next_id(pagos_litis, tabla="pagos_litis")
             nueva = {
                 "ID": new_id,
                 "Caso": normalize_key(exp),
@@ -4145,8 +6024,7 @@ def _patch_render_pagos_litis_menu():
                 "Monto": float(monto),
                 "Observacion": obs
             }
-            df2 = add_row(pagos_litis, nueva, "pagos_litis")
-            save_df("pagos_litis", df2)
+            df2 = append_row("pagos_litis", pagos_litis, nueva)
             st.success("✅ Pago litis guardado")
             st.rerun()
 
@@ -4158,13 +6036,13 @@ def _patch_render_pagos_litis_menu():
 
         with st.form("patch_pl_edit_form"):
             caso_e = st.text_input("Expediente", value=str(fila["Caso"]), key="patch_pl_caso_e")
-            fecha_e = st.text_input("FechaPago (YYYY-MM-DD)", value=str(fila["FechaPago"]), key="patch_pl_fecha_e")
+            fecha_e = st.text_input("FechaPago (YYYY-MM-DD)", value=fecha_txt(fila["FechaPago"]), key="patch_pl_fecha_e")
             monto_e = st.number_input("Monto", min_value=0.0, value=money(fila["Monto"]), step=50.0, key="patch_pl_monto_e")
             obs_e = st.text_input("Observación", value=str(fila["Observacion"]), key="patch_pl_obs_e")
             submit = st.form_submit_button("Guardar cambios")
             if submit:
                 idx = pagos_litis.index[pagos_litis["ID"] == sel][0]
-                pagos_litis.loc[idx, :] = [sel, normalize_key(caso_e), fecha_e, float(monto_e), obs_e]
+                asignar_fila(pagos_litis, idx, {"Caso": normalize_key(caso_e), "FechaPago": fecha_e, "Monto": float(monto_e), "Observacion": obs_e})
                 save_df("pagos_litis", pagos_litis)
                 st.success("✅ Actualizado")
                 st.rerun()
@@ -4186,36 +6064,91 @@ def _patch_reporte_por_abogado():
     if casos.empty:
         st.info("No hay casos registrados.")
         return
-    df_res = resumen_financiero_df() if 'resumen_financiero_df' in globals() else pd.DataFrame()
-    if df_res.empty:
+    # cubo ya sumado (abogado × materia × mes): filtrar y agrupar es instantáneo
+    cubo = reporte_agregado()
+    if cubo.empty:
         st.info("No hay datos financieros aún.")
         return
 
-    # unir abogado
-    dfm = df_res.merge(casos[["Expediente","Abogado"]], on="Expediente", how="left")
-
-    rep_ab = dfm.groupby("Abogado", as_index=False).agg({
-        "Honorario Pactado":"sum",
-        "Honorario Pagado":"sum",
-        "Honorario Pendiente":"sum",
-        "Saldo Litis":"sum"
-    })
-
-    st.dataframe(rep_ab, use_container_width=True)
+    meses = sorted(m for m in cubo["Mes"].unique() if m != finanzas.SIN_MES)
+    c_p1, c_p2, c_p3 = st.columns(3)
+    with c_p1:
+        desde = st.selectbox("Desde (mes)", meses, index=0, key="rep_cubo_desde") if meses else None
+    with c_p2:
+        hasta = st.selectbox("Hasta (mes)", meses, index=len(meses) - 1, key="rep_cubo_hasta") if meses else None
+    with c_p3:
+        materias = st.multiselect("Materia", sorted(cubo["Materia"].unique()), key="rep_cubo_materias")
+    sin_fecha = st.checkbox("Incluir movimientos sin fecha", value=True, key="rep_cubo_sin_fecha")
+    if desde and hasta and desde > hasta:
+        st.warning("⚠️ 'Desde' es posterior a 'Hasta'")
+
+    sel = finanzas.filtrar_cubo(cubo, desde, hasta, materias, sin_fecha)
+    cerrados = [m for m in meses_cerrados() if (not desde or m >= desde) and (not hasta or m <= hasta)]
+    if cerrados:
+        st.caption("🔒 Meses cerrados (se muestra su cierre): " + ", ".join(cerrados))
+        dif_cierre = diferencias_cierres()
+        dif_cierre = dif_cierre[dif_cierre["Mes"].isin(cerrados)]
+        if not dif_cierre.empty:
+            st.warning(f"⚠️ {dif_cierre['Caso'].nunique()} casos cambiaron después del cierre de su mes")
+            with st.expander("Ver cambios posteriores al cierre"):
+                st.dataframe(dif_cierre, use_container_width=True, hide_index=True)
+    rep_ab = sel.groupby("Abogado", as_index=False)[finanzas.CONCEPTOS_CUBO].sum()
+
+    # lo pendiente es a hoy (no depende del período)
+    dfm = libro_financiero().merge(casos[["Expediente", "Abogado"]], on="Expediente", how="left")
+    pend = dfm.groupby("Abogado", as_index=False)[["Honorario Pendiente", "Saldo Litis"]].sum()
+    rep_ab = rep_ab.merge(pend, on="Abogado", how="left").fillna({"Honorario Pendiente": 0.0, "Saldo Litis": 0.0})
+
+    st.caption("Montos del período seleccionado · Pendiente y saldo litis: a la fecha")
+    st.dataframe(rep_ab, use_container_width=True, hide_index=True)
     st.download_button("⬇️ Descargar reporte por abogado (CSV)", rep_ab.to_csv(index=False).encode("utf-8"), "reporte_por_abogado.csv")
 
     st.divider()
     st.markdown("#### Detalle de casos por abogado")
-    abogados_disp = [a for a in rep_ab["Abogado"].dropna().tolist() if str(a).strip() != ""]
+    abogados_disp = [a for a in rep_ab["Abogado"].tolist() if str(a).strip() != ""]
     if not abogados_disp:
         st.info("No hay abogado asociado en los casos.")
         return
 
     ab_sel = st.selectbox("Selecciona abogado", abogados_disp, key="patch_ab_sel")
-    det = dfm[dfm["Abogado"] == ab_sel].copy()
-    st.dataframe(det, use_container_width=True)
+    det = finanzas.filtrar_cubo(reporte_detalle(), desde, hasta, materias, sin_fecha, abogado=ab_sel)
+    det = det.groupby(["Caso", "Materia"], as_index=False)[finanzas.CONCEPTOS_CUBO].sum()
+    st.dataframe(det, use_container_width=True, hide_index=True)
     st.download_button("⬇️ Descargar detalle abogado (CSV)", det.to_csv(index=False).encode("utf-8"), f"reporte_detalle_{ab_sel}.csv")
 
+
+def _patch_carga_asignaciones():
+    st.markdown("### 🗂️ Carga de trabajo por persona")
+    carga = carga_de_trabajo()
+    if carga.empty:
+        st.info("No hay asignaciones vigentes.")
+        return
+    st.caption("Casos con asignación vigente (principal, defensa conjunta o delegado)")
+    st.dataframe(carga, use_container_width=True, hide_index=True)
+    st.download_button("⬇️ Descargar carga de trabajo (CSV)", carga.to_csv(index=False).encode("utf-8"), "carga_de_trabajo.csv", key="carga_csv")
+
+
+def _patch_libro_periodo():
+    st.markdown("### 📒 Libro diario del período")
+    c_l1, c_l2 = st.columns(2)
+    with c_l1:
+        l_desde = st.date_input("Desde", value=date.today().replace(day=1), key="libro_desde")
+    with c_l2:
+        l_hasta = st.date_input("Hasta", value=date.today(), key="libro_hasta")
+    desde_txt = l_desde.isoformat() if l_desde else None
+    hasta_txt = l_hasta.isoformat() if l_hasta else None
+
+    tot = totales_libro(desde_txt, hasta_txt)
+    if tot.empty:
+        st.info("Sin asientos en el período.")
+        return
+    st.dataframe(tot, use_container_width=True, hide_index=True)
+    lineas = finanzas.libro_del_periodo(_indice_libro(), desde_txt, hasta_txt)
+    st.download_button(
+        "⬇️ Descargar asientos del período (CSV)", lineas.to_csv(index=False).encode("utf-8"),
+        f"libro_diario_{desde_txt}_{hasta_txt}.csv", key="libro_csv",
+    )
+
 # ----------------------------------------------------------
 # Activación “sin tocar tu código”: si el menú coincide, muestra el bloque
 # ----------------------------------------------------------
@@ -4235,6 +6168,10 @@ try:
     if 'menu' in globals() and menu == "Reportes":
         st.divider()
         _patch_reporte_por_abogado()
+        st.divider()
+        _patch_carga_asignaciones()
+        st.divider()
+        _patch_libro_periodo()
 except Exception:
     pass
 
@@ -4246,9 +6183,9 @@ except Exception:
 
 def _audit_log(accion, entidad='', entidad_id='', detalle=''):
     try:
-        df = load_df('auditoria_mod')
-        new_id = next_id(df)
-        df = add_row(df, {
+        df = load_df('auditoria_mod', columns=['ID'])
+        new_id = next_id(df, tabla='auditoria_mod')
+        df = append_row('auditoria_mod', df, {
             'ID': new_id,
             'Fecha': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             'Usuario': st.session_state.get('usuario',''),
@@ -4257,8 +6194,7 @@ def _audit_log(accion, entidad='', entidad_id='', detalle=''):
             'Entidad': entidad,
             'EntidadID': str(entidad_id),
             'Detalle': detalle
-        }, 'auditoria_mod')
-        save_df('auditoria_mod', df)
+        })
     except Exception:
         pass
 
@@ -4271,22 +6207,8 @@ def _is_readonly():
 
 
 def _filter_cases_by_role(df_casos):
-    # Abogado: solo sus casos (match por nombre de abogado)
-    if st.session_state.get('rol') == 'abogado':
-        user = st.session_state.get('usuario','')
-        # si existe abogados.csv y abogado_id, intentamos mapear a Nombre
-        ab_name = None
-        try:
-            if 'abogados' in globals() and not abogados.empty:
-                # Si el usuario tiene abogado_id, usarlo
-                aid = st.session_state.get('abogado_id','')
-                if str(aid).strip() and (abogados['ID'].astype(str) == str(aid)).any():
-                    ab_name = abogados[abogados['ID'].astype(str)==str(aid)].iloc[0].get('Nombre','')
-        except Exception:
-            pass
-        name = ab_name if ab_name else user
-        return df_casos[df_casos['Abogado'].astype(str) == str(name)].copy()
-    return df_casos
+    # misma regla que el resto de la app (expedientes del perfil de sesión)
+    return filtrar_casos_por_rol(df_casos)
 
 # Aplicar filtro visual a casos y tablas dependientes
 try:
@@ -4445,8 +6367,8 @@ if menu == "Instancias":
             submit = st.form_submit_button("Guardar instancia")
 
             if submit:
-                new_id = next_id(df_i)
-                df_i = add_row(df_i, {
+                new_id = next_id(df_i, tabla="instancias")
+                df_i = append_row("instancias", df_i, {
                     "ID": new_id,
                     "Caso": exp_n,
                     "TipoInstancia": tipo,
@@ -4457,8 +6379,7 @@ if menu == "Instancias":
                     "SedeAdministrativa": sede_admin,
                     "CosaDecidida": cosa_decidida,
                     "FechaCosaDecidida": fecha_cosa
-                }, "instancias")
-                save_df("instancias", df_i)
+                })
                 st.success("✅ Instancia registrada")
                 st.rerun()
 
@@ -4565,9 +6486,10 @@ try:
             sede = st.text_input('Sede registral', value=str(fila.get('SedeRegistral','')))
             if st.button('💾 Guardar extendido', disabled=_is_readonly()):
                 idx = clientes.index[clientes['ID'] == sel][0]
-                clientes.loc[idx, ['TipoCliente','ContactoEmergencia','CelularEmergencia','RazonSocial','RUC','RepresentanteLegal','PartidaElectronica','SedeRegistral']] = [
-                    tipo, contacto, cel_cont, rs, ruc, rep, partida, sede
-                ]
+                asignar_fila(clientes, idx, dict(zip(
+                    ['TipoCliente','ContactoEmergencia','CelularEmergencia','RazonSocial','RUC','RepresentanteLegal','PartidaElectronica','SedeRegistral'],
+                    [tipo, contacto, cel_cont, rs, ruc, rep, partida, sede]
+                )))
                 save_df('clientes', clientes)
                 _audit_log('UPDATE','clientes',sel,'extendido')
                 st.success('✅ Guardado')
@@ -4575,48 +6497,180 @@ try:
 except Exception:
     pass
 # ==========================================================
-# PARCHE SQLITE – SINCRONIZACIÓN CSV ↔ SQLITE (NO OBLIGATORIO)
+# PARCHE SQLITE – SINCRONIZACIÓN CSV ↔ SQLITE
+# (el motor activo se elige con STORAGE_BACKEND en secrets)
 # ==========================================================
-import sqlite3
-
-SQLITE_DB = "data.db"
-
 def csv_to_sqlite():
-    conn = sqlite3.connect(SQLITE_DB)
-    for key, path in FILES.items():
+    be = _backend_sqlite(SQLITE_DB)
+    for key in FILES:
         try:
-            df = load_df(key)
-            df.to_sql(key, conn, if_exists="replace", index=False)
+            be.importar_csv(key)
         except Exception as e:
             st.warning(f"No se pudo exportar {key}: {e}")
-    conn.close()
+    invalidar_cache()
 
 def sqlite_to_csv():
-    conn = sqlite3.connect(SQLITE_DB)
-    cur = conn.cursor()
-    tables = cur.execute(
-        "SELECT name FROM sqlite_master WHERE type='table'"
-    ).fetchall()
-
-    for (table,) in tables:
+    be = _backend_sqlite(SQLITE_DB)
+    for key in FILES:
         try:
-            df = pd.read_sql(f"SELECT * FROM {table}", conn)
-            if table in FILES:
-                df.to_csv(FILES[table], index=False)
+            if be.existe(key):
+                with _bloqueo_tabla(key):
+                    _escribir_csv_atomico(FILES[key], be.leer(key))
         except Exception as e:
-            st.warning(f"No se pudo importar {table}: {e}")
-    conn.close()
+            st.warning(f"No se pudo importar {key}: {e}")
+    invalidar_cache()
 
 # UI mínima (oculta, segura)
 with st.sidebar.expander("🗄️ Base de Datos (SQLite)", expanded=False):
-    st.caption("CSV sigue siendo la fuente principal")
+    if STORAGE_BACKEND == "sqlite":
+        st.caption(f"Motor activo: SQLite (WAL) – {SQLITE_DB} es la fuente principal")
+        confirmar_sql = st.checkbox("Reemplazar la base con los CSV", key="sqlite_reemplazar_ok")
+    else:
+        st.caption("CSV sigue siendo la fuente principal")
+        confirmar_sql = True
+
     if st.button("⬆️ Exportar CSV → SQLite"):
-        csv_to_sqlite()
-        st.success("✅ CSV exportado a SQLite (data.db)")
+        if not confirmar_sql:
+            st.error("❌ Marca la confirmación: se reemplazarán las tablas de la base")
+        else:
+            csv_to_sqlite()
+            st.success(f"✅ CSV exportado a SQLite ({SQLITE_DB})")
 
     if st.button("⬇️ Importar SQLite → CSV"):
         sqlite_to_csv()
         st.success("✅ SQLite importado a CSV")
+
+# Métrica de espera por bloqueos de escritura (solo admin)
+if str(st.session_state.get("rol", "")).strip().lower() == "admin":
+    with st.sidebar.expander("🔒 Escrituras concurrentes", expanded=False):
+        st.caption("Bloqueo por tabla: " + ("fcntl (entre procesos)" if fcntl is not None else "solo dentro del proceso"))
+        df_bloq = metricas_bloqueo()
+        if df_bloq.empty:
+            st.info("Sin escrituras registradas en este proceso.")
+        else:
+            st.dataframe(df_bloq, use_container_width=True, hide_index=True)
+
+# ==========================================================
+# PARCHE RESPALDOS – VERSIONES Y RESTAURACIÓN
+# (por consola: python respaldos.py listar / restaurar <tabla> <hash>)
+# ==========================================================
+def restaurar_tabla(key: str, h: str):
+    """Reemplaza la tabla por la versión `h` (respalda antes la actual)."""
+    alm = almacen_respaldos()
+    r = alm.buscar(key, h)
+    if r is None:
+        raise KeyError(f"No hay una versión '{h}' de '{key}'")
+    data = alm.leer(r["Hash"])
+    be = storage()
+    with _bloqueo_tabla(key):
+        if be.nombre == "csv":
+            backup_file(FILES[key], motivo="antes de restaurar")
+            respaldos.escribir_atomico(FILES[key], data)
+        else:
+            be.respaldar(key)
+            try:
+                df = drop_unnamed(pd.read_csv(BytesIO(data)))
+            except pd.errors.EmptyDataError:
+                df = pd.DataFrame(columns=SCHEMAS.get(key, ["ID"]))
+            be.crear_tabla(key, _migrar_df(key, df))
+    invalidar_cache(key)
+
+
+if str(st.session_state.get("rol", "")).strip().lower() == "admin":
+    with st.sidebar.expander("🗂️ Respaldos", expanded=False):
+        alm = almacen_respaldos()
+        tablas_resp = [k for k in alm.tablas() if k in FILES]
+        if not tablas_resp:
+            st.info("Aún no hay respaldos registrados.")
+        else:
+            t_resp = st.selectbox("Tabla", tablas_resp, key="resp_tabla")
+            vers = pd.DataFrame(alm.versiones(t_resp), columns=respaldos.CATALOGO_COLS)
+            vers["Hash"] = vers["Hash"].str[:12]
+            st.dataframe(vers[["Fecha", "Hash", "Bytes", "Motivo"]], use_container_width=True, hide_index=True)
+
+            h_resp = st.selectbox("Versión", vers["Hash"].tolist(), key="resp_hash",
+                                  format_func=lambda h: f"{vers.loc[vers['Hash'] == h, 'Fecha'].iloc[0]} – {h}")
+            if h_resp:
+                r_sel = alm.buscar(t_resp, h_resp)
+                st.download_button(
+                    "⬇️ Descargar esta versión",
+                    data=alm.leer(r_sel["Hash"]),
+                    file_name=f"{t_resp}.{h_resp}.csv",
+                    mime="text/csv",
+                    key="resp_descargar",
+                )
+                ok_resp = st.checkbox("Reemplazar la tabla actual por esta versión", key="resp_ok")
+                if st.button("♻️ Restaurar", key="resp_restaurar"):
+                    if not ok_resp:
+                        st.error("❌ Marca la confirmación: la tabla actual se reemplazará (queda respaldada)")
+                    else:
+                        restaurar_tabla(t_resp, h_resp)
+                        _audit_log("RESTORE", t_resp, h_resp, "respaldo")
+                        st.success(f"✅ '{t_resp}' restaurada a la versión {h_resp}")
+                        st.rerun()
+
+        c_r1, c_r2 = st.columns(2)
+        with c_r1:
+            if st.button("🧹 Podar ahora", key="resp_podar"):
+                res = alm.podar()
+                st.success(f"✅ {res['versiones']} versiones y {res['blobs']} archivos eliminados")
+        with c_r2:
+            if st.button("📥 Importar .bak antiguos", key="resp_legado"):
+                n_leg = alm.importar_legado(FILES)
+                st.success(f"✅ {n_leg} respaldos antiguos importados")
+        st.caption(f"Retención: 1 por hora durante {BACKUP_RETENCION_HORAS} h, 1 por día durante {BACKUP_RETENCION_DIAS} días")
+
+    with st.sidebar.expander("🧮 Tablas derivadas", expanded=False):
+        st.caption("Se actualizan solas con cada caso, pago, honorario, cuota litis, actuación o consulta")
+        t_der = st.selectbox("Tabla", list(TABLAS_DERIVADAS), key="der_tabla")
+        st.caption("Sello de fuentes: " + ("✅ al día" if derivada_al_dia(t_der) else "⚠️ desfasado (se reconstruye al leer)"))
+        c_s1, c_s2 = st.columns(2)
+        with c_s1:
+            if st.button("🔎 Verificar", key="saldos_verificar"):
+                dif_der = verificar_derivada(t_der)
+                if dif_der.empty:
+                    st.success("✅ Sin diferencias con el recálculo completo")
+                else:
+                    st.error(f"❌ {dif_der['Caso'].nunique()} casos con diferencias")
+                    st.dataframe(dif_der, use_container_width=True, hide_index=True)
+        with c_s2:
+            if st.button("🔁 Reconstruir", key="saldos_reconstruir"):
+                n_der = len(reconstruir_derivada(t_der))
+                _audit_log("REBUILD", t_der, "", f"{n_der} filas")
+                st.success(f"✅ '{t_der}' reconstruida ({n_der} filas)")
+
+    with st.sidebar.expander("🔒 Cierre mensual", expanded=False):
+        st.caption("Congela los totales por caso y abogado de un mes terminado; Reportes usa esa foto")
+        pendientes_cierre = meses_cerrables()
+        if pendientes_cierre:
+            mes_cierre = st.selectbox("Mes a cerrar", pendientes_cierre, key="cierre_mes")
+            if st.button("🔒 Cerrar mes", key="cierre_cerrar"):
+                try:
+                    n_cierre = cerrar_mes(mes_cierre)
+                except ValueError as e:
+                    st.error(f"❌ {e}")
+                else:
+                    _audit_log("CIERRE", "cierres", mes_cierre, f"{n_cierre} filas")
+                    st.success(f"✅ {mes_cierre} cerrado ({n_cierre} filas)")
+        else:
+            st.info("No hay meses terminados por cerrar.")
+
+        cerrados_adm = meses_cerrados()
+        if cerrados_adm:
+            dif_adm = diferencias_cierres()
+            st.dataframe(pd.DataFrame({
+                "Mes": cerrados_adm,
+                "Casos con cambios": [dif_adm.loc[dif_adm["Mes"] == m, "Caso"].nunique() for m in cerrados_adm],
+            }), use_container_width=True, hide_index=True)
+            alertas_adm = load_df("cierres_alertas")
+            if not alertas_adm.empty:
+                st.caption("Últimas ediciones sobre meses cerrados")
+                st.dataframe(alertas_adm.tail(20).iloc[::-1], use_container_width=True, hide_index=True)
+            mes_rec = st.selectbox("Volver a cerrar (acepta los cambios)", cerrados_adm, key="cierre_rec_mes")
+            if st.button("🔁 Volver a cerrar", key="cierre_recerrar"):
+                n_cierre = cerrar_mes(mes_rec, recerrar=True)
+                _audit_log("RECIERRE", "cierres", mes_rec, f"{n_cierre} filas")
+                st.success(f"✅ {mes_rec} vuelto a cerrar ({n_cierre} filas)")
 # ==========================================================
 # PARCHE WORD – DESCARGAR CONTRATOS EN .DOCX
 # ==========================================================
@@ -4656,6 +6710,9 @@ def _repo_fix_ids(df: pd.DataFrame) -> pd.DataFrame:
     ids = pd.to_numeric(df['ID'], errors='coerce')
     max_id = int(ids.dropna().max()) if ids.notna().any() else 0
     bad = ids.isna() | (ids <= 0)
+    if bad.any():
+        # bloque de la secuencia (repo_contratos no es tabla de FILES: piso explícito)
+        max_id = storage().reservar_ids('repo_contratos', int(bad.sum()), piso=max_id) - 1
     for i in df.index[bad].tolist():
         max_id += 1
         df.at[i, 'ID'] = max_id
@@ -4854,7 +6911,8 @@ def _repo_sync_contratos():
     ids = pd.to_numeric(repo.get('ID', pd.Series(dtype='float')), errors='coerce')
     max_id = ids.dropna().max()
     max_id = 0 if pd.isna(max_id) else int(max_id)
-    nid = max_id + 1
+    n_nuevos = sum(1 for r in scanned if r['Archivo'] not in existing)
+    nid = storage().reservar_ids('repo_contratos', n_nuevos, piso=max_id) if n_nuevos else max_id + 1
 
     # Nuevos siempre entran como HISTÓRICO (Opción C)
     new_rows = []
@@ -0,0 +1,230 @@
+# asignaciones.py
+# Quién lleva cada caso (solo pandas, sin Streamlit)
+#
+# casos.Abogado / AbogadosExtra / Delegados siguen siendo la fuente de verdad:
+# es lo que edita el formulario de Casos, y asignaciones_caso es una tabla
+# derivada de esos textos (save_df de casos la actualiza en el mismo
+# bloqueo; la reconstrucción la concilia con ellos). Editar
+# asignaciones_caso a mano no cambia quién lleva el caso: se revierte en la
+# siguiente conciliación. Aquí se pasan a filas (Caso, Persona, Rol, Desde, Hasta):
+# - Rol: Principal (abogado a cargo), Conjunto (defensa conjunta, por
+#   nombre) o Delegado (por usuario)
+# - Una asignación vigente tiene Hasta vacío; al quitarla se cierra con la
+#   fecha del cambio (el historial no se borra)
+# - indexar() arma los índices por caso y por persona: "mis casos",
+#   carga de trabajo y permisos son búsquedas en un dict
+
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from finanzas import normalizar_caso
+
+ROLES = ["Principal", "Conjunto", "Delegado"]
+COLUMNAS_CASO = {"Abogado": "Principal", "AbogadosExtra": "Conjunto", "Delegados": "Delegado"}
+ASIGNACION_COLS = ["ID", "Caso", "Persona", "Rol", "Desde", "Hasta"]
+CLAVES = ["Caso", "Clave", "Rol"]
+
+
+def _vacio(df) -> bool:
+    return df is None or getattr(df, "empty", True)
+
+
+def _texto(df: pd.DataFrame, col: str) -> pd.Series:
+    if col not in df.columns:
+        return pd.Series("", index=df.index, dtype=object)
+    return df[col].astype(object).where(df[col].notna(), "").astype(str).str.strip()
+
+
+def clave_persona(s: pd.Series) -> pd.Series:
+    """Nombre / usuario comparable: sin mayúsculas ni espacios de más ("Ana" != "Ana María")."""
+    return s.astype(object).where(s.notna(), "").astype(str).str.split().str.join(" ").str.casefold()
+
+
+def _fecha(df: pd.DataFrame, col: str) -> pd.Series:
+    if col not in df.columns:
+        return pd.Series("", index=df.index, dtype=object)
+    f = pd.to_datetime(df[col].astype(object).where(df[col].notna()), errors="coerce", format="mixed")
+    return f.dt.strftime("%Y-%m-%d").fillna("").astype(object)
+
+
+def _con_clave(df: pd.DataFrame) -> pd.DataFrame:
+    return df.assign(Caso=normalizar_caso(df["Caso"]), Clave=clave_persona(df["Persona"]), Rol=_texto(df, "Rol"))
+
+
+def esperadas(casos: pd.DataFrame) -> pd.DataFrame:
+    """Asignaciones que dicen hoy los campos de `casos` (Desde = FechaInicio del caso)."""
+    cols = ["Caso", "Persona", "Rol", "Desde"]
+    if _vacio(casos) or "Expediente" not in casos.columns:
+        return pd.DataFrame(columns=cols)
+    exp = normalizar_caso(casos["Expediente"])
+    inicio = _fecha(casos, "FechaInicio")
+    partes = []
+    for col, rol in COLUMNAS_CASO.items():
+        if col not in casos.columns:
+            continue
+        personas = _texto(casos, col).str.split("|") if rol != "Principal" else _texto(casos, col).map(lambda x: [x])
+        partes.append(pd.DataFrame({"Caso": exp.values, "Persona": personas.values, "Rol": rol, "Desde": inicio.values}))
+    if not partes:
+        return pd.DataFrame(columns=cols)
+    out = pd.concat(partes, ignore_index=True).explode("Persona")
+    out["Persona"] = out["Persona"].astype(object).where(out["Persona"].notna(), "").astype(str).str.strip()
+    out = out[(out["Caso"] != "") & (out["Persona"] != "")]
+    out = _con_clave(out).drop_duplicates(CLAVES)
+    return out[cols].reset_index(drop=True)
+
+
+def vigentes(df: pd.DataFrame, fecha=None) -> pd.DataFrame:
+    """Asignaciones abiertas (o vigentes en `fecha`, AAAA-MM-DD)."""
+    if _vacio(df):
+        return pd.DataFrame(columns=ASIGNACION_COLS)
+    df = df.reindex(columns=ASIGNACION_COLS)
+    hasta = _texto(df, "Hasta")
+    if fecha is None:
+        return df[hasta == ""]
+    desde = _texto(df, "Desde")
+    return df[(desde <= str(fecha)) & ((hasta == "") | (hasta >= str(fecha)))]
+
+
+def _comparar(nuevo: pd.DataFrame, previo: pd.DataFrame) -> pd.DataFrame:
+    """+1: asignación que aparece, -1: la que se quita (por Caso + persona + rol)."""
+    cols = ["Caso", "Persona", "Rol", "Desde", "Cambio"]
+    nuevo = _con_clave(nuevo.reindex(columns=["Caso", "Persona", "Rol", "Desde"]))
+    previo = _con_clave(previo.reindex(columns=["Caso", "Persona", "Rol", "Desde"]))
+    c = nuevo.merge(previo[CLAVES + ["Persona"]], on=CLAVES, how="outer", suffixes=("", "_previo"), indicator=True)
+    c["Persona"] = c["Persona"].fillna(c["Persona_previo"])
+    c["Desde"] = c["Desde"].fillna("")
+    c["Cambio"] = np.where(c["_merge"] == "left_only", 1, np.where(c["_merge"] == "right_only", -1, 0))
+    return c[c["Cambio"] != 0][cols].reset_index(drop=True)
+
+
+class AsignacionesCaso:
+    """
+    Misma interfaz que finanzas.TablaDerivada para app.py (fuentes / delta /
+    aplicar / desde_tablas / diferencias), pero lo quitado se cierra con
+    Hasta en vez de borrarse: la reconstrucción concilia lo vigente.
+    """
+    solo_agregar = False
+    con_historial = True
+
+    def __init__(self):
+        self.fuentes = ["casos"]
+        self.claves = ["ID"]
+        self.columnas = ASIGNACION_COLS
+
+    def delta(self, tabla: str, antes, despues: pd.DataFrame) -> pd.DataFrame:
+        """Asignaciones que se abren (+1) / cierran (-1) al pasar casos de `antes` (None: filas nuevas) a `despues`."""
+        return _comparar(esperadas(despues), esperadas(antes))
+
+    def desde_tablas(self, tablas: dict) -> pd.DataFrame:
+        """Lo que debería estar vigente según casos (sin ID ni Hasta)."""
+        return esperadas(tablas.get("casos"))
+
+    def aplicar(self, actual: pd.DataFrame, delta: pd.DataFrame, hoy=None, reservar=None) -> pd.DataFrame:
+        """
+        reservar(n, piso) -> primer ID de n nuevos (la secuencia de la tabla
+        en app.py); sin reservar, mayor ID + 1.
+        """
+        hoy = str(hoy or date.today())
+        actual = pd.DataFrame(columns=ASIGNACION_COLS) if _vacio(actual) else actual.reindex(columns=ASIGNACION_COLS)
+        actual = actual.assign(Hasta=_texto(actual, "Hasta"))
+        if _vacio(delta):
+            return actual.reset_index(drop=True)
+        llave = pd.MultiIndex.from_frame(_con_clave(actual)[CLAVES])
+        abiertas = (actual["Hasta"] == "").values
+        d = _con_clave(delta)
+
+        quitar = pd.MultiIndex.from_frame(d[d["Cambio"] < 0][CLAVES])
+        actual.loc[abiertas & llave.isin(quitar), "Hasta"] = hoy
+
+        nuevas = d[d["Cambio"] > 0]
+        ya_abiertas = pd.MultiIndex.from_frame(_con_clave(actual[actual["Hasta"] == ""])[CLAVES])
+        nuevas = nuevas[~pd.MultiIndex.from_frame(nuevas[CLAVES]).isin(ya_abiertas)]
+        if nuevas.empty:
+            return actual.reset_index(drop=True)
+        # caso sin historial (alta o migración): desde el inicio del caso; si no, desde hoy
+        conocido = nuevas["Caso"].isin(set(normalizar_caso(actual["Caso"])))
+        desde = nuevas["Desde"].astype(str).where(~conocido & (nuevas["Desde"].astype(str) != ""), hoy)
+        ultimo = pd.to_numeric(actual["ID"], errors="coerce").max()
+        ultimo = int(ultimo) if pd.notna(ultimo) else 0
+        primero = reservar(len(nuevas), ultimo) if reservar is not None else ultimo + 1
+        filas = pd.DataFrame({
+            "ID": np.arange(primero, primero + len(nuevas)),
+            "Caso": nuevas["Caso"].values,
+            "Persona": nuevas["Persona"].values,
+            "Rol": nuevas["Rol"].values,
+            "Desde": desde.values,
+            "Hasta": "",
+        })
+        if actual.empty:
+            return filas
+        return pd.concat([actual, filas], ignore_index=True)
+
+    def conciliar(self, actual: pd.DataFrame, esperado: pd.DataFrame, hoy=None, reservar=None) -> pd.DataFrame:
+        """Abre / cierra lo necesario para que lo vigente sea `esperado` (conserva el historial)."""
+        return self.aplicar(actual, _comparar(esperado, vigentes(actual)), hoy, reservar)
+
+    def diferencias(self, actual: pd.DataFrame, esperado: pd.DataFrame) -> pd.DataFrame:
+        cols = ["Caso", "Persona", "Rol", "Diferencia"]
+        c = _comparar(esperado, vigentes(actual))
+        c["Diferencia"] = np.where(c["Cambio"] > 0, "Falta en asignaciones", "Vigente que ya no está en casos")
+        return c.reindex(columns=cols)
+
+
+ASIGNACIONES = AsignacionesCaso()
+
+
+def indexar(df: pd.DataFrame) -> dict:
+    """
+    por_caso: Caso -> posiciones (iloc) de todas sus asignaciones (con historial)
+    por_persona: (Rol, clave de persona) -> frozenset de casos con asignación vigente
+    """
+    if _vacio(df):
+        return {"tabla": pd.DataFrame(columns=ASIGNACION_COLS), "por_caso": {}, "por_persona": {}}
+    df = df.reindex(columns=ASIGNACION_COLS).reset_index(drop=True)
+    df = df.assign(Desde=_texto(df, "Desde"), Hasta=_texto(df, "Hasta"))
+    k = _con_clave(df)
+    por_caso = df.groupby(k["Caso"].values, sort=False).indices
+    abiertas = k[df["Hasta"] == ""]
+    por_persona = abiertas.groupby(["Rol", "Clave"])["Caso"].agg(frozenset).to_dict()
+    return {"tabla": df, "por_caso": por_caso, "por_persona": por_persona}
+
+
+def del_caso(indice: dict, caso) -> pd.DataFrame:
+    """Asignaciones del caso (vigentes primero, luego las cerradas más recientes)."""
+    pos = indice["por_caso"].get(normalizar_caso(pd.Series([caso])).iloc[0])
+    if pos is None:
+        return indice["tabla"].iloc[0:0]
+    df = indice["tabla"].iloc[pos]
+    orden = df.assign(_abierta=df["Hasta"] == "")
+    return df.loc[orden.sort_values(["_abierta", "Hasta", "Desde"], ascending=False, kind="stable").index]
+
+
+def casos_de(indice: dict, persona: str, roles=None) -> frozenset:
+    """Casos con asignación vigente de `persona` (nombre o usuario) en `roles` (todos si None)."""
+    clave = clave_persona(pd.Series([persona])).iloc[0]
+    if not clave:
+        return frozenset()
+    casos = set()
+    for rol in (roles or ROLES):
+        casos |= indice["por_persona"].get((rol, clave), frozenset())
+    return frozenset(casos)
+
+
+def carga_por_persona(df: pd.DataFrame, casos: pd.DataFrame = None) -> pd.DataFrame:
+    """Casos vigentes por persona y rol (y cuántos de ellos siguen activos, si se pasa `casos`)."""
+    cols = ["Persona"] + ROLES + ["Total"]
+    v = vigentes(df)
+    if v.empty:
+        return pd.DataFrame(columns=cols + (["Activos"] if casos is not None else []))
+    k = _con_clave(v)
+    # nombre a mostrar: el primero con que aparece la persona
+    nombre = k.drop_duplicates("Clave").set_index("Clave")["Persona"]
+    t = pd.crosstab(k["Clave"], k["Rol"]).reindex(columns=ROLES, fill_value=0).rename_axis(columns=None)
+    t["Total"] = k.groupby("Clave")["Caso"].nunique()
+    if casos is not None and not _vacio(casos) and "Expediente" in casos.columns:
+        activos = set(normalizar_caso(casos["Expediente"])[_texto(casos, "EstadoCaso").isin(["", "Activo"])])
+        t["Activos"] = k[k["Caso"].isin(activos)].groupby("Clave")["Caso"].nunique().reindex(t.index, fill_value=0)
+    t.insert(0, "Persona", nombre.reindex(t.index).values)
+    return t.sort_values("Total", ascending=False, kind="stable").reset_index(drop=True)
@@ -0,0 +1,335 @@
+# bench_finanzas.py
+# Benchmark de finanzas.py con datos sintéticos (no toca los CSV del estudio)
+#
+# Uso:
+#   python bench_finanzas.py                      (10k casos / 200k pagos)
+#   python bench_finanzas.py --casos 2000 --pagos 40000
+#   python bench_finanzas.py --legado 1000        (compara con el cálculo fila a fila
+#                                                  anterior sobre 1000 casos; 0 = omitir)
+#   python bench_finanzas.py --cuotas 100000      (asignación de pagos a cuotas)
+#   python bench_finanzas.py --diferencial 1000   (N escenarios al azar contra el cálculo anterior)
+#   python bench_finanzas.py --antiguedad 50000   (estado de cuotas + antigüedad 0-30/31-60/61-90/90+)
+#   python bench_finanzas.py --derivadas 60       (saldos / cubo: aplicar o agregar diferencias fila a fila = reconstruir;
+#                                                  tablas de 1, 2, 3, 4... filas)
+
+import argparse
+import time
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+import finanzas
+
+
+def datos_sinteticos(n_casos: int, n_pagos: int, seed: int = 7) -> dict:
+    rnd = np.random.default_rng(seed)
+    exps = np.array([f"{i:05d}-2024-CI" for i in range(1, n_casos + 1)], dtype=object)
+
+    def casos_al_azar(n):
+        return exps[rnd.integers(0, n_casos, n)]
+
+    def montos(n, hasta):
+        m = rnd.integers(0, hasta, n).astype("float64")
+        m[rnd.random(n) < 0.01] = np.nan  # algunos vacíos, como en los CSV reales
+        return m
+
+    n_et = n_casos // 3
+    n_pl = max(1, n_pagos // 10)
+    return {
+        "casos": pd.DataFrame({
+            "ID": np.arange(1, n_casos + 1),
+            "Expediente": exps,
+            "Cliente": [f"Cliente {i % 500}" for i in range(n_casos)],
+            "Materia": rnd.choice(["Civil", "Laboral", "Penal"], n_casos),
+            "Abogado": [f"Abogado {i % 40}" for i in range(n_casos)],
+        }),
+        "honorarios": pd.DataFrame({"Caso": exps, "Monto Pactado": montos(n_casos, 20000)}),
+        "honorarios_etapas": pd.DataFrame({
+            "Caso": casos_al_azar(n_et), "Etapa": "Primera instancia", "Monto Pactado": montos(n_et, 5000),
+        }),
+        "pagos_honorarios": pd.DataFrame({"Caso": casos_al_azar(n_pagos), "Monto": montos(n_pagos, 800)}),
+        "cuota_litis": pd.DataFrame({
+            "Caso": casos_al_azar(n_casos // 5),
+            "Monto Base": montos(n_casos // 5, 100000),
+            "Porcentaje": rnd.integers(5, 30, n_casos // 5).astype("float64"),
+        }),
+        "pagos_litis": pd.DataFrame({"Caso": casos_al_azar(n_pl), "Monto": montos(n_pl, 2000)}),
+        "actuaciones": pd.DataFrame({
+            "Caso": casos_al_azar(n_pagos // 4),
+            "CostasAranceles": montos(n_pagos // 4, 300),
+            "Gastos": montos(n_pagos // 4, 100),
+        }),
+    }
+
+
+def resumen_legado(t: dict) -> pd.DataFrame:
+    """Cálculo anterior (un recorrido de máscaras por caso), solo para comparar."""
+    def nk(x):
+        return "" if pd.isna(x) else str(x).strip().upper()
+
+    cl = t["cuota_litis"].copy()
+    cl["Caso"] = cl["Caso"].apply(nk)
+    cl["CuotaCalc"] = cl["Monto Base"] * cl["Porcentaje"] / 100.0
+    act = t["actuaciones"].copy()
+    act["Caso"] = act["Caso"].apply(nk)
+    act["G"] = act["CostasAranceles"] + act["Gastos"]
+    gastos_map = act.groupby("Caso")["G"].sum().to_dict()
+
+    rows = []
+    for _, c in t["casos"].iterrows():
+        exp = nk(c.get("Expediente", ""))
+        sub_et = t["honorarios_etapas"][t["honorarios_etapas"]["Caso"] == exp]
+        if not sub_et.empty:
+            pactado = sub_et["Monto Pactado"].sum()
+        else:
+            pactado = t["honorarios"][t["honorarios"]["Caso"] == exp]["Monto Pactado"].sum()
+        pagado_h = t["pagos_honorarios"][t["pagos_honorarios"]["Caso"] == exp]["Monto"].sum()
+        calc = cl[cl["Caso"] == exp]["CuotaCalc"].sum()
+        pagado_l = t["pagos_litis"][t["pagos_litis"]["Caso"] == exp]["Monto"].sum()
+        pend_h = max(0.0, float(pactado) - float(pagado_h))
+        pend_l = max(0.0, float(calc) - float(pagado_l))
+        rows.append([
+            exp, c.get("Cliente", ""), c.get("Materia", ""),
+            float(pactado), float(pagado_h), pend_h,
+            float(calc), float(pagado_l), pend_l,
+            float(gastos_map.get(exp, 0.0)), pend_h + pend_l,
+        ])
+    return pd.DataFrame(rows, columns=finanzas.RESUMEN_COLS)
+
+
+def cuotas_sinteticas(n_cuotas: int, n_casos: int, seed: int = 7) -> dict:
+    """Cronograma con casos borde: montos 0/negativos/vacíos, fechas vacías, pagos negativos."""
+    rnd = np.random.default_rng(seed)
+    exps = np.array([f"{i:05d}-2024-ci " for i in range(1, n_casos + 1)], dtype=object)
+    casos = exps[rnd.integers(0, n_casos, n_cuotas)]
+    monto = rnd.choice([0.0, 50.0, 100.0, 250.0, 333.33, -20.0, np.nan], n_cuotas,
+                       p=[0.05, 0.25, 0.3, 0.2, 0.1, 0.05, 0.05])
+    fechas = pd.Timestamp("2024-01-01") + pd.to_timedelta(rnd.integers(0, 900, n_cuotas), unit="D")
+    fechas = pd.Series(fechas).where(rnd.random(n_cuotas) > 0.1)
+    nro = pd.array(rnd.integers(1, 12, n_cuotas), dtype="Int64")
+    nro[rnd.random(n_cuotas) < 0.03] = pd.NA
+
+    def pagos(n):
+        return pd.DataFrame({
+            "Caso": exps[rnd.integers(0, n_casos, n)],
+            "Monto": rnd.choice([10.0, 75.5, 100.0, 400.0, -150.0, np.nan], n, p=[0.2, 0.3, 0.25, 0.15, 0.05, 0.05]),
+        })
+
+    return {
+        "cuotas": pd.DataFrame({
+            "ID": np.arange(1, n_cuotas + 1),
+            "Caso": casos,
+            "Tipo": rnd.choice(["Honorarios", "CuotaLitis", "Otro"], n_cuotas, p=[0.6, 0.35, 0.05]),
+            "NroCuota": nro,
+            "FechaVenc": fechas,
+            "Monto": monto,
+            "Notas": "",
+        }),
+        "pagos_honorarios": pagos(n_cuotas // 2),
+        "pagos_litis": pagos(n_cuotas // 5),
+    }
+
+
+def estado_cuotas_legado(t: dict, hoy: date) -> pd.DataFrame:
+    """Asignación anterior (iterrows + dict de saldos), solo para comparar."""
+    def nk(x):
+        return "" if pd.isna(x) else str(x).strip().upper()
+
+    df = t["cuotas"].copy()
+    df["Caso"] = df["Caso"].apply(nk)
+    fv = pd.to_datetime(df["FechaVenc"], errors="coerce", format="mixed")
+    df["FechaVenc_dt"] = fv.dt.date.astype("object").where(fv.notna(), None)
+    ph = t["pagos_honorarios"].copy()
+    pl = t["pagos_litis"].copy()
+    ph["Caso"] = ph["Caso"].apply(nk)
+    pl["Caso"] = pl["Caso"].apply(nk)
+
+    def calc_for_type(tipo, pagos_df):
+        sub = df[df["Tipo"] == tipo].copy()
+        if sub.empty:
+            return sub
+        sub["_sort_date"] = sub["FechaVenc_dt"].apply(lambda d: d if d else date(2100, 1, 1))
+        sub.sort_values(["Caso", "_sort_date", "NroCuota"], inplace=True)
+        remaining = {k: float(v) for k, v in pagos_df.groupby("Caso")["Monto"].sum().to_dict().items()}
+        asignados, saldos, estados, dias = [], [], [], []
+        for _, r in sub.iterrows():
+            caso = r["Caso"]
+            monto = float(r["Monto"])
+            venc = r["FechaVenc_dt"]
+            rem = remaining.get(caso, 0.0)
+            asign = min(rem, monto) if monto > 0 else 0.0
+            remaining[caso] = rem - asign
+            saldo = monto - asign
+            if monto == 0:
+                est = "Sin monto"
+            elif saldo <= 0.00001:
+                est = "Pagada"
+            elif asign > 0:
+                est = "Parcial"
+            else:
+                est = "Pendiente"
+            dv = None if venc is None else (venc - hoy).days
+            asignados.append(asign); saldos.append(saldo); estados.append(est); dias.append(dv)
+        sub["PagadoAsignado"] = asignados
+        sub["SaldoCuota"] = saldos
+        sub["Estado"] = estados
+        sub["DiasParaVencimiento"] = dias
+        return sub.drop(columns=["_sort_date"])
+
+    out_h = calc_for_type("Honorarios", ph)
+    out_l = calc_for_type("CuotaLitis", pl)
+    return pd.concat([out_h, out_l], ignore_index=True) if (not out_h.empty or not out_l.empty) else pd.DataFrame()
+
+
+def _estado_cuotas(t: dict, hoy: date) -> pd.DataFrame:
+    return finanzas.estado_cuotas(t["cuotas"], t["pagos_honorarios"], t["pagos_litis"], hoy=hoy)
+
+
+def diferencial_cuotas(n_escenarios: int, hoy: date):
+    for k in range(n_escenarios):
+        rnd = np.random.default_rng(1000 + k)
+        t = cuotas_sinteticas(int(rnd.integers(1, 400)), int(rnd.integers(1, 40)), seed=1000 + k)
+        nuevo = _estado_cuotas(t, hoy)
+        viejo = estado_cuotas_legado(t, hoy)
+        if "DiasParaVencimiento" in viejo.columns:
+            # sin fecha: None en el recorrido anterior, NaN en el nuevo (mismo significado)
+            viejo["DiasParaVencimiento"] = pd.to_numeric(viejo["DiasParaVencimiento"])
+        pd.testing.assert_frame_equal(
+            nuevo.reset_index(drop=True), viejo.reset_index(drop=True),
+            check_dtype=False, rtol=1e-9, atol=1e-6,
+        )
+
+
+def fuentes_derivadas(n_filas: int, seed: int) -> dict:
+    """Tablas fuente de saldos / cubo con `n_filas` filas cada una (con fechas y abogado en consultas)."""
+    rnd = np.random.default_rng(seed)
+    t = datos_sinteticos(max(1, n_filas // 2), 4 * n_filas + 4, seed=seed)
+    fechas = (pd.Timestamp("2024-01-01") + pd.to_timedelta(rnd.integers(0, 400, n_filas), unit="D")).astype(str)
+    out = {}
+    for k in finanzas.CUBO.fuentes:
+        base = t.get(k, t["pagos_honorarios"].rename(columns={"Monto": "CostoConsulta"}))
+        df = base.head(n_filas).reset_index(drop=True).copy()
+        for col in ["FechaRegistro", "FechaPago", "Fecha"]:
+            df[col] = fechas[:len(df)]
+        if k == "consultas":
+            df["Abogado"] = rnd.choice(["Abogado 1", "Abogado 2", ""], len(df))
+        out[k] = df
+    return out
+
+
+def diferencial_derivadas(n_escenarios: int):
+    """Aplicar el delta de cada alta (desde vacío) debe dar lo mismo que reconstruir de una vez."""
+    for k in range(n_escenarios):
+        n_filas = k % 6 + 1 if k < 30 else int(np.random.default_rng(k).integers(1, 60))
+        t = fuentes_derivadas(n_filas, seed=2000 + k)
+        for d in [finanzas.SALDOS, finanzas.CUBO]:
+            guardado = d.desde_tablas({})
+            # como en CSV: las diferencias se agregan al final y se suman al leer
+            agregado = [d.desde_tablas({})]
+            for tabla in d.fuentes:
+                df = t.get(tabla)
+                delta = d.delta(tabla, df.iloc[0:0], df)
+                guardado = d.aplicar(guardado, delta)
+                agregado.append(d.filas_delta(delta))
+            esperado = d.desde_tablas(t)
+            dif = d.diferencias(guardado, esperado)
+            assert dif.empty, f"escenario {k} ({n_filas} filas): {dif.head()}"
+            agregado = pd.concat(agregado, ignore_index=True)
+            dif = d.diferencias(agregado, esperado)
+            assert dif.empty, f"escenario {k} ({n_filas} filas, agregadas): {dif.head()}"
+            dif = d.diferencias(d.compactar(agregado), esperado)
+            assert dif.empty, f"escenario {k} ({n_filas} filas, compactadas): {dif.head()}"
+
+
+def _como_app(t: dict) -> dict:
+    """Mismos tipos que entrega load_df_reparado (Caso normalizado en str, Tipo category)."""
+    out = {}
+    for k, df in t.items():
+        df = df.copy()
+        if "Caso" in df.columns:
+            df["Caso"] = finanzas.normalizar_caso(df["Caso"]).astype("str")
+        if "Monto" in df.columns:
+            df["Monto"] = df["Monto"].fillna(0.0)
+        out[k] = df
+    c = out["cuotas"]
+    c["Tipo"] = c["Tipo"].astype("category")
+    c["NroCuota"] = c["NroCuota"].fillna(0).astype("int64")
+    exps = c["Caso"].drop_duplicates().sort_values()
+    out["casos"] = pd.DataFrame({
+        "Expediente": exps.values,
+        "Cliente": [f"Cliente {i % 700}" for i in range(len(exps))],
+        "Abogado": [f"Abogado {i % 9}" for i in range(len(exps))],
+    })
+    return out
+
+
+def _antiguedad(t: dict, hoy: date) -> pd.DataFrame:
+    detalle = finanzas.antiguedad_cuotas(_estado_cuotas(t, hoy), t["casos"])
+    return finanzas.resumen_antiguedad(detalle, "Cliente")
+
+
+def _resumen(t: dict) -> pd.DataFrame:
+    return finanzas.resumen_financiero(
+        t["casos"], t["honorarios"], t["honorarios_etapas"], t["pagos_honorarios"],
+        t["cuota_litis"], t["pagos_litis"], t["actuaciones"],
+    )
+
+
+def medir(fn, repeticiones: int = 3) -> float:
+    mejor = float("inf")
+    for _ in range(repeticiones):
+        t0 = time.perf_counter()
+        fn()
+        mejor = min(mejor, time.perf_counter() - t0)
+    return mejor * 1000
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark de finanzas.py")
+    ap.add_argument("--casos", type=int, default=10_000)
+    ap.add_argument("--pagos", type=int, default=200_000)
+    ap.add_argument("--legado", type=int, default=1_000, help="casos para comparar con el cálculo anterior (0 = omitir)")
+    ap.add_argument("--cuotas", type=int, default=100_000, help="cuotas para medir la asignación de pagos")
+    ap.add_argument("--diferencial", type=int, default=400, help="escenarios al azar de cuotas contra el cálculo anterior (0 = omitir)")
+    ap.add_argument("--antiguedad", type=int, default=50_000, help="cuotas para medir el reporte de antigüedad (0 = omitir)")
+    ap.add_argument("--derivadas", type=int, default=60, help="escenarios de saldos / cubo contra la reconstrucción (0 = omitir)")
+    args = ap.parse_args(argv)
+    hoy = date.today()
+
+    t = datos_sinteticos(args.casos, args.pagos)
+    ms = medir(lambda: _resumen(t))
+    print(f"resumen_financiero   {args.casos:>7} casos / {args.pagos:>7} pagos: {ms:9.1f} ms")
+
+    if args.legado:
+        n = args.legado
+        chico = datos_sinteticos(n, max(1, args.pagos * n // args.casos))
+        nuevo = _resumen(chico)
+        t0 = time.perf_counter()
+        viejo = resumen_legado(chico)
+        ms_viejo = (time.perf_counter() - t0) * 1000
+        pd.testing.assert_frame_equal(nuevo, viejo, check_dtype=False)
+        print(f"  anterior (fila a fila) {n:>5} casos: {ms_viejo:9.1f} ms "
+              f"– nuevo: {medir(lambda: _resumen(chico)):7.1f} ms – resultados idénticos")
+
+    if args.cuotas:
+        tc = cuotas_sinteticas(args.cuotas, max(1, args.cuotas // 10))
+        ms = medir(lambda: _estado_cuotas(tc, hoy))
+        print(f"estado_cuotas        {args.cuotas:>7} cuotas: {ms:9.1f} ms")
+
+    if args.diferencial:
+        diferencial_cuotas(args.diferencial, hoy)
+        print(f"  {args.diferencial} escenarios al azar: mismo resultado que la asignación fila a fila")
+
+    if args.derivadas:
+        diferencial_derivadas(args.derivadas)
+        print(f"  {args.derivadas} escenarios de saldos / cubo (1 a 6 filas y al azar): deltas = reconstrucción")
+
+    if args.antiguedad:
+        ta = _como_app(cuotas_sinteticas(args.antiguedad, max(1, args.antiguedad // 10)))
+        ms = medir(lambda: _antiguedad(ta, hoy))
+        print(f"antigüedad de saldos {args.antiguedad:>7} cuotas: {ms:9.1f} ms (estado + tramos + resumen por cliente)")
+
+
+if __name__ == "__main__":
+    main()
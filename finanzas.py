@@ -0,0 +1,958 @@
+# finanzas.py
+# Cálculos financieros por caso (solo pandas, sin Streamlit)
+#
+# app.py les pasa sus tablas ya cargadas/tipadas; aquí no se lee ni escribe
+# nada. Todo es por columnas (groupby/reindex), sin recorrer casos fila a fila,
+# así se puede medir con bench_finanzas.py.
+
+from datetime import date
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.frequencies import to_offset
+
+RESUMEN_COLS = [
+    "Expediente", "Cliente", "Materia",
+    "Honorario Pactado", "Honorario Pagado", "Honorario Pendiente",
+    "Cuota Litis Calculada", "Pagado Litis", "Saldo Litis",
+    "Gastos Actuaciones", "Saldo Total",
+]
+
+
+def _vacio(df) -> bool:
+    return df is None or getattr(df, "empty", True)
+
+
+def normalizar_caso(s: pd.Series) -> pd.Series:
+    """Igual que normalize_key de app.py, pero sobre toda la columna."""
+    if pd.api.types.is_string_dtype(s.dtype) and not pd.api.types.is_object_dtype(s.dtype):
+        # texto ya tipado (str de Arrow): sin pasar por objetos Python
+        return s.fillna("").str.strip().str.upper()
+    return s.astype(object).where(s.notna(), "").astype(str).str.strip().str.upper()
+
+
+def _numero(df: pd.DataFrame, col: str) -> pd.Series:
+    if col not in df.columns:
+        return pd.Series(0.0, index=df.index)
+    # los montos ya vienen como float64 (SCHEMA_TIPOS); esto solo cubre texto heredado
+    return pd.to_numeric(df[col], errors="coerce")
+
+
+def indice_por_caso(df: pd.DataFrame, col: str = "Caso") -> dict:
+    """Caso normalizado -> posiciones (iloc) de sus filas."""
+    if _vacio(df) or col not in df.columns:
+        return {}
+    return df.groupby(normalizar_caso(df[col]).values, sort=False).indices
+
+
+def filas_de_casos(df: pd.DataFrame, indice: dict, casos) -> pd.DataFrame:
+    """Filas de df de los casos dados (normalizados), en su orden original, usando el índice."""
+    partes = [indice[c] for c in casos if c in indice]
+    if _vacio(df) or not partes:
+        return df.iloc[0:0] if df is not None else df
+    return df.iloc[np.sort(np.concatenate(partes))]
+
+
+def suma_por_caso(df: pd.DataFrame, valores) -> pd.Series:
+    """Suma por Caso normalizado. `valores`: nombre de columna o Series alineada a df."""
+    if _vacio(df) or "Caso" not in df.columns:
+        return pd.Series(dtype="float64")
+    v = _numero(df, valores) if isinstance(valores, str) else valores
+    return v.groupby(normalizar_caso(df["Caso"])).sum()
+
+
+def gastos_por_caso(actuaciones: pd.DataFrame) -> pd.DataFrame:
+    if _vacio(actuaciones):
+        return pd.DataFrame(columns=["Caso", "GastosActuaciones"])
+    gastos = _numero(actuaciones, "CostasAranceles") + _numero(actuaciones, "Gastos")
+    out = suma_por_caso(actuaciones, gastos).rename("GastosActuaciones")
+    return out.rename_axis("Caso").reset_index()
+
+
+def resumen_financiero(casos, honorarios, honorarios_etapas, pagos_honorarios,
+                       cuota_litis, pagos_litis, actuaciones) -> pd.DataFrame:
+    """
+    Una fila por caso (mismo orden que `casos`):
+    - Pactado: suma de etapas si el caso tiene etapas; si no, honorario total
+    - Pendiente / Saldo Litis: nunca negativos
+    """
+    if _vacio(casos):
+        return pd.DataFrame(columns=RESUMEN_COLS)
+
+    exp = normalizar_caso(casos["Expediente"]) if "Expediente" in casos.columns else pd.Series("", index=casos.index)
+
+    def por_exp(serie: pd.Series) -> pd.Series:
+        return serie.reindex(exp.values).fillna(0.0).astype("float64").values
+
+    # 1) Pactado honorarios: etapas si existen (aunque sumen 0), si no total
+    if _vacio(honorarios_etapas) or "Caso" not in honorarios_etapas.columns:
+        con_etapas = pd.Series(False, index=exp.index).values
+    else:
+        con_etapas = exp.isin(set(normalizar_caso(honorarios_etapas["Caso"]))).values
+    pactado_et = por_exp(suma_por_caso(honorarios_etapas, "Monto Pactado"))
+    pactado_tot = por_exp(suma_por_caso(honorarios, "Monto Pactado"))
+    pactado = pd.Series(pactado_tot).where(~con_etapas, pd.Series(pactado_et)).values
+
+    # 2) Pagos honorarios
+    pagado_h = por_exp(suma_por_caso(pagos_honorarios, "Monto"))
+
+    # 3) Cuota litis calculada (por fila: base * % / 100)
+    if _vacio(cuota_litis):
+        calc = por_exp(pd.Series(dtype="float64"))
+    else:
+        cuota_calc = _numero(cuota_litis, "Monto Base") * _numero(cuota_litis, "Porcentaje") / 100.0
+        calc = por_exp(suma_por_caso(cuota_litis, cuota_calc))
+
+    # 4) Pagos litis
+    pagado_l = por_exp(suma_por_caso(pagos_litis, "Monto"))
+
+    gastos = gastos_por_caso(actuaciones)
+    gastos_act = por_exp(gastos.set_index(gastos["Caso"].astype(str))["GastosActuaciones"])
+
+    pend_h = (pactado - pagado_h).clip(min=0.0)
+    pend_l = (calc - pagado_l).clip(min=0.0)
+
+    def col(nombre):
+        return casos[nombre].values if nombre in casos.columns else ""
+
+    return pd.DataFrame({
+        "Expediente": exp.values,
+        "Cliente": col("Cliente"),
+        "Materia": col("Materia"),
+        "Honorario Pactado": pactado,
+        "Honorario Pagado": pagado_h,
+        "Honorario Pendiente": pend_h,
+        "Cuota Litis Calculada": calc,
+        "Pagado Litis": pagado_l,
+        "Saldo Litis": pend_l,
+        "Gastos Actuaciones": gastos_act,
+        "Saldo Total": pend_h + pend_l,
+    }, columns=RESUMEN_COLS)
+
+
+# ==========================================================
+# CUOTAS: asignación de pagos en cascada
+# - Por caso, los pagos cubren las cuotas en orden (vencimiento, NroCuota);
+#   sin fecha van al final
+# - asignado_i = min(monto_i, pagado - suma de cuotas anteriores), nunca < 0
+# - Todo con cumsum por caso (sin recorrer filas)
+# ==========================================================
+TIPOS_CUOTA_PAGOS = [("Honorarios", "pagos_honorarios"), ("CuotaLitis", "pagos_litis")]
+_SIN_FECHA = pd.Timestamp(2100, 1, 1)
+
+
+def _asignar_pagos(sub: pd.DataFrame, pagado: pd.Series, hoy: pd.Timestamp) -> pd.DataFrame:
+    sub = sub.sort_values(["Caso", "_sort_date", "NroCuota"])
+    caso = sub["Caso"].values
+    m = pd.to_numeric(sub["Monto"], errors="coerce").astype("float64").values
+    pos = m > 0  # NaN / 0 / negativos no reciben pagos
+
+    por_caso = pd.Series(np.where(pos, m, 0.0)).groupby(caso, sort=False)
+    previo = (por_caso.cumsum() - np.where(pos, m, 0.0)).values
+    n_pos = pd.Series(pos).groupby(caso, sort=False).cumsum().values
+
+    total = pagado.reindex(caso).fillna(0.0).astype("float64").values
+    # un total negativo (correcciones) se descuenta entero de la primera cuota con monto
+    disponible = np.where(pos & (n_pos == 1), total, np.maximum(total - previo, 0.0))
+    asignado = np.where(pos, np.minimum(disponible, m), 0.0)
+    # el cumsum deja residuos (~1e-14) donde el recorrido fila a fila daba 0:
+    # no deben convertir una cuota Pendiente en Parcial
+    asignado = np.where(np.abs(asignado) > 1e-6, asignado, 0.0)
+    saldo = m - asignado
+
+    sub["PagadoAsignado"] = asignado
+    sub["SaldoCuota"] = saldo
+    sub["Estado"] = np.select(
+        [m == 0, saldo <= 0.00001, asignado > 0],
+        ["Sin monto", "Pagada", "Parcial"],
+        "Pendiente",
+    )
+    sub["DiasParaVencimiento"] = (sub["_fv"] - hoy).dt.days
+    return sub.drop(columns=["_sort_date", "_fv"])
+
+
+def estado_cuotas(cuotas, pagos_honorarios, pagos_litis, hoy=None) -> pd.DataFrame:
+    """
+    Cuotas con PagadoAsignado / SaldoCuota / Estado / DiasParaVencimiento.
+    Honorarios se cubren con pagos_honorarios y CuotaLitis con pagos_litis.
+    """
+    if _vacio(cuotas):
+        return pd.DataFrame()
+    hoy = pd.Timestamp(hoy or date.today()).normalize()
+
+    df = cuotas.copy()
+    df["Caso"] = normalizar_caso(df["Caso"])
+    # FechaVenc ya es datetime64 (SCHEMA_TIPOS); to_datetime solo hace falta
+    # si la columna quedó como texto por fechas no válidas
+    fv = df["FechaVenc"]
+    if not pd.api.types.is_datetime64_any_dtype(fv.dtype):
+        fv = pd.to_datetime(fv, errors="coerce", format="mixed")
+    fv = fv.dt.normalize()
+    df["FechaVenc_dt"] = fv.dt.date.astype("object").where(fv.notna(), None)
+    df["_fv"] = fv
+    df["_sort_date"] = fv.fillna(_SIN_FECHA)
+
+    pagos = {"pagos_honorarios": pagos_honorarios, "pagos_litis": pagos_litis}
+    partes = []
+    for tipo, tabla in TIPOS_CUOTA_PAGOS:
+        sub = df[df["Tipo"] == tipo]
+        if sub.empty:
+            continue
+        partes.append(_asignar_pagos(sub, suma_por_caso(pagos[tabla], "Monto"), hoy))
+    return pd.concat(partes, ignore_index=True) if partes else pd.DataFrame()
+
+
+# ==========================================================
+# TABLAS DERIVADAS (sumas por clave mantenidas por diferencias)
+# - Cada fila de una tabla fuente aporta montos a una clave; los aportes
+#   se suman, así una alta/edición/baja se aplica como diferencia
+# - La misma definición sirve para reconstruir desde cero y comparar
+# ==========================================================
+class TablaDerivada:
+    """
+    claves: columnas clave (nunca vacías: esas filas no se guardan)
+    montos: columnas sumables
+    aportes: {tabla fuente: f(df) -> DataFrame por fila con claves + montos}
+    """
+    solo_agregar = False
+    con_historial = False
+
+    def __init__(self, claves: list, montos: list, aportes: dict):
+        self.claves = list(claves)
+        self.montos = list(montos)
+        self.columnas = self.claves + self.montos
+        self.aportes = aportes
+        self.fuentes = list(aportes)
+
+    def _cero(self) -> pd.DataFrame:
+        idx = pd.MultiIndex.from_arrays([[]] * len(self.claves), names=self.claves) if len(self.claves) > 1 \
+            else pd.Index([], name=self.claves[0])
+        return pd.DataFrame(columns=self.montos, index=idx, dtype="float64")
+
+    def sumar(self, tabla: str, df: pd.DataFrame) -> pd.DataFrame:
+        """Aporte de `df` (filas de `tabla`) a cada clave: índice claves, columnas montos."""
+        if _vacio(df):
+            return self._cero()
+        filas = self.aportes[tabla](df)
+        # NaN no suma (igual que resumen_financiero)
+        valores = filas.reindex(columns=self.montos).astype("float64").fillna(0.0)
+        # por nombre de columna: una lista de arreglos con tantos elementos
+        # como filas se tomaría como UNA clave fila a fila (p. ej. 3 filas)
+        valores[self.claves] = filas[self.claves]
+        return valores.groupby(self.claves, sort=False)[self.montos].sum()
+
+    def delta(self, tabla: str, antes: pd.DataFrame, despues: pd.DataFrame) -> pd.DataFrame:
+        """Lo que cambia cada clave al pasar `tabla` de `antes` a `despues` (solo claves con cambio)."""
+        d = self.sumar(tabla, despues).sub(self.sumar(tabla, antes), fill_value=0.0)
+        return d[(d.abs() > 1e-9).any(axis=1)]
+
+    def _limpiar(self, df: pd.DataFrame) -> pd.DataFrame:
+        # clave vacía: no hay a quién imputar; sin aportes no ocupa fila
+        df = df.reset_index()
+        df = df[(df[self.claves] != "").all(axis=1) & (df[self.montos].abs() > 1e-9).any(axis=1)]
+        return df.sort_values(self.claves).reset_index(drop=True).reindex(columns=self.columnas)
+
+    def desde_tablas(self, tablas: dict) -> pd.DataFrame:
+        """Reconstrucción completa desde las tablas fuente ({tabla: DataFrame})."""
+        total = self._cero()
+        for t in self.fuentes:
+            total = total.add(self.sumar(t, tablas.get(t)), fill_value=0.0)
+        return self._limpiar(total.fillna(0.0))
+
+    def indexar(self, guardado: pd.DataFrame) -> pd.DataFrame:
+        """Tabla guardada -> índice claves, montos numéricos (claves repetidas se suman)."""
+        if _vacio(guardado):
+            return self._cero()
+        df = guardado.reindex(columns=self.columnas)
+        df[self.claves] = df[self.claves].astype(object).where(df[self.claves].notna(), "").astype(str)
+        df[self.montos] = df[self.montos].apply(pd.to_numeric, errors="coerce").fillna(0.0)
+        return df.groupby(self.claves, sort=False)[self.montos].sum()
+
+    def aplicar(self, guardado: pd.DataFrame, delta: pd.DataFrame) -> pd.DataFrame:
+        return self._limpiar(self.indexar(guardado).add(delta, fill_value=0.0).fillna(0.0))
+
+    def filas_delta(self, delta: pd.DataFrame) -> pd.DataFrame:
+        """Delta (índice claves) -> filas claves + montos para sumarlas a la tabla guardada."""
+        df = delta.reset_index()
+        df = df[(df[self.claves] != "").all(axis=1)]
+        return df.reindex(columns=self.columnas).reset_index(drop=True)
+
+    def compactar(self, guardado: pd.DataFrame) -> pd.DataFrame:
+        """Una fila por clave (suma las repetidas y quita las que quedaron en cero)."""
+        return self._limpiar(self.indexar(guardado))
+
+    def diferencias(self, guardado: pd.DataFrame, recalculado: pd.DataFrame, tolerancia: float = 0.005) -> pd.DataFrame:
+        """Una fila por (clave, columna) donde la tabla guardada se aleja de la reconstruida."""
+        cols = self.claves + ["Columna", "Guardado", "Recalculado", "Diferencia"]
+        g, r = self.indexar(guardado), self.indexar(recalculado)
+        todas = g.index.union(r.index)
+        g = g.reindex(todas, fill_value=0.0).stack()
+        r = r.reindex(todas, fill_value=0.0).stack()
+        dif = (g - r)[(g - r).abs() > tolerancia]
+        if dif.empty:
+            return pd.DataFrame(columns=cols)
+        out = pd.DataFrame({"Guardado": g[dif.index], "Recalculado": r[dif.index], "Diferencia": dif})
+        return out.rename_axis(self.claves + ["Columna"]).reset_index()[cols]
+
+
+# ==========================================================
+# SALDOS POR CASO
+# - El pactado guarda etapas y total por separado (+ cuántas etapas hay)
+#   para aplicar la misma regla que resumen_financiero al leer
+# ==========================================================
+SALDOS_MONTOS = [
+    "PactadoHonorarios", "PactadoEtapas", "NroEtapas", "PagadoHonorarios",
+    "CuotaLitisCalculada", "PagadoLitis", "GastosActuaciones",
+]
+
+
+def _clave(df: pd.DataFrame, col: str) -> pd.Series:
+    if col not in df.columns:
+        return pd.Series("", index=df.index)
+    return normalizar_caso(df[col])
+
+
+def _por_caso(df: pd.DataFrame, **montos) -> pd.DataFrame:
+    return pd.DataFrame({"Caso": _clave(df, "Caso"), **montos}, index=df.index)
+
+
+SALDOS = TablaDerivada(["Caso"], SALDOS_MONTOS, {
+    "honorarios": lambda df: _por_caso(df, PactadoHonorarios=_numero(df, "Monto Pactado")),
+    "honorarios_etapas": lambda df: _por_caso(df, PactadoEtapas=_numero(df, "Monto Pactado"), NroEtapas=1.0),
+    "pagos_honorarios": lambda df: _por_caso(df, PagadoHonorarios=_numero(df, "Monto")),
+    "cuota_litis": lambda df: _por_caso(
+        df, CuotaLitisCalculada=_numero(df, "Monto Base") * _numero(df, "Porcentaje") / 100.0),
+    "pagos_litis": lambda df: _por_caso(df, PagadoLitis=_numero(df, "Monto")),
+    "actuaciones": lambda df: _por_caso(
+        df, GastosActuaciones=_numero(df, "CostasAranceles") + _numero(df, "Gastos")),
+})
+SALDOS_COLS = SALDOS.columnas
+
+
+# ==========================================================
+# CUBO DE REPORTES (caso × abogado × mes)
+# - Se guarda por caso para poder bajar al detalle; Abogado solo viene lleno
+#   en consultas (las demás tablas toman el abogado del caso al consultar)
+# - Mes = AAAA-MM de la fecha de registro / pago / actuación / consulta
+# - Pactado: etapas o total por caso (misma regla que el libro financiero)
+# ==========================================================
+SIN_MES = "s/f"
+SIN_CLAVE = "-"
+CUBO_MONTOS = [
+    "PactadoTotal", "PactadoEtapas", "Etapas", "HonorarioPagado",
+    "CuotaLitis", "LitisPagado", "Gastos", "Consultas",
+]
+CONCEPTOS_CUBO = [
+    "Honorario pactado", "Honorario pagado", "Cuota litis", "Litis pagado",
+    "Gastos", "Consultas",
+]
+CUBO_DIMENSIONES = ["Caso", "Abogado", "Materia", "Mes"]
+
+
+def _mes(df: pd.DataFrame, col: str) -> pd.Series:
+    if col not in df.columns:
+        return pd.Series(SIN_MES, index=df.index)
+    f = df[col]
+    if not pd.api.types.is_datetime64_any_dtype(f.dtype):
+        f = pd.to_datetime(f.astype(object).where(f.notna()), errors="coerce", format="mixed")
+    # pocos meses distintos: se formatea cada uno una sola vez
+    codigos, meses = pd.factorize(f.values.astype("datetime64[M]"))
+    textos = np.append(np.datetime_as_string(meses, unit="M").astype(object), SIN_MES)
+    return pd.Series(textos[codigos], index=df.index)
+
+
+def _por_mes(df: pd.DataFrame, col_fecha: str, abogado=None, **montos) -> pd.DataFrame:
+    caso = _clave(df, "Caso")
+    ab = pd.Series(SIN_CLAVE, index=df.index) if abogado is None else abogado
+    return pd.DataFrame({
+        "Caso": caso.where(caso != "", SIN_CLAVE),
+        "Abogado": ab,
+        "Mes": _mes(df, col_fecha),
+        **montos,
+    }, index=df.index)
+
+
+def _abogado_consulta(df: pd.DataFrame) -> pd.Series:
+    if "Abogado" not in df.columns:
+        return pd.Series(SIN_CLAVE, index=df.index)
+    ab = df["Abogado"].astype(object).where(df["Abogado"].notna(), "").astype(str).str.strip()
+    return ab.where(ab != "", SIN_CLAVE)
+
+
+CUBO = TablaDerivada(["Caso", "Abogado", "Mes"], CUBO_MONTOS, {
+    "honorarios": lambda df: _por_mes(df, "FechaRegistro", PactadoTotal=_numero(df, "Monto Pactado")),
+    "honorarios_etapas": lambda df: _por_mes(
+        df, "FechaRegistro", PactadoEtapas=_numero(df, "Monto Pactado"), Etapas=1.0),
+    "pagos_honorarios": lambda df: _por_mes(df, "FechaPago", HonorarioPagado=_numero(df, "Monto")),
+    "cuota_litis": lambda df: _por_mes(
+        df, "FechaRegistro", CuotaLitis=_numero(df, "Monto Base") * _numero(df, "Porcentaje") / 100.0),
+    "pagos_litis": lambda df: _por_mes(df, "FechaPago", LitisPagado=_numero(df, "Monto")),
+    "actuaciones": lambda df: _por_mes(
+        df, "Fecha", Gastos=_numero(df, "CostasAranceles") + _numero(df, "Gastos")),
+    "consultas": lambda df: _por_mes(
+        df, "Fecha", abogado=_abogado_consulta(df), Consultas=_numero(df, "CostoConsulta")),
+})
+
+
+def cubo_detalle(cubo: pd.DataFrame, casos: pd.DataFrame = None) -> pd.DataFrame:
+    """Caso / Abogado / Materia / Mes + una columna por concepto (CONCEPTOS_CUBO)."""
+    if _vacio(cubo):
+        return pd.DataFrame(columns=CUBO_DIMENSIONES + CONCEPTOS_CUBO)
+    df = CUBO.indexar(cubo).reset_index()
+    datos = datos_del_caso(casos, df["Caso"], ["Abogado", "Materia"])
+    ab = np.where(df["Abogado"] != SIN_CLAVE, df["Abogado"], datos["Abogado"])
+    ab = pd.Series(ab, dtype=object).astype(str).str.strip()
+    mat = pd.Series(datos["Materia"], dtype=object).astype(str).str.strip()
+
+    con_etapas = df.groupby("Caso")["Etapas"].transform("sum") > 0
+    return pd.DataFrame({
+        "Caso": df["Caso"].values,
+        "Abogado": ab.where(ab != "", "(sin abogado)").values,
+        "Materia": mat.where(mat != "", "(sin materia)").values,
+        "Mes": df["Mes"].values,
+        "Honorario pactado": np.where(con_etapas, df["PactadoEtapas"], df["PactadoTotal"]),
+        "Honorario pagado": df["HonorarioPagado"].values,
+        "Cuota litis": df["CuotaLitis"].values,
+        "Litis pagado": df["LitisPagado"].values,
+        "Gastos": df["Gastos"].values,
+        "Consultas": df["Consultas"].values,
+    }, columns=CUBO_DIMENSIONES + CONCEPTOS_CUBO)
+
+
+def cubo_agregado(detalle: pd.DataFrame) -> pd.DataFrame:
+    """Abogado × Mes × Materia (sin caso): lo que consulta la pantalla de Reportes."""
+    if _vacio(detalle):
+        return pd.DataFrame(columns=CUBO_DIMENSIONES[1:] + CONCEPTOS_CUBO)
+    return detalle.groupby(CUBO_DIMENSIONES[1:], sort=True)[CONCEPTOS_CUBO].sum().reset_index()
+
+
+def filtrar_cubo(df: pd.DataFrame, desde=None, hasta=None, materias=None, sin_fecha: bool = True,
+                 abogado=None) -> pd.DataFrame:
+    """Filas de `df` (detalle o agregado) dentro del período AAAA-MM [desde, hasta]."""
+    if _vacio(df):
+        return df
+    mes = df["Mes"]
+    con_fecha = mes != SIN_MES
+    ok = con_fecha
+    if desde:
+        ok = ok & (mes >= desde)
+    if hasta:
+        ok = ok & (mes <= hasta)
+    if sin_fecha:
+        ok = ok | ~con_fecha
+    if materias:
+        ok = ok & df["Materia"].isin(materias)
+    if abogado is not None:
+        ok = ok & (df["Abogado"] == abogado)
+    return df[ok]
+
+
+# ==========================================================
+# CIERRES MENSUALES
+# - Al cerrar un mes se congela su detalle del cubo (caso × abogado, con la
+#   materia y el abogado que tenía el caso ese día)
+# - Los reportes leen la foto para los meses cerrados y el cubo vivo para
+#   el resto; los movimientos sin fecha siempre van en vivo
+# - diferencias_cierre() compara la foto con el cubo actual: cualquier
+#   edición posterior que toque un mes cerrado aparece ahí
+# ==========================================================
+CIERRE_COLS = ["Mes", "Caso", "Abogado", "Materia"] + CONCEPTOS_CUBO
+
+
+def mes_actual(hoy=None) -> str:
+    return pd.Timestamp(hoy if hoy is not None else date.today()).strftime("%Y-%m")
+
+
+def foto_cierre(detalle: pd.DataFrame, mes: str) -> pd.DataFrame:
+    """Filas de `detalle` (cubo_detalle) del mes, listas para guardar."""
+    if _vacio(detalle):
+        return pd.DataFrame(columns=CIERRE_COLS)
+    foto = detalle[detalle["Mes"] == mes]
+    foto = foto[(foto[CONCEPTOS_CUBO].abs() > 1e-9).any(axis=1)]
+    return foto.sort_values(["Caso", "Abogado"]).reset_index(drop=True).reindex(columns=CIERRE_COLS)
+
+
+def detalle_con_cierres(detalle: pd.DataFrame, cierres: pd.DataFrame, meses_cerrados) -> pd.DataFrame:
+    """Detalle del cubo con los meses cerrados reemplazados por su foto."""
+    cerrados = list(meses_cerrados)
+    vivo = detalle if _vacio(detalle) else detalle[~detalle["Mes"].isin(cerrados)]
+    if _vacio(cierres) or not cerrados:
+        return vivo.reindex(columns=CUBO_DIMENSIONES + CONCEPTOS_CUBO)
+    foto = cierres[cierres["Mes"].isin(cerrados)].reindex(columns=CUBO_DIMENSIONES + CONCEPTOS_CUBO)
+    foto[CONCEPTOS_CUBO] = foto[CONCEPTOS_CUBO].apply(pd.to_numeric, errors="coerce").fillna(0.0)
+    partes = [p for p in (vivo, foto) if not _vacio(p)]
+    if not partes:
+        return pd.DataFrame(columns=CUBO_DIMENSIONES + CONCEPTOS_CUBO)
+    return pd.concat(partes, ignore_index=True)
+
+
+def diferencias_cierre(detalle: pd.DataFrame, cierres: pd.DataFrame, meses_cerrados,
+                       tolerancia: float = 0.005) -> pd.DataFrame:
+    """Mes / Caso / Concepto donde el cubo actual ya no coincide con la foto del cierre."""
+    cols = ["Mes", "Caso", "Concepto", "Cerrado", "Actual", "Diferencia"]
+    cerrados = list(meses_cerrados)
+    if not cerrados:
+        return pd.DataFrame(columns=cols)
+
+    def por_caso(df):
+        if _vacio(df):
+            return pd.DataFrame(columns=CONCEPTOS_CUBO, index=pd.MultiIndex.from_arrays([[], []], names=["Mes", "Caso"]))
+        df = df[df["Mes"].isin(cerrados)]
+        valores = df[CONCEPTOS_CUBO].apply(pd.to_numeric, errors="coerce").fillna(0.0)
+        return valores.groupby([df["Mes"].astype(str), df["Caso"].astype(str)]).sum().rename_axis(["Mes", "Caso"])
+
+    c, a = por_caso(cierres), por_caso(detalle)
+    todas = c.index.union(a.index)
+    c = c.reindex(todas, fill_value=0.0).astype("float64").stack()
+    a = a.reindex(todas, fill_value=0.0).astype("float64").stack()
+    dif = (a - c)[(a - c).abs() > tolerancia]
+    if dif.empty:
+        return pd.DataFrame(columns=cols)
+    out = pd.DataFrame({"Cerrado": c[dif.index], "Actual": a[dif.index], "Diferencia": dif})
+    return out.rename_axis(["Mes", "Caso", "Concepto"]).reset_index()[cols]
+
+
+def resumen_desde_saldos(casos: pd.DataFrame, saldos: pd.DataFrame) -> pd.DataFrame:
+    """Mismo resultado que resumen_financiero, leyendo la tabla materializada."""
+    if _vacio(casos):
+        return pd.DataFrame(columns=RESUMEN_COLS)
+    exp = normalizar_caso(casos["Expediente"]) if "Expediente" in casos.columns else pd.Series("", index=casos.index)
+    s = SALDOS.indexar(saldos).reindex(exp.values).fillna(0.0)
+
+    pactado = np.where(s["NroEtapas"].values > 0, s["PactadoEtapas"].values, s["PactadoHonorarios"].values)
+    pagado_h = s["PagadoHonorarios"].values
+    calc = s["CuotaLitisCalculada"].values
+    pagado_l = s["PagadoLitis"].values
+    pend_h = (pactado - pagado_h).clip(min=0.0)
+    pend_l = (calc - pagado_l).clip(min=0.0)
+
+    def col(nombre):
+        return casos[nombre].values if nombre in casos.columns else ""
+
+    return pd.DataFrame({
+        "Expediente": exp.values,
+        "Cliente": col("Cliente"),
+        "Materia": col("Materia"),
+        "Honorario Pactado": pactado,
+        "Honorario Pagado": pagado_h,
+        "Honorario Pendiente": pend_h,
+        "Cuota Litis Calculada": calc,
+        "Pagado Litis": pagado_l,
+        "Saldo Litis": pend_l,
+        "Gastos Actuaciones": s["GastosActuaciones"].values,
+        "Saldo Total": pend_h + pend_l,
+    }, columns=RESUMEN_COLS)
+
+
+# ==========================================================
+# ANTIGÜEDAD DE SALDOS (sobre la asignación de cuotas)
+# - Solo cuotas con saldo; días vencidos = hoy - FechaVenc
+# - "Por vencer": aún no vence o no tiene fecha
+# ==========================================================
+TRAMOS_ANTIGUEDAD = ["Por vencer", "0-30", "31-60", "61-90", "90+"]
+_LIMITES_TRAMOS = [-np.inf, -1, 30, 60, 90, np.inf]
+ANTIGUEDAD_DETALLE_COLS = [
+    "Caso", "Cliente", "Abogado", "Tipo", "NroCuota", "FechaVenc_dt",
+    "SaldoCuota", "DiasVencido", "Tramo",
+]
+
+
+def datos_del_caso(casos: pd.DataFrame, caso: pd.Series, cols) -> dict:
+    """Columna `cols` de casos para cada valor de `caso` (ya normalizado); "" si no hay ficha."""
+    datos = {c: np.full(len(caso), "", dtype=object) for c in cols}
+    if _vacio(casos) or "Expediente" not in casos.columns:
+        return datos
+    exp = pd.Index(normalizar_caso(casos["Expediente"]))
+    unico = ~exp.duplicated()  # expedientes repetidos: manda el primero
+    pos = exp[unico].get_indexer(caso)
+    fila = np.flatnonzero(unico)[np.maximum(pos, 0)]
+    for c in cols:
+        if c in casos.columns:
+            v = casos[c].astype(object).values[fila]
+            datos[c] = np.where((pos >= 0) & pd.notna(v), v, "")
+    return datos
+
+
+def antiguedad_cuotas(estado: pd.DataFrame, casos: pd.DataFrame = None) -> pd.DataFrame:
+    """Cuotas con saldo (salida de estado_cuotas) + Cliente/Abogado del caso, DiasVencido y Tramo."""
+    if _vacio(estado):
+        return pd.DataFrame(columns=ANTIGUEDAD_DETALLE_COLS)
+    df = estado[estado["SaldoCuota"] > 0.00001]
+    dias = -pd.to_numeric(df["DiasParaVencimiento"], errors="coerce")
+    tramo = pd.cut(dias.fillna(-1), _LIMITES_TRAMOS, labels=TRAMOS_ANTIGUEDAD)
+
+    datos = datos_del_caso(casos, df["Caso"], ["Cliente", "Abogado"])
+    out = pd.DataFrame({
+        "Caso": df["Caso"].values,
+        "Cliente": datos["Cliente"],
+        "Abogado": datos["Abogado"],
+        "Tipo": df["Tipo"].values,
+        "NroCuota": df["NroCuota"].values,
+        "FechaVenc_dt": df["FechaVenc_dt"].values,
+        "SaldoCuota": df["SaldoCuota"].values,
+        "DiasVencido": dias.astype("Int64").values,
+        "Tramo": tramo.values,
+    }, columns=ANTIGUEDAD_DETALLE_COLS)
+    return out
+
+
+def resumen_antiguedad(detalle: pd.DataFrame, por: str = "Caso") -> pd.DataFrame:
+    """Saldo por `por` (Caso / Cliente / Abogado) y Tipo, una columna por tramo + Total."""
+    cols = [por, "Tipo"] + TRAMOS_ANTIGUEDAD + ["Total"]
+    if _vacio(detalle):
+        return pd.DataFrame(columns=cols)
+    tabla = (
+        detalle.groupby([por, "Tipo", "Tramo"], observed=True, sort=False)["SaldoCuota"].sum()
+        .unstack("Tramo", fill_value=0.0)
+        .reindex(columns=TRAMOS_ANTIGUEDAD, fill_value=0.0)
+        .sort_index()
+    )
+    tabla["Total"] = tabla.sum(axis=1)
+    tabla = tabla[tabla["Total"] > 0]
+    tabla.columns.name = None
+    return tabla.reset_index()[cols]
+
+
+# ==========================================================
+# FLUJO DE CAJA PROYECTADO (sobre la asignación de cuotas)
+# - Tasa de cobro por cliente: lo cobrado de sus cuotas ya vencidas / su monto
+#   (sin historial: la tasa del estudio; sin ninguna cuota vencida: 100 %)
+# - Esperado = saldo de cada cuota × tasa del cliente, en la semana/mes de su
+#   vencimiento; lo ya vencido se espera en el período actual
+# - Cuotas sin fecha no entran (no se sabe cuándo)
+# ==========================================================
+FRECUENCIAS_FLUJO = {"Semanal": "W-MON", "Mensual": "MS"}
+FLUJO_COLS = ["Programado", "Esperado", "De cuotas vencidas", "Acumulado esperado"]
+
+
+def periodos_horizonte(frecuencia: str, meses: int) -> int:
+    """Cuántas semanas/meses (contando el actual) cubren `meses` meses."""
+    return meses if frecuencia == "MS" else int(round(meses * 52 / 12))
+
+
+def tasas_cobro(estado: pd.DataFrame, casos: pd.DataFrame = None) -> tuple:
+    """(tabla Cliente / Vencido / Cobrado / Tasa, tasa del estudio)."""
+    cols = ["Cliente", "Vencido", "Cobrado", "Tasa"]
+    if _vacio(estado):
+        return pd.DataFrame(columns=cols), 1.0
+    monto = pd.to_numeric(estado["Monto"], errors="coerce").fillna(0.0)
+    vencida = (pd.to_numeric(estado["DiasParaVencimiento"], errors="coerce") <= 0) & (monto > 0)
+    df = estado[vencida]
+    if df.empty:
+        return pd.DataFrame(columns=cols), 1.0
+    cliente = datos_del_caso(casos, df["Caso"], ["Cliente"])["Cliente"]
+    g = pd.DataFrame({"Vencido": monto[vencida].values, "Cobrado": df["PagadoAsignado"].values}).groupby(cliente).sum()
+    g["Tasa"] = (g["Cobrado"] / g["Vencido"]).clip(0.0, 1.0)
+    global_ = float(min(max(g["Cobrado"].sum() / g["Vencido"].sum(), 0.0), 1.0))
+    return g.rename_axis("Cliente").reset_index()[cols], global_
+
+
+def proyeccion_flujo(estado: pd.DataFrame, casos: pd.DataFrame = None, frecuencia: str = "MS",
+                     meses: int = 12, hoy=None) -> pd.DataFrame:
+    """
+    Índice = inicio de cada semana (lunes) / mes, desde el período actual;
+    periodos_horizonte(frecuencia, meses) filas con columnas FLUJO_COLS.
+    Los horizontes más cortos son las primeras filas.
+    """
+    hoy = pd.Timestamp(hoy or date.today()).normalize()
+    paso = to_offset(frecuencia)
+    inicio = paso.rollback(hoy)
+    fin = inicio + periodos_horizonte(frecuencia, meses) * paso
+    # dos filas en cero para que el resample cubra todo el horizonte
+    partes = [pd.DataFrame(0.0, index=pd.DatetimeIndex([inicio, fin - pd.Timedelta(days=1)]), columns=FLUJO_COLS[:3])]
+
+    if not _vacio(estado):
+        # estado_cuotas calculado con el mismo `hoy`
+        saldo = pd.to_numeric(estado["SaldoCuota"], errors="coerce").fillna(0.0)
+        fv = hoy + pd.to_timedelta(pd.to_numeric(estado["DiasParaVencimiento"], errors="coerce"), unit="D")
+        pend = (saldo > 0.00001) & fv.notna() & (fv < fin)
+        tabla, global_ = tasas_cobro(estado, casos)
+        cliente = datos_del_caso(casos, estado.loc[pend, "Caso"], ["Cliente"])["Cliente"]
+        tasa = tabla.set_index("Cliente")["Tasa"].reindex(cliente).fillna(global_).values
+
+        esperado = saldo[pend].values * tasa
+        vencida = (fv[pend] < hoy).values
+        partes.append(pd.DataFrame({
+            "Programado": saldo[pend].values,
+            "Esperado": esperado,
+            "De cuotas vencidas": np.where(vencida, esperado, 0.0),
+        }, index=pd.DatetimeIndex(fv[pend].where(~vencida, hoy))))
+
+    serie = pd.concat(partes)
+    out = serie.resample(frecuencia, label="left", closed="left").sum()
+    out["Acumulado esperado"] = out["Esperado"].cumsum()
+    return out.rename_axis("Periodo")
+
+
+# ==========================================================
+# LIBRO DIARIO (partida doble, solo se agrega)
+# - Cada movimiento de dinero de las tablas fuente es un asiento de dos
+#   líneas (Debe en una cuenta, Haber en otra, mismo monto)
+# - Editar o borrar una fila no toca lo ya asentado: se agrega la
+#   corrección / anulación (asiento inverso por la diferencia)
+# - La clave de un movimiento es Tabla + OrigenID + Fecha + Caso + Concepto:
+#   si cambia la fecha o el caso, se anula el viejo y se asienta el nuevo
+# - Lo asentado de un movimiento = Debe - Haber en la cuenta deudora de su
+#   concepto; diferencias() lo compara con lo que dicen hoy las fuentes
+# - La consulta se cobra al atenderla (consultas no registra pagos): cada
+#   una asienta el cargo y su cobro, así no queda como deuda del cliente
+# ==========================================================
+CUENTAS_LIBRO = {
+    # concepto: (cuenta al Debe, cuenta al Haber)
+    "Cuota honorarios": ("Cuentas por cobrar", "Ingresos honorarios"),
+    "Cuota litis": ("Cuentas por cobrar", "Ingresos cuota litis"),
+    "Pago honorarios": ("Caja", "Cuentas por cobrar"),
+    "Pago cuota litis": ("Caja", "Cuentas por cobrar"),
+    "Gasto del caso": ("Gastos por reembolsar", "Caja"),
+    "Reembolso de gastos": ("Caja", "Gastos por reembolsar"),
+    "Consulta": ("Cuentas por cobrar", "Ingresos consultas"),
+    "Pago consulta": ("Caja", "Cuentas por cobrar"),
+}
+CUENTAS_CLIENTE = ["Cuentas por cobrar", "Gastos por reembolsar"]
+LIBRO_CLAVES = ["Tabla", "OrigenID", "Fecha", "Caso", "Concepto"]
+LIBRO_COLS = [
+    "ID", "Asiento", "Fecha", "Caso", "Cliente", "Concepto", "Cuenta",
+    "Debe", "Haber", "Tabla", "OrigenID", "Motivo", "Registrado",
+]
+
+
+def _fecha_texto(df: pd.DataFrame, col: str) -> pd.Series:
+    """AAAA-MM-DD ("" sin fecha): ordena igual que la fecha."""
+    if col not in df.columns:
+        return pd.Series("", index=df.index)
+    f = df[col]
+    if not pd.api.types.is_datetime64_any_dtype(f.dtype):
+        f = pd.to_datetime(f.astype(object).where(f.notna()), errors="coerce", format="mixed")
+    return f.dt.strftime("%Y-%m-%d").fillna("").astype(object)
+
+
+def _id_texto(df: pd.DataFrame) -> pd.Series:
+    if "ID" not in df.columns:
+        return pd.Series("", index=df.index)
+    n = pd.to_numeric(df["ID"], errors="coerce")
+    return n.astype("Int64").astype(str).where(n.notna(), df["ID"].astype(object).fillna("").astype(str))
+
+
+def _texto(df: pd.DataFrame, col: str) -> pd.Series:
+    if col not in df.columns:
+        return pd.Series("", index=df.index)
+    return df[col].astype(object).where(df[col].notna(), "").astype(str).str.strip()
+
+
+def _movs(df: pd.DataFrame, tabla: str, concepto, col_fecha: str, monto: pd.Series) -> pd.DataFrame:
+    return pd.DataFrame({
+        "Tabla": tabla,
+        "OrigenID": _id_texto(df),
+        "Fecha": _fecha_texto(df, col_fecha),
+        "Caso": _clave(df, "Caso"),
+        "Concepto": concepto,
+        "Cliente": _texto(df, "Cliente"),
+        "Monto": monto.astype("float64").fillna(0.0),
+    }, index=df.index)
+
+
+def _movs_cuotas(df):
+    litis = _texto(df, "Tipo") == "CuotaLitis"
+    return _movs(df, "cuotas", np.where(litis, "Cuota litis", "Cuota honorarios"), "FechaVenc", _numero(df, "Monto"))
+
+
+def _movs_actuaciones(df):
+    gasto = _numero(df, "CostasAranceles").fillna(0.0) + _numero(df, "Gastos").fillna(0.0)
+    reembolsado = _texto(df, "GastosPagado") == "1"
+    return pd.concat([
+        _movs(df, "actuaciones", "Gasto del caso", "Fecha", gasto),
+        _movs(df, "actuaciones", "Reembolso de gastos", "Fecha", gasto.where(reembolsado, 0.0)),
+    ])
+
+
+def _movs_consultas(df):
+    costo = _numero(df, "CostoConsulta")
+    return pd.concat([
+        _movs(df, "consultas", "Consulta", "Fecha", costo),
+        _movs(df, "consultas", "Pago consulta", "Fecha", costo),
+    ])
+
+
+class LibroDiario:
+    """
+    Misma interfaz que TablaDerivada para app.py (fuentes / delta /
+    desde_tablas / diferencias), pero el resultado se agrega como asientos
+    en vez de reemplazar filas.
+    """
+    solo_agregar = True
+    con_historial = False
+    # sube cuando cambia lo que se asienta por fuente: los libros guardados
+    # con la definición anterior se concilian (se asienta lo que falte)
+    version = 2
+
+    def __init__(self, movimientos: dict):
+        self.movimientos = movimientos
+        self.fuentes = list(movimientos)
+        self.claves = LIBRO_CLAVES
+        self.columnas = LIBRO_COLS
+
+    def _cero(self) -> pd.DataFrame:
+        return pd.DataFrame(columns=LIBRO_CLAVES + ["Cliente", "Monto"])
+
+    def sumar(self, tabla: str, df: pd.DataFrame) -> pd.DataFrame:
+        """Movimientos de `df` (filas de `tabla`) por clave, sin los de monto 0."""
+        if _vacio(df):
+            return self._cero()
+        m = self.movimientos[tabla](df)
+        m = m[m["Monto"].abs() > 1e-9]
+        return m.groupby(LIBRO_CLAVES, sort=False, as_index=False).agg(Cliente=("Cliente", "first"), Monto=("Monto", "sum"))
+
+    def _comparar(self, nuevo: pd.DataFrame, previo: pd.DataFrame) -> pd.DataFrame:
+        c = nuevo.merge(previo, on=LIBRO_CLAVES, how="outer", suffixes=("", "_previo"))
+        despues, antes = c["Monto"].fillna(0.0), c["Monto_previo"].fillna(0.0)
+        c["Cliente"] = c["Cliente"].fillna(c["Cliente_previo"]).fillna("")
+        c["Monto"] = despues - antes
+        c["Motivo"] = np.where(antes.abs() <= 1e-9, "Alta", np.where(despues.abs() <= 1e-9, "Anulación", "Corrección"))
+        return c[c["Monto"].abs() > 1e-9][LIBRO_CLAVES + ["Cliente", "Monto", "Motivo"]].reset_index(drop=True)
+
+    def delta(self, tabla: str, antes, despues: pd.DataFrame) -> pd.DataFrame:
+        """Movimientos a asentar al pasar `tabla` de `antes` (None: filas nuevas) a `despues`."""
+        return self._comparar(self.sumar(tabla, despues), self.sumar(tabla, antes))
+
+    def desde_tablas(self, tablas: dict) -> pd.DataFrame:
+        """Lo que debería estar asentado por clave según las fuentes."""
+        partes = [self.sumar(t, tablas.get(t)) for t in self.fuentes]
+        partes = [p for p in partes if not p.empty]
+        if not partes:
+            return self._cero()
+        return pd.concat(partes, ignore_index=True)
+
+    def asentado(self, libro: pd.DataFrame) -> pd.DataFrame:
+        """Neto asentado por clave (Debe - Haber en la cuenta deudora del concepto)."""
+        if _vacio(libro):
+            return self._cero()
+        df = libro.reindex(columns=LIBRO_COLS)
+        deudora = df["Concepto"].map({c: d for c, (d, _) in CUENTAS_LIBRO.items()})
+        df = df[df["Cuenta"] == deudora]
+        neto = _numero(df, "Debe").fillna(0.0) - _numero(df, "Haber").fillna(0.0)
+        claves = {c: df[c].astype(object).where(df[c].notna(), "").astype(str) for c in LIBRO_CLAVES}
+        return pd.DataFrame({**claves, "Cliente": df["Cliente"], "Monto": neto}) \
+            .groupby(LIBRO_CLAVES, sort=False, as_index=False).agg(Cliente=("Cliente", "first"), Monto=("Monto", "sum"))
+
+    def pendientes(self, libro: pd.DataFrame, esperado: pd.DataFrame) -> pd.DataFrame:
+        """Movimientos que faltan asentar para que el libro cuadre con `esperado`."""
+        p = self._comparar(esperado, self.asentado(libro))
+        p["Motivo"] = "Conciliación"
+        return p
+
+    def diferencias(self, libro: pd.DataFrame, esperado: pd.DataFrame, tolerancia: float = 0.005) -> pd.DataFrame:
+        cols = LIBRO_CLAVES + ["Asentado", "Esperado", "Diferencia"]
+        c = esperado.merge(self.asentado(libro), on=LIBRO_CLAVES, how="outer", suffixes=("", "_libro"))
+        c["Esperado"], c["Asentado"] = c["Monto"].fillna(0.0), c["Monto_libro"].fillna(0.0)
+        c["Diferencia"] = c["Esperado"] - c["Asentado"]
+        return c[c["Diferencia"].abs() > tolerancia].reset_index(drop=True).reindex(columns=cols)
+
+    def asientos(self, movs: pd.DataFrame, casos: pd.DataFrame, primer_id: int, registrado: str) -> pd.DataFrame:
+        """Dos líneas por movimiento (IDs desde `primer_id`); monto negativo = asiento inverso."""
+        if _vacio(movs):
+            return pd.DataFrame(columns=LIBRO_COLS)
+        movs = movs.reset_index(drop=True)
+        cliente = movs["Cliente"].astype(str).str.strip()
+        del_caso = datos_del_caso(casos, movs["Caso"], ["Cliente"])["Cliente"]
+        movs = movs.assign(Cliente=np.where(cliente != "", cliente, del_caso))
+
+        cuentas = movs["Concepto"].map(CUENTAS_LIBRO)
+        debe = np.array([c[0] for c in cuentas], dtype=object)
+        haber = np.array([c[1] for c in cuentas], dtype=object)
+        inverso = movs["Monto"].values < 0
+        monto = np.abs(movs["Monto"].values)
+        n = len(movs)
+        ids = primer_id + np.arange(2 * n)
+        lineas = pd.concat([
+            movs.assign(ID=ids[0::2], Cuenta=np.where(inverso, haber, debe), Debe=monto, Haber=0.0),
+            movs.assign(ID=ids[1::2], Cuenta=np.where(inverso, debe, haber), Debe=0.0, Haber=monto),
+        ])
+        lineas["Asiento"] = ids[0::2].tolist() * 2
+        lineas["Registrado"] = registrado
+        return lineas.sort_values("ID").reset_index(drop=True)[LIBRO_COLS]
+
+
+LIBRO = LibroDiario({
+    "cuotas": _movs_cuotas,
+    "pagos_honorarios": lambda df: _movs(df, "pagos_honorarios", "Pago honorarios", "FechaPago", _numero(df, "Monto")),
+    "pagos_litis": lambda df: _movs(df, "pagos_litis", "Pago cuota litis", "FechaPago", _numero(df, "Monto")),
+    "actuaciones": _movs_actuaciones,
+    "consultas": _movs_consultas,
+})
+
+
+def indexar_libro(libro: pd.DataFrame) -> dict:
+    """
+    Libro ordenado por caso+fecha (con el tramo de filas de cada caso) y por
+    fecha: estado de cuenta y totales de un período son cortes contiguos.
+    """
+    if _vacio(libro):
+        vacio = pd.DataFrame(columns=LIBRO_COLS)
+        return {"por_caso": vacio, "tramos": {}, "por_fecha": vacio}
+    df = libro.reindex(columns=LIBRO_COLS)
+    df["Fecha"] = df["Fecha"].astype(object).where(df["Fecha"].notna(), "").astype(str)
+    df["Caso"] = normalizar_caso(df["Caso"])
+    df["_n"] = pd.to_numeric(df["ID"], errors="coerce")
+    por_caso = df.sort_values(["Caso", "Fecha", "_n"], kind="stable").drop(columns="_n").reset_index(drop=True)
+    casos, inicio = np.unique(por_caso["Caso"].values.astype(str), return_index=True)
+    fin = np.append(inicio[1:], len(por_caso))
+    return {
+        "por_caso": por_caso,
+        "tramos": dict(zip(casos, zip(inicio, fin))),
+        "por_fecha": df.sort_values(["Fecha", "_n"], kind="stable").drop(columns="_n").reset_index(drop=True),
+    }
+
+
+def _corte(df: pd.DataFrame, ini: int, fin: int, desde=None, hasta=None) -> pd.DataFrame:
+    fechas = df["Fecha"].values[ini:fin].astype(str)
+    a = ini + (np.searchsorted(fechas, str(desde), "left") if desde else 0)
+    b = ini + (np.searchsorted(fechas, str(hasta), "right") if hasta else fin - ini)
+    return df.iloc[a:b]
+
+
+def libro_del_caso(indice: dict, caso, desde=None, hasta=None) -> pd.DataFrame:
+    """Líneas del caso en [desde, hasta] (AAAA-MM-DD), ordenadas por fecha."""
+    tramo = indice["tramos"].get(normalizar_caso(pd.Series([caso])).iloc[0])
+    if tramo is None:
+        return indice["por_caso"].iloc[0:0]
+    return _corte(indice["por_caso"], tramo[0], tramo[1], desde, hasta)
+
+
+def libro_del_periodo(indice: dict, desde=None, hasta=None) -> pd.DataFrame:
+    df = indice["por_fecha"]
+    return _corte(df, 0, len(df), desde, hasta)
+
+
+def estado_de_cuenta(lineas: pd.DataFrame, saldo_inicial: float = 0.0) -> pd.DataFrame:
+    """Cargos y abonos al cliente (cuentas por cobrar y gastos) con saldo corrido."""
+    cols = ["Fecha", "Concepto", "Motivo", "Cargo", "Abono", "Saldo", "Tabla", "OrigenID"]
+    if _vacio(lineas):
+        return pd.DataFrame(columns=cols)
+    df = lineas[lineas["Cuenta"].isin(CUENTAS_CLIENTE)]
+    cargo, abono = _numero(df, "Debe").fillna(0.0), _numero(df, "Haber").fillna(0.0)
+    return pd.DataFrame({
+        "Fecha": df["Fecha"], "Concepto": df["Concepto"], "Motivo": df["Motivo"],
+        "Cargo": cargo, "Abono": abono, "Saldo": saldo_inicial + (cargo - abono).cumsum(),
+        "Tabla": df["Tabla"], "OrigenID": df["OrigenID"],
+    })[cols].reset_index(drop=True)
+
+
+def saldo_cliente(lineas: pd.DataFrame) -> float:
+    if _vacio(lineas):
+        return 0.0
+    df = lineas[lineas["Cuenta"].isin(CUENTAS_CLIENTE)]
+    return float(_numero(df, "Debe").fillna(0.0).sum() - _numero(df, "Haber").fillna(0.0).sum())
+
+
+def totales_por_cuenta(lineas: pd.DataFrame) -> pd.DataFrame:
+    cols = ["Cuenta", "Debe", "Haber", "Saldo"]
+    if _vacio(lineas):
+        return pd.DataFrame(columns=cols)
+    df = pd.DataFrame({
+        "Cuenta": lineas["Cuenta"],
+        "Debe": _numero(lineas, "Debe").fillna(0.0),
+        "Haber": _numero(lineas, "Haber").fillna(0.0),
+    })
+    out = df.groupby("Cuenta", as_index=False)[["Debe", "Haber"]].sum()
+    out["Saldo"] = out["Debe"] - out["Haber"]
+    return out[cols]
@@ -0,0 +1,357 @@
+# respaldos.py
+# Almacén de respaldos por contenido (sin Streamlit: lo usa app.py y también la consola)
+#
+# - Cada versión se guarda UNA sola vez, comprimida: backups/store/<ab>/<sha256>.gz
+# - backups/catalogo.csv registra Tabla, Archivo, Fecha, Hash, Bytes, Motivo
+# - Si el contenido no cambió desde el último respaldo de la tabla, no se registra nada
+# - Retención: lo último de cada hora durante N horas, lo último de cada día
+#   durante M días; lo más reciente de cada tabla nunca se borra
+#
+# Uso por consola:
+#   python respaldos.py listar [tabla]
+#   python respaldos.py restaurar <tabla> <hash> [--destino archivo.csv]
+#   python respaldos.py podar
+#   python respaldos.py importar-legado      (los backups/*.bak de versiones anteriores)
+# Opciones: --dir <carpeta de datos> (por defecto .), --horas 48, --dias 60
+
+import argparse
+import csv
+import gzip
+import hashlib
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+try:
+    import fcntl  # bloqueos entre procesos (no existe en Windows)
+except Exception:
+    fcntl = None
+
+CATALOGO_COLS = ["Tabla", "Archivo", "Fecha", "Hash", "Bytes", "Motivo"]
+FORMATO_FECHA = "%Y-%m-%d %H:%M:%S"
+
+
+def escribir_atomico(path: str, data: bytes):
+    """Escribe en un temporal de la misma carpeta y lo renombra (nunca queda a medias)."""
+    carpeta = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=carpeta)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class Almacen:
+    def __init__(self, backup_dir: str, locks_dir: str, horas: int = 48, dias: int = 60):
+        self.backup_dir = backup_dir
+        self.store_dir = os.path.join(backup_dir, "store")
+        self.catalogo = os.path.join(backup_dir, "catalogo.csv")
+        self.locks_dir = locks_dir
+        self.horas = int(horas)
+        self.dias = int(dias)
+        self._lock = threading.RLock()
+        self._ultima_poda = 0.0
+        os.makedirs(self.store_dir, exist_ok=True)
+        os.makedirs(self.locks_dir, exist_ok=True)
+
+    # ---------- bloqueo del catálogo ----------
+    @contextmanager
+    def _bloqueo(self):
+        with self._lock:
+            f = None
+            try:
+                if fcntl is not None:
+                    f = open(os.path.join(self.locks_dir, "_respaldos.lock"), "a")
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                yield
+            finally:
+                if f is not None:
+                    try:
+                        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                    finally:
+                        f.close()
+
+    # ---------- catálogo ----------
+    def _leer_catalogo(self) -> list:
+        if not os.path.exists(self.catalogo):
+            return []
+        with open(self.catalogo, newline="", encoding="utf-8") as f:
+            return [r for r in csv.DictReader(f) if r.get("Hash")]
+
+    def _escribir_catalogo(self, filas: list):
+        from io import StringIO
+        buf = StringIO()
+        w = csv.DictWriter(buf, fieldnames=CATALOGO_COLS, lineterminator="\n")
+        w.writeheader()
+        w.writerows(filas)
+        escribir_atomico(self.catalogo, buf.getvalue().encode("utf-8"))
+
+    def _agregar_catalogo(self, fila: dict):
+        nuevo = not os.path.exists(self.catalogo) or os.path.getsize(self.catalogo) == 0
+        with open(self.catalogo, "a", newline="", encoding="utf-8") as f:
+            w = csv.DictWriter(f, fieldnames=CATALOGO_COLS, lineterminator="\n")
+            if nuevo:
+                w.writeheader()
+            w.writerow(fila)
+            f.flush()
+            os.fsync(f.fileno())
+
+    # ---------- blobs ----------
+    def _blob_path(self, h: str) -> str:
+        return os.path.join(self.store_dir, h[:2], f"{h}.gz")
+
+    def _guardar_blob(self, h: str, data: bytes):
+        path = self._blob_path(h)
+        if os.path.exists(path):
+            return  # mismo contenido ya guardado
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        escribir_atomico(path, gzip.compress(data, compresslevel=6, mtime=0))
+
+    def leer(self, h: str) -> bytes:
+        with open(self._blob_path(h), "rb") as f:
+            return gzip.decompress(f.read())
+
+    # ---------- respaldar ----------
+    def respaldar_bytes(self, tabla: str, archivo: str, data: bytes, motivo: str = "guardado", fecha=None) -> bool:
+        """Registra una versión. False si el contenido es igual al último respaldo de la tabla."""
+        h = hashlib.sha256(data).hexdigest()
+        with self._bloqueo():
+            ultimo = None
+            for r in self._leer_catalogo():
+                if r["Tabla"] == tabla:
+                    ultimo = r
+            if ultimo is not None and ultimo["Hash"] == h:
+                return False
+            self._guardar_blob(h, data)
+            self._agregar_catalogo({
+                "Tabla": tabla,
+                "Archivo": archivo,
+                "Fecha": (fecha or datetime.now()).strftime(FORMATO_FECHA),
+                "Hash": h,
+                "Bytes": len(data),
+                "Motivo": motivo,
+            })
+        self._podar_si_toca()
+        return True
+
+    def respaldar_archivo(self, tabla: str, path: str, motivo: str = "guardado") -> bool:
+        if not os.path.exists(path):
+            return False
+        with open(path, "rb") as f:
+            data = f.read()
+        return self.respaldar_bytes(tabla, path, data, motivo)
+
+    # ---------- consultar ----------
+    def versiones(self, tabla=None) -> list:
+        """Versiones registradas (más reciente primero)."""
+        filas = [r for r in self._leer_catalogo() if tabla is None or r["Tabla"] == tabla]
+        return self._ordenar(filas)
+
+    @staticmethod
+    def _ordenar(filas: list) -> list:
+        # más reciente primero; a igual segundo, la registrada después
+        pos = {id(r): i for i, r in enumerate(filas)}
+        return sorted(filas, key=lambda r: (r["Fecha"], pos[id(r)]), reverse=True)
+
+    def tablas(self) -> list:
+        return sorted({r["Tabla"] for r in self._leer_catalogo()})
+
+    def buscar(self, tabla: str, h: str) -> dict:
+        """Versión por hash completo o prefijo; None si no existe o es ambigua."""
+        hallados = {r["Hash"]: r for r in self.versiones(tabla) if r["Hash"].startswith(h)}
+        return next(iter(hallados.values())) if len(hallados) == 1 else None
+
+    # ---------- retención ----------
+    def _conservar(self, filas: list, ahora: datetime) -> list:
+        pos = {id(r): i for i, r in enumerate(filas)}
+        por_tabla = {}
+        for r in filas:
+            por_tabla.setdefault(r["Tabla"], []).append(r)
+
+        quedan = []
+        for regs in por_tabla.values():
+            regs = self._ordenar(regs)
+            vistos = set()
+            for i, r in enumerate(regs):
+                try:
+                    f = datetime.strptime(r["Fecha"], FORMATO_FECHA)
+                except ValueError:
+                    f = ahora
+                edad = ahora - f
+                if i == 0:
+                    cubeta = ("ultimo",)
+                elif edad <= timedelta(hours=self.horas):
+                    cubeta = ("hora", f.strftime("%Y%m%d%H"))
+                elif edad <= timedelta(days=self.dias):
+                    cubeta = ("dia", f.strftime("%Y%m%d"))
+                else:
+                    continue
+                # la más reciente de cada cubeta (regs va de nuevo a viejo)
+                if cubeta not in vistos:
+                    vistos.add(cubeta)
+                    quedan.append(r)
+        # mismo orden en que estaban registradas
+        return sorted(quedan, key=lambda r: pos[id(r)])
+
+    def podar(self, ahora=None) -> dict:
+        """Aplica la retención y borra los blobs que ya nadie usa."""
+        ahora = ahora or datetime.now()
+        with self._bloqueo():
+            filas = self._leer_catalogo()
+            quedan = self._conservar(filas, ahora)
+            if len(quedan) != len(filas):
+                self._escribir_catalogo(quedan)
+
+            usados = {r["Hash"] for r in quedan}
+            borrados = 0
+            for carpeta, _, archivos in os.walk(self.store_dir):
+                for a in archivos:
+                    if a.endswith(".gz") and a[:-3] not in usados:
+                        try:
+                            os.remove(os.path.join(carpeta, a))
+                            borrados += 1
+                        except OSError:
+                            pass
+        self._ultima_poda = time.time()
+        return {"versiones": len(filas) - len(quedan), "blobs": borrados}
+
+    def _podar_si_toca(self):
+        # como mucho una vez por hora y por proceso
+        if time.time() - self._ultima_poda >= 3600:
+            try:
+                self.podar()
+            except Exception:
+                pass
+
+    # ---------- restaurar ----------
+    def restaurar(self, tabla: str, h: str, destino=None) -> str:
+        """
+        Copia la versión `h` sobre su archivo (o `destino`), respaldando antes lo actual.
+        Para tablas en uso, preferir la restauración desde la app (respeta caché y motor).
+        """
+        r = self.buscar(tabla, h)
+        if r is None:
+            raise KeyError(f"No hay una versión '{h}' de '{tabla}' (o el prefijo es ambiguo)")
+        original = destino is None or os.path.abspath(destino) == os.path.abspath(r["Archivo"])
+        destino = destino or r["Archivo"]
+        data = self.leer(r["Hash"])
+
+        f = None
+        try:
+            if fcntl is not None:
+                # mismo archivo de bloqueo que usa la app para esa tabla
+                f = open(os.path.join(self.locks_dir, f"{tabla}.lock"), "a")
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            if original:
+                self.respaldar_archivo(tabla, destino, motivo="antes de restaurar")
+            escribir_atomico(destino, data)
+        finally:
+            if f is not None:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                finally:
+                    f.close()
+        return destino
+
+    # ---------- respaldos de versiones anteriores ----------
+    def importar_legado(self, archivos: dict = None) -> int:
+        """
+        Pasa al almacén los backups/*.bak sueltos (nombre.AAAAMMDD_HHMMSS[.motivo].bak)
+        y los elimina. `archivos` es tabla -> archivo (FILES); sin él se usa lo que
+        ya diga el catálogo. Devuelve cuántos archivos se procesaron.
+        """
+        archivos = dict(archivos or {})
+        for r in self._leer_catalogo():
+            archivos.setdefault(r["Tabla"], r["Archivo"])
+        tabla_de = {os.path.basename(v): k for k, v in archivos.items()}
+
+        patron = re.compile(r"^(?P<base>.+?)\.(?P<stamp>\d{8}_\d{6})(?:\.(?P<motivo>[a-z]+))?\.bak$")
+        encontrados = []
+        for a in os.listdir(self.backup_dir):
+            m = patron.match(a)
+            if m:
+                encontrados.append((m.group("stamp"), a, m))
+
+        n = 0
+        for stamp, a, m in sorted(encontrados):
+            base = m.group("base")
+            if base.endswith(".sqlite"):
+                tabla = base[:-len(".sqlite")]
+                archivo = archivos.get(tabla, f"{tabla}.csv")
+            else:
+                tabla = tabla_de.get(base, os.path.splitext(base)[0])
+                archivo = archivos.get(tabla, base)
+            path = os.path.join(self.backup_dir, a)
+            with open(path, "rb") as f:
+                data = f.read()
+            self.respaldar_bytes(
+                tabla, archivo, data,
+                motivo=m.group("motivo") or "legado",
+                fecha=datetime.strptime(stamp, "%Y%m%d_%H%M%S"),
+            )
+            os.remove(path)
+            n += 1
+        return n
+
+
+# ==========================================================
+# CONSOLA
+# ==========================================================
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Respaldos por contenido del estudio")
+    ap.add_argument("--dir", default=".", help="carpeta de datos (donde están los CSV)")
+    ap.add_argument("--horas", type=int, default=48, help="horas con un respaldo por hora")
+    ap.add_argument("--dias", type=int, default=60, help="días con un respaldo por día")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p_listar = sub.add_parser("listar", help="versiones registradas")
+    p_listar.add_argument("tabla", nargs="?")
+
+    p_rest = sub.add_parser("restaurar", help="restaurar una versión (hash o prefijo)")
+    p_rest.add_argument("tabla")
+    p_rest.add_argument("hash")
+    p_rest.add_argument("--destino", help="escribir en otro archivo en lugar del original")
+
+    sub.add_parser("podar", help="aplicar la política de retención")
+    sub.add_parser("importar-legado", help="pasar al almacén los backups/*.bak antiguos")
+
+    args = ap.parse_args(argv)
+    os.chdir(args.dir)  # las rutas del catálogo son relativas a la carpeta de datos
+    alm = Almacen("backups", ".locks", horas=args.horas, dias=args.dias)
+
+    if args.cmd == "listar":
+        filas = alm.versiones(args.tabla)
+        if not filas:
+            print("Sin respaldos registrados.")
+        for r in filas:
+            print(f"{r['Fecha']}  {r['Tabla']:<20} {r['Hash'][:12]}  {int(r['Bytes']):>10} B  {r['Motivo']}")
+    elif args.cmd == "restaurar":
+        try:
+            destino = alm.restaurar(args.tabla, args.hash, args.destino)
+        except KeyError as e:
+            print(f"❌ {e.args[0]}")
+            return 1
+        print(f"✅ Restaurado en {destino}")
+    elif args.cmd == "podar":
+        res = alm.podar()
+        print(f"✅ Versiones eliminadas: {res['versiones']} – blobs borrados: {res['blobs']}")
+    elif args.cmd == "importar-legado":
+        print(f"✅ Respaldos importados: {alm.importar_legado()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+# Carga con datos a reparar (ID vacío, Caso en minúsculas, Tipo heredado)
+# con una sesión ya iniciada: load_df_reparado guarda la reparación con
+# save_df, que consulta el alcance del perfil de la sesión.
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+AppTest = pytest.importorskip("streamlit.testing.v1").AppTest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULOS = ["app.py", "finanzas.py", "asignaciones.py", "respaldos.py"]
+
+
+def _sembrar(d):
+    pd.DataFrame([{"ID": 1, "Nombre": "Abogado 1", "Activo": "1"}]).to_csv(os.path.join(d, "abogados.csv"), index=False)
+    pd.DataFrame([{"ID": 1, "Nombre": "Cliente 1"}]).to_csv(os.path.join(d, "clientes.csv"), index=False)
+    pd.DataFrame([
+        {"ID": i, "Expediente": f"EXP-{i}", "Cliente": "Cliente 1", "Abogado": "Abogado 1", "EstadoCaso": "Activo"}
+        for i in (1, 2)
+    ]).to_csv(os.path.join(d, "casos.csv"), index=False)
+    pd.DataFrame([
+        {"ID": 1, "Caso": "EXP-1", "FechaPago": "2024-01-10", "Monto": 100.0},
+    ]).to_csv(os.path.join(d, "pagos_honorarios.csv"), index=False)
+    pd.DataFrame([
+        {"ID": 1, "Caso": "EXP-1", "Tipo": "Honorarios", "NroCuota": 1, "FechaVenc": "2024-02-15", "Monto": 50.0},
+    ]).to_csv(os.path.join(d, "cuotas.csv"), index=False)
+
+
+def _a_reparar(d):
+    # ID vacío y Caso en minúsculas / cuota con el Tipo antiguo
+    pd.DataFrame([
+        {"ID": 1, "Caso": "EXP-1", "FechaPago": "2024-01-10", "Monto": 100.0},
+        {"ID": "", "Caso": "exp-2", "FechaPago": "2024-01-11", "Monto": 40.0},
+    ]).to_csv(os.path.join(d, "pagos_honorarios.csv"), index=False)
+    pd.DataFrame([
+        {"ID": 1, "Caso": "EXP-1", "Tipo": "Honorarios", "NroCuota": 1, "FechaVenc": "2024-02-15", "Monto": 50.0},
+        {"ID": 2, "Caso": "EXP-2", "Tipo": "Cuota Litis", "NroCuota": 1, "FechaVenc": "2024-03-15", "Monto": 70.0},
+    ]).to_csv(os.path.join(d, "cuotas.csv"), index=False)
+
+
+@pytest.fixture
+def carpeta(tmp_path, monkeypatch):
+    for m in MODULOS:
+        shutil.copy(os.path.join(RAIZ, m), tmp_path)
+    os.makedirs(tmp_path / ".streamlit")
+    (tmp_path / ".streamlit" / "secrets.toml").write_text('CONTROL_PASSWORD = "c"\n')
+    _sembrar(str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    import streamlit as st
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    return tmp_path
+
+
+def test_reparacion_con_sesion_iniciada(carpeta):
+    at = AppTest.from_file(str(carpeta / "app.py"), default_timeout=60)
+    at.session_state["usuario"] = "admin"
+    at.session_state["rol"] = "admin"
+    at.run()
+    assert not at.exception
+    assert at.session_state["perfil"] is not None
+
+    _a_reparar(str(carpeta))
+    at.run()
+    assert not at.exception, [e.value for e in at.exception]
+
+    pagos = pd.read_csv(carpeta / "pagos_honorarios.csv")
+    assert pagos["ID"].notna().all()
+    assert set(pagos["Caso"]) == {"EXP-1", "EXP-2"}
+    cuotas = pd.read_csv(carpeta / "cuotas.csv")
+    assert set(cuotas["Tipo"]) == {"Honorarios", "CuotaLitis"}